@@ -0,0 +1,393 @@
+import os
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pymongo
+from bson.objectid import ObjectId
+
+from bitmex_watcher.partitions import TimePartitionedCollection, to_utc
+from bitmex_watcher.snapshot_arrays import OrderBookArraysBatch
+from bitmex_watcher.snapshot_store import OrderBookSnapshotReader, rebuild_levels, DELTA
+from bitmex_watcher.settings import settings
+from bitmex_watcher.utils import log, constants
+
+
+logger = log.setup_custom_logger('root')
+
+TRADES = 'trades'
+ORDER_BOOK_SNAPSHOTS = 'order_book_snapshots'
+
+_TIMESTAMP_TYPE = pa.timestamp('us', tz='UTC')
+
+TRADES_SCHEMA = pa.schema([
+    ('timestamp', _TIMESTAMP_TYPE),
+    ('trdMatchID', pa.string()),
+    ('side', pa.string()),
+    ('price', pa.float64()),
+    ('size', pa.int64())
+])
+
+# Summary values of OrderBookSnapshot.to_summary_dict() (except the timestamp) and their types.
+SUMMARY_FIELDS = [
+    ('midPrice', pa.float64()),
+    ('priceFromDepth', pa.float64()),
+    ('depthBias', pa.float64()),
+    ('bidsRatio', pa.float64()),
+    ('totalVolume', pa.int64()),
+    ('highestBid', pa.float64()),
+    ('lowestBid', pa.float64()),
+    ('bidsVolume', pa.int64()),
+    ('lowestAsk', pa.float64()),
+    ('highestAsk', pa.float64()),
+    ('asksVolume', pa.int64())
+]
+
+# Levels are kept as list columns, so that a row is a whole snapshot.
+ORDER_BOOK_SNAPSHOTS_SCHEMA = pa.schema([('timestamp', _TIMESTAMP_TYPE), ('id', pa.string())] + SUMMARY_FIELDS + [
+    ('bidPrices', pa.list_(pa.float64())),
+    ('bidSizes', pa.list_(pa.int64())),
+    ('askPrices', pa.list_(pa.float64())),
+    ('askSizes', pa.list_(pa.int64()))
+])
+
+
+def archive_directory(root, kind, symbol, date):
+    """
+    Returns the directory of the files of a symbol and a date (UTC),
+    e.g. "archive/trades/symbol=XBTUSD/date=2019-04-13".
+    """
+    return os.path.join(root, kind, "symbol={}".format(symbol), "date={}".format(date.strftime('%Y-%m-%d')))
+
+
+def archive_file_name(timestamp, document_id):
+    """
+    Files are named after their first row. Archiving again from the same checkpoint overwrites the same file.
+    """
+    return "part-{}-{}.parquet".format(to_utc(timestamp).strftime('%Y%m%dT%H%M%S%f'), document_id)
+
+
+def trades_table(documents):
+    return pa.Table.from_arrays([
+        pa.array([to_utc(d['timestamp']) for d in documents], _TIMESTAMP_TYPE),
+        pa.array([d['trdMatchID'] for d in documents], pa.string()),
+        pa.array([d['side'] for d in documents], pa.string()),
+        pa.array([float(d['price']) for d in documents], pa.float64()),
+        pa.array([int(d['size']) for d in documents], pa.int64())
+    ], schema=TRADES_SCHEMA)
+
+
+def order_book_snapshots_table(documents):
+    """
+    documents must have their levels in 'bids' and 'asks', as OrderBookSnapshotReader returns them.
+    """
+    columns = [
+        pa.array([to_utc(d['timestamp']) for d in documents], _TIMESTAMP_TYPE),
+        pa.array([str(d['_id']) for d in documents], pa.string())
+    ]
+    for name, data_type in SUMMARY_FIELDS:
+        columns.append(pa.array([d[name] for d in documents], data_type))
+    for side in ('bids', 'asks'):
+        columns.append(pa.array([[float(each["price"]) for each in d[side]] for d in documents],
+                                pa.list_(pa.float64())))
+        columns.append(pa.array([[int(each["size"]) for each in d[side]] for d in documents],
+                                pa.list_(pa.int64())))
+    return pa.Table.from_arrays(columns, schema=ORDER_BOOK_SNAPSHOTS_SCHEMA)
+
+
+def write_table(table, directory, file_name, compression):
+    # Written under a temporary name first, so that readers never see a partial file.
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, file_name)
+    pq.write_table(table, path + '.tmp', compression=compression)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def padded_matrix(column, dtype):
+    """
+    Converts a list column into a (num_rows, max_length) array padded with zeros, and the lengths of the rows.
+    """
+    if column.num_chunks == 0:
+        return np.zeros((0, 0), dtype=dtype), np.zeros(0, dtype=np.int64)
+    list_array = pa.concat_arrays(column.chunks)
+    offsets = list_array.offsets.to_numpy()
+    values = list_array.flatten().to_numpy(zero_copy_only=False).astype(dtype)
+    counts = np.diff(offsets)
+    result = np.zeros((len(counts), counts.max(initial=0)), dtype=dtype)
+    rows = np.repeat(np.arange(len(counts)), counts)
+    columns = np.arange(len(values)) - np.repeat(offsets[:-1] - offsets[0], counts)
+    result[rows, columns] = values
+    return result, counts
+
+
+###
+# Position of the archive of a kind of data and a symbol: the (timestamp, id) of the last archived row.
+# Kept in a JSON file at the root of the archive, replaced atomically after each file is written.
+##
+class ArchiveCheckpoint:
+
+    def __init__(self, root):
+        self.path = os.path.join(root, 'checkpoint.json')
+        self.positions = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.positions = json.load(f)
+
+    @staticmethod
+    def key(kind, symbol):
+        return "{}/{}".format(kind, symbol)
+
+    def get(self, kind, symbol):
+        """
+        Returns (timestamp, id) or None.
+        """
+        position = self.positions.get(ArchiveCheckpoint.key(kind, symbol))
+        if position is None:
+            return None
+        return datetime.strptime(position['timestamp'], '%Y-%m-%dT%H:%M:%S.%f%z'), position['id']
+
+    def save(self, kind, symbol, timestamp, document_id):
+        self.positions[ArchiveCheckpoint.key(kind, symbol)] = {
+            'timestamp': to_utc(timestamp).strftime('%Y-%m-%dT%H:%M:%S.%f%z'),
+            'id': document_id
+        }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.positions, f, indent=2, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+
+
+###
+# Copies the trades and the order book snapshots of a symbol from MongoDB into Parquet files,
+# a file per date (UTC) and batch of rows, resuming from the checkpoint of the last run.
+#
+# Documents are read in the order of (timestamp, id) in one cursor, instead of one by one.
+# Delta documents are rebuilt on the fly from the snapshot before them.
+#
+# The checkpoint is a (timestamp, id), not an insertion order. Documents inserted after the checkpoint has passed
+# their timestamps (backfilled trades, or writes retried by MongoWriter for longer than the lag of the runs)
+# are archived in files of their own, if they are at most recheck_seconds behind the checkpoint.
+# Every run compares that many seconds of MongoDB with the archive. Those further behind are never archived.
+##
+class MarketDataArchiver:
+
+    def __init__(self, root, db, symbol, trades_collection_name, order_book_snapshots_collection_name,
+                 partitioning='none', compression='snappy', max_rows_per_file=100000, recheck_seconds=3600):
+        self.root = root
+        self.db = db
+        self.symbol = symbol
+        self.trades_collection_name = trades_collection_name
+        self.order_book_snapshots_collection_name = order_book_snapshots_collection_name
+        self.partitioning = partitioning
+        self.compression = compression
+        self.max_rows_per_file = max_rows_per_file
+        self.recheck_seconds = recheck_seconds
+        self.checkpoint = ArchiveCheckpoint(root)
+
+    def source_collections(self, base_name, since):
+        if self.partitioning == 'none':
+            return [self.db[base_name]]
+        partitioned = TimePartitionedCollection(self.db, base_name, self.partitioning)
+        return partitioned.existing_partitions(self.db.list_collection_names(), since)
+
+    @staticmethod
+    def query(id_field, position, end):
+        query = {"timestamp": {"$lt": end}}
+        if position is not None:
+            timestamp, document_id = position
+            if id_field == '_id':
+                document_id = ObjectId(document_id)
+            query["$or"] = [{"timestamp": {"$gt": timestamp}},
+                            {"timestamp": timestamp, id_field: {"$gt": document_id}}]
+        return query
+
+    @staticmethod
+    def late_query(id_field, position, start):
+        """
+        The documents from start up to the position (inclusive).
+        """
+        timestamp, document_id = position
+        if id_field == '_id':
+            document_id = ObjectId(document_id)
+        return {"timestamp": {"$gte": start, "$lte": timestamp},
+                "$or": [{"timestamp": {"$lt": timestamp}}, {"timestamp": timestamp, id_field: {"$lte": document_id}}]}
+
+    def _archive(self, kind, base_name, id_field, id_column, end, to_documents, to_table):
+        """
+        Archives the documents before end, and those which arrived late behind the checkpoint.
+        Returns the number of rows archived.
+        """
+        position = self.checkpoint.get(kind, self.symbol)
+        num_rows = 0
+        if position is not None and 0 < self.recheck_seconds:
+            num_rows += self._archive_late(kind, base_name, id_field, id_column, position, to_documents, to_table)
+        for collection in self.source_collections(base_name, None if position is None else position[0]):
+            cursor = collection.find(MarketDataArchiver.query(id_field, position, end)).sort(
+                [("timestamp", pymongo.ASCENDING), (id_field, pymongo.ASCENDING)])
+            num_rows += self._write_batches(kind, id_field, to_documents(collection, cursor), to_table, True)
+            position = self.checkpoint.get(kind, self.symbol)
+        return num_rows
+
+    def _archive_late(self, kind, base_name, id_field, id_column, position, to_documents, to_table):
+        """
+        Archives the documents of the last recheck_seconds up to the checkpoint which are missing from the archive.
+        """
+        start = position[0] - timedelta(seconds=self.recheck_seconds)
+        table = ArchiveReader(self.root).load_table(kind, self.symbol, start, position[0] + timedelta(microseconds=1))
+        archived_ids = set() if table is None else set(table.column(id_column).to_pylist())
+        num_rows = 0
+        for collection in self.source_collections(base_name, start):
+            cursor = collection.find(MarketDataArchiver.late_query(id_field, position, start)).sort(
+                [("timestamp", pymongo.ASCENDING), (id_field, pymongo.ASCENDING)])
+            documents = (d for d in cursor if str(d[id_field]) not in archived_ids)
+            num_rows += self._write_batches(kind, id_field, to_documents(collection, documents), to_table, False)
+        if 0 < num_rows:
+            logger.warning("%d rows of %s arrived late and are archived behind the checkpoint.", num_rows, kind)
+        return num_rows
+
+    def _write_batches(self, kind, id_field, documents, to_table, is_checkpointed):
+        num_rows = 0
+        batch = []
+        for document in documents:
+            if 0 < len(batch) and (self.max_rows_per_file <= len(batch) or
+                                   to_utc(batch[0]['timestamp']).date() != to_utc(document['timestamp']).date()):
+                num_rows += self._write(kind, id_field, batch, to_table, is_checkpointed)
+                batch = []
+            batch.append(document)
+        if 0 < len(batch):
+            num_rows += self._write(kind, id_field, batch, to_table, is_checkpointed)
+        return num_rows
+
+    def _write(self, kind, id_field, documents, to_table, is_checkpointed=True):
+        first = documents[0]
+        last = documents[-1]
+        path = write_table(to_table(documents),
+                           archive_directory(self.root, kind, self.symbol, to_utc(first['timestamp'])),
+                           archive_file_name(first['timestamp'], first[id_field]), self.compression)
+        # The checkpoint follows the file, so that a crash in between only writes the same file again.
+        # Late documents are not checkpointed; the next run finds them in the archive.
+        if is_checkpointed:
+            self.checkpoint.save(kind, self.symbol, last['timestamp'], str(last[id_field]))
+        logger.info("%d rows are archived: %s", len(documents), path)
+        return len(documents)
+
+    def archive_trades(self, end):
+        return self._archive(TRADES, self.trades_collection_name, 'trdMatchID', 'trdMatchID', end,
+                             lambda collection, documents: documents, trades_table)
+
+    @staticmethod
+    def full_order_book_documents(collection, documents):
+        """
+        Yields documents with their levels in 'bids' and 'asks'.
+        A delta right after its previous snapshot is applied to it; others are rebuilt from their keyframes.
+        """
+        reader = OrderBookSnapshotReader(collection)
+        last = None
+        for document in documents:
+            if document.get('type') == DELTA and last is not None and\
+                    last.get('keyframeId') == document['keyframeId'] and last.get('seq', 0) + 1 == document['seq']:
+                bids, asks = rebuild_levels(last, [document])
+                result = dict(document)
+                for key in ('bidsChanges', 'asksChanges'):
+                    result.pop(key)
+                result.update({'bids': bids, 'asks': asks})
+            else:
+                result = reader.rebuild(document, collection)
+            if result is None:
+                # The keyframe has been removed.
+                continue
+            last = result
+            yield result
+
+    def archive_order_book_snapshots(self, end):
+        return self._archive(ORDER_BOOK_SNAPSHOTS, self.order_book_snapshots_collection_name, '_id', 'id', end,
+                             MarketDataArchiver.full_order_book_documents, order_book_snapshots_table)
+
+
+###
+# Loads a time range of an archive into NumPy arrays, reading only the files of the dates in the range.
+##
+class ArchiveReader:
+
+    def __init__(self, root):
+        self.root = root
+
+    def load_table(self, kind, symbol, start, end):
+        """
+        Returns a pyarrow Table of the rows in [start, end) sorted by timestamp, or None if there are none.
+        Rows archived late are in files of their own.
+        """
+        start = to_utc(start)
+        end = to_utc(end)
+        tables = []
+        date = start.date()
+        while date <= end.date():
+            directory = archive_directory(self.root, kind, symbol, date)
+            if os.path.isdir(directory):
+                for name in sorted(os.listdir(directory)):
+                    if name.endswith('.parquet'):
+                        tables.append(pq.read_table(os.path.join(directory, name)))
+            date += timedelta(days=1)
+        if len(tables) == 0:
+            return None
+        table = pa.concat_tables(tables).combine_chunks()
+        timestamps = table.column('timestamp').to_numpy()
+        is_in_range = (np.datetime64(start.replace(tzinfo=None), 'us') <= timestamps) &\
+                      (timestamps < np.datetime64(end.replace(tzinfo=None), 'us'))
+        table = table.filter(pa.array(is_in_range))
+        return table.take(pa.array(np.argsort(table.column('timestamp').to_numpy(), kind='stable')))
+
+    def load_trades(self, symbol, start, end):
+        """
+        Returns a dict of arrays: 'timestamp' (datetime64[us] in UTC), 'trdMatchID', 'side', 'price' and 'size'.
+        """
+        table = self.load_table(TRADES, symbol, start, end)
+        if table is None:
+            table = TRADES_SCHEMA.empty_table()
+        return {name: table.column(name).to_numpy() for name in TRADES_SCHEMA.names}
+
+    def load_order_book_snapshots(self, symbol, start, end):
+        """
+        Returns the summary values as a dict of arrays ('timestamp', 'id', 'midPrice', ...),
+        and the levels as an OrderBookArraysBatch.
+        """
+        table = self.load_table(ORDER_BOOK_SNAPSHOTS, symbol, start, end)
+        if table is None:
+            table = ORDER_BOOK_SNAPSHOTS_SCHEMA.empty_table()
+        summary = {name: table.column(name).to_numpy() for name in ['timestamp', 'id'] + [n for n, _ in SUMMARY_FIELDS]}
+        bid_prices, num_bids = padded_matrix(table.column('bidPrices'), np.float64)
+        bid_sizes, _ = padded_matrix(table.column('bidSizes'), np.int64)
+        ask_prices, num_asks = padded_matrix(table.column('askPrices'), np.float64)
+        ask_sizes, _ = padded_matrix(table.column('askSizes'), np.int64)
+        batch = OrderBookArraysBatch(list(summary['timestamp']), bid_prices, bid_sizes, num_bids,
+                                     ask_prices, ask_sizes, num_asks)
+        return summary, batch
+
+
+def start():
+    """
+    Archives what the watcher has saved up to ARCHIVE_LAG_SECONDS ago, for every symbol, and returns.
+    Run it periodically (e.g. from cron); every run continues from the last one.
+    """
+    from bitmex_watcher.watcher_server import symbol_scoped_name
+
+    mongo_client = pymongo.MongoClient(settings.MONGO_DB_URI)
+    try:
+        db = mongo_client[settings.BITMEX_DB]
+        end = datetime.now().astimezone(constants.TIMEZONE) - timedelta(seconds=settings.ARCHIVE_LAG_SECONDS)
+        for symbol in settings.SYMBOLS or [settings.SYMBOL]:
+            scope = symbol if settings.SYMBOLS else None
+            archiver = MarketDataArchiver(
+                settings.ARCHIVE_DIR, db, symbol,
+                symbol_scoped_name(settings.TRADES_COLLECTION, scope),
+                symbol_scoped_name(settings.ORDER_BOOK_SNAPSHOTS_COLLECTION, scope),
+                settings.STORAGE_PARTITIONING, settings.ARCHIVE_COMPRESSION, settings.ARCHIVE_MAX_ROWS_PER_FILE,
+                settings.ARCHIVE_RECHECK_SECONDS)
+            num_trades = archiver.archive_trades(end)
+            num_snapshots = archiver.archive_order_book_snapshots(end)
+            logger.info("Archived %s: %d trades and %d order book snapshots.", symbol, num_trades, num_snapshots)
+    finally:
+        mongo_client.close()
@@ -0,0 +1,478 @@
+from __future__ import absolute_import
+
+import sys
+import asyncio
+
+from datetime import datetime
+
+import pymongo
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from bson.errors import InvalidDocument
+from bson.objectid import ObjectId
+import motor.motor_asyncio
+import redis.asyncio
+
+from bitmex_watcher.models import TradesCursor, trade_from_dict
+from bitmex_watcher.mongo_writer import MongoWriter
+from bitmex_watcher.settings import settings
+from bitmex_watcher.snapshot_store import OrderBookSnapshotReader
+from bitmex_watcher.utils import log, constants
+from bitmex_watcher.watcher_server import MarketWatcher, TRADES_SORT, is_partitioned
+
+
+logger = log.setup_custom_logger('root')
+
+
+class AsyncMarketWatcher(MarketWatcher):
+    """
+    MarketWatcher on an asyncio event loop.
+    Captures, MongoDB writes (motor) and Redis publishes (redis.asyncio) run in their own tasks connected by queues,
+    so that a capture does not wait for the writes and the publishes of the previous one.
+    pybitmex keeps its websocket on its own thread; its updates wake up the event loop in the event capture mode.
+    """
+
+    def __init__(self, symbol=None, bitmex_client=None, mongo_client=None, redis_client=None, ws_dispatcher=None,
+                 loop=None):
+        if settings.SYMBOLS:
+            # A single symbol would be watched, the others silently not.
+            raise ValueError("SYMBOLS is not supported by the asyncio runtime. Set SYMBOL instead.")
+        self.loop = loop or asyncio.get_event_loop()
+
+        if mongo_client is None:
+            logger.info("Connecting to %s" % settings.MONGO_DB_URI)
+            mongo_client = motor.motor_asyncio.AsyncIOMotorClient(settings.MONGO_DB_URI)
+        if redis_client is None:
+            redis_client = redis.asyncio.StrictRedis(
+                host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+
+        # Writes and publishes requested by a capture. They are moved to the queues once the capture is done.
+        self.pending_writes = []
+        self.pending_publishes = []
+        # A full write queue holds back the next capture.
+        self.write_queue = asyncio.Queue(maxsize=settings.MONGO_WRITER_MAX_QUEUE_SIZE)
+        self.publish_queue = asyncio.Queue()
+        self.ws_updated = asyncio.Event()
+        # Waited for before the next capture, instead of in the capture.
+        self.is_market_closed = False
+        # Once a write of trades has failed, the trades cursor is no longer saved, so that it stays before them.
+        self.is_trades_write_failed = False
+
+        super(AsyncMarketWatcher, self).__init__(symbol, bitmex_client, mongo_client, redis_client, ws_dispatcher)
+
+        if settings.CAPTURE_MODE == 'event':
+            self.ws_dispatcher.add_waker(self._wake_up)
+        self.metrics.add_gauge('write_queue_depth', self.write_queue.qsize)
+        self.metrics.add_gauge('publish_queue_depth', self.publish_queue.qsize)
+
+    def _wake_up(self):
+        # Called on the websocket thread.
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.ws_updated.set)
+
+    def _initialize_db_scheme(self):
+        # Motor can only be used on the event loop. See initialize_db_scheme().
+        pass
+
+    def _create_indices(self):
+        # See initialize_db_scheme().
+        pass
+
+    @staticmethod
+    def _create_mongo_writer():
+        # The write task takes the place of MongoWriter.
+        return None
+
+    def _create_trades_backfiller(self):
+        logger.warning("TRADES_BACKFILL is not supported by the asyncio runtime. Gaps are only logged.")
+        return None
+
+    def _create_ws_reconnector(self):
+        # Connecting waits for the partials, which would block the event loop.
+        logger.warning("STALE_FEED_POLICY = \"reconnect\" is not supported by the asyncio runtime. "
+                       "The watcher exits on a stale feed instead.")
+        return None
+
+    def _create_leader_lease(self):
+        # Leading without the lease would save and publish alongside the leader.
+        raise ValueError("LEADER_ELECTION is not supported by the asyncio runtime.")
+
+    async def initialize_db_scheme(self):
+        for interval, retention_seconds in settings.TRADES_ROLLUPS:
+            await self.trades_rollup_collections[interval].create_index(
+                [("timestamp", pymongo.ASCENDING)], unique=True, expireAfterSeconds=retention_seconds)
+        if is_partitioned():
+            logger.info("MongoDB partitions are initialized as they start.")
+            return
+
+        collections = await self.bitmex_db.list_collection_names()
+        if (self.trades_collection_name in collections) and (self.order_book_snapshots_collection_name in collections):
+            logger.info("MongoDB scheme is already initialized. Do nothing.")
+        else:
+            logger.info("INITIALIZING MongoDB scheme.")
+            await self.bitmex_db.create_collection(self.trades_collection_name,
+                                                   capped=True, size=settings.MAX_TRADES_COLLECTION_BYTES)
+            await self.trades_collection.create_index([("timestamp", pymongo.ASCENDING)])
+
+            await self.bitmex_db.create_collection(self.order_book_snapshots_collection_name,
+                                                   capped=True, size=settings.MAX_ORDER_BOOK_COLLECTION_BYTES)
+            await self.order_book_snapshot_collection.create_index([("timestamp", pymongo.ASCENDING)])
+            logger.info("INITIALIZED MongoDB scheme.")
+
+        await AsyncMarketWatcher.create_trades_indices(self.trades_collection)
+        if self.order_book_snapshot_encoder is not None:
+            await OrderBookSnapshotReader.create_indices(self.order_book_snapshot_collection)
+
+    @staticmethod
+    async def create_trades_indices(collection):
+        try:
+            await collection.create_index([("trdMatchID", pymongo.ASCENDING)], unique=True)
+        except PyMongoError as e:
+            logger.warning("Unable to create the unique index of trdMatchID: %s", e)
+
+    async def drop_expired_partitions(self, partitioned_collection):
+        if settings.PARTITION_RETENTION_DAYS <= 0:
+            return
+        now = datetime.now().astimezone(constants.TIMEZONE)
+        names = partitioned_collection.expired_partition_names(
+            await self.bitmex_db.list_collection_names(), now, MarketWatcher.partition_retention_seconds())
+        for name in names:
+            await self.bitmex_db.drop_collection(name)
+            partitioned_collection.partitions.pop(name, None)
+        if 0 < len(names):
+            logger.info("Expired partitions are dropped: %s", names)
+
+    async def load_trades_cursor(self):
+        data = await self.trades_cursor_collection.find_one()
+        if data is None:
+            logger.info("Trades cursor is NOT loaded.")
+            return None
+        else:
+            result = TradesCursor(data['timestamp'], data['trdMatchID'])
+            logger.info("Trades cursor is loaded: %s", str(result))
+            return result
+
+    async def load_trades_rollups(self):
+        if self.trades_rollups is None:
+            return
+        documents = {}
+        for interval, collection in self.trades_rollup_collections.items():
+            documents[interval] = await collection.find_one(sort=[("timestamp", pymongo.DESCENDING)])
+        self.trades_rollups.seed(documents)
+        logger.info("Trades rollups are loaded: %s", str(self.trades_rollups.cursor))
+
+    async def load_trade_windows(self):
+        if self.trade_windows is None:
+            return
+        query = self.trade_windows_query()
+        if self.partitioned_trades is None:
+            documents = await self.trades_collection.find(query).sort(TRADES_SORT).to_list(None)
+        else:
+            documents = []
+            now = datetime.now().astimezone(constants.TIMEZONE)
+            for collection in self.partitioned_trades.partitions_between(query["timestamp"]["$gt"], now):
+                documents.extend(await collection.find(query).sort(TRADES_SORT).to_list(None))
+        self.trade_windows.add([trade_from_dict(each) for each in documents])
+        logger.info("Trade windows are loaded: %s", str(self.trade_windows.cursor))
+
+    ###
+    # Called by capture_once(). They only queue the work.
+    ##
+
+    def initialize_trades_partition(self, collection):
+        # Queued ahead of the first write to the partition.
+        self.pending_writes.append((self.create_trades_partition, collection))
+
+    def initialize_order_book_snapshots_partition(self, collection):
+        self.pending_writes.append((self.create_order_book_snapshots_partition, collection))
+
+    def save_trades(self, new_trades, trades_cursor):
+        for each in self.split_trades([t.to_dict() for t in new_trades]):
+            self.pending_writes.append((self.insert_trades, each))
+        logger.log(self.loop_log_level, "%d trades queued. The last: %s", len(new_trades), trades_cursor)
+        # The cursor follows the trades it covers.
+        self.checkpoint_trades_cursor(trades_cursor)
+
+    def save_trades_rollups(self, changed_buckets):
+        for interval, buckets in changed_buckets.items():
+            if 0 < len(buckets):
+                operations = [ReplaceOne({"timestamp": b.timestamp}, b.to_dict(), upsert=True) for b in buckets]
+                self.pending_writes.append((self.write_trades_rollups, (interval, operations)))
+
+    def save_trades_cursor(self, cursor):
+        if cursor is None:
+            return
+        self.pending_writes.append((self.replace_trades_cursor, cursor.to_dict()))
+        self.saved_trades_cursor = cursor
+
+    def save_and_publish_order_book_snapshot(self, document, stream_entry=None):
+        # The id is published as soon as the snapshot is written.
+        order_book_snapshot_id = str(document.setdefault('_id', ObjectId()))
+        collection = self.order_book_snapshot_collection_for(document['timestamp'])
+        self.pending_writes.append((self.insert_order_book_snapshot, (collection, document, stream_entry)))
+        logger.log(self.loop_log_level, "A new order book snapshot is queued: %s", order_book_snapshot_id)
+
+    def publish_order_book_snapshot_id(self, order_book_snapshot_id, stream_entry=None):
+        self.pending_publishes.append((self.publish_id, (order_book_snapshot_id, stream_entry)))
+
+    def publish_order_book_snapshot_payload(self, payload):
+        self.pending_publishes.append((self.publish_payload, payload))
+
+    def publish_trade_stats(self, trade_stats):
+        self.pending_publishes.append((self.publish_stats, trade_stats))
+
+    def publish_trades_payload(self, payload):
+        self.pending_publishes.append((self.publish_trades, payload))
+
+    def publish_heartbeat(self, is_order_book_changed):
+        if self.stream_publisher is not None:
+            self.pending_publishes.append((self.set_heartbeat, None))
+        else:
+            super(AsyncMarketWatcher, self).publish_heartbeat(is_order_book_changed)
+
+    def publish_metrics(self, metrics_json):
+        self.pending_publishes.append((self.set_metrics, metrics_json))
+
+    ###
+    # Run by the write task.
+    ##
+
+    async def create_trades_partition(self, collection):
+        await collection.create_index([("timestamp", pymongo.ASCENDING)])
+        await AsyncMarketWatcher.create_trades_indices(collection)
+        await self.drop_expired_partitions(self.partitioned_trades)
+
+    async def create_order_book_snapshots_partition(self, collection):
+        await collection.create_index([("timestamp", pymongo.ASCENDING)])
+        if self.order_book_snapshot_encoder is not None:
+            await OrderBookSnapshotReader.create_indices(collection)
+        await self.drop_expired_partitions(self.partitioned_order_book_snapshots)
+
+    async def insert_trades(self, collection_and_documents):
+        collection, documents = collection_and_documents
+        with self.metrics.time('mongo_trade_insert'):
+            try:
+                num_inserted = len((await collection.insert_many(documents, ordered=False)).inserted_ids)
+            except BulkWriteError as e:
+                num_inserted = MarketWatcher.count_inserted_ignoring_duplicates(e)
+        logger.log(self.loop_log_level, "%d trades inserted.", num_inserted)
+
+    async def write_trades_rollups(self, interval_and_operations):
+        interval, operations = interval_and_operations
+        await self.trades_rollup_collections[interval].bulk_write(operations, ordered=False)
+
+    async def replace_trades_cursor(self, document):
+        if self.is_trades_write_failed:
+            logger.warning("Trades cursor is NOT saved after a failed write of trades: %s", str(document))
+            return
+        # A single atomic upsert. There is always exactly one cursor.
+        await self.trades_cursor_collection.replace_one({}, document, upsert=True)
+        logger.debug("Trades cursor is saved: %s", str(document))
+
+    async def insert_order_book_snapshot(self, collection_document_and_stream_entry):
+        collection, document, stream_entry = collection_document_and_stream_entry
+        with self.metrics.time('snapshot_insert'):
+            await collection.insert_one(document)
+        order_book_snapshot_id = str(document['_id'])
+        logger.log(self.loop_log_level, "A new order book snapshot is inserted: %s", order_book_snapshot_id)
+        self.publish_queue.put_nowait((self.publish_id, (order_book_snapshot_id, stream_entry)))
+
+    ###
+    # Run by the publish task.
+    ##
+
+    async def publish_id(self, id_and_stream_entry):
+        order_book_snapshot_id, stream_entry = id_and_stream_entry
+        with self.metrics.time('redis_publish'):
+            if self.stream_publisher is not None:
+                await self.stream_publisher.add_order_book_snapshot(self.redis, stream_entry)
+            else:
+                await self.redis.publish(self.order_book_snapshot_id_channel_name, order_book_snapshot_id)
+        self.metrics.count('redis_publishes')
+        if order_book_snapshot_id != '*':
+            self.observe_order_book_lag()
+        logger.log(self.loop_log_level, "Published to redis: %s", order_book_snapshot_id)
+
+    async def publish_payload(self, payload):
+        # The latest payload is also kept in a key for subscribers which have just started. One round trip.
+        with self.metrics.time('redis_publish'):
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.set(self.order_book_snapshot_channel_name, payload)
+            pipeline.publish(self.order_book_snapshot_channel_name, payload)
+            await pipeline.execute()
+        self.metrics.count('redis_publishes')
+        logger.log(self.loop_log_level, "Published the payload to redis [%s]: %d bytes",
+                   self.order_book_snapshot_channel_name, len(payload))
+
+    async def publish_stats(self, trade_stats):
+        with self.metrics.time('redis_publish'):
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.set(self.trade_stats_channel_name, trade_stats)
+            pipeline.publish(self.trade_stats_channel_name, trade_stats)
+            await pipeline.execute()
+        self.metrics.count('redis_publishes')
+
+    async def publish_trades(self, payload):
+        with self.metrics.time('redis_publish'):
+            if self.stream_publisher is not None:
+                await self.stream_publisher.add_trades(self.redis, payload)
+            else:
+                await self.redis.publish(self.trades_channel_name, payload)
+        self.metrics.count('redis_publishes')
+        logger.log(self.loop_log_level, "Published the trades to redis: %d bytes", len(payload))
+
+    async def set_heartbeat(self, _):
+        await self.stream_publisher.set_heartbeat(self.redis)
+
+    async def set_metrics(self, metrics_json):
+        await self.redis.set(self.metrics_key_name, metrics_json)
+
+    ###
+    # Tasks.
+    ##
+
+    async def flush_pending(self):
+        writes, self.pending_writes = self.pending_writes, []
+        for each in writes:
+            await self.write_queue.put(each)
+        publishes, self.pending_publishes = self.pending_publishes, []
+        for each in publishes:
+            self.publish_queue.put_nowait(each)
+
+    def wait_while_market_closed(self):
+        self.is_market_closed = True
+
+    async def wait_for_next_capture(self):
+        if self.is_market_closed:
+            self.is_market_closed = False
+            await asyncio.sleep(MarketWatcher.MARKET_CLOSED_WAIT_SECONDS)
+        if settings.CAPTURE_MODE != 'event':
+            await asyncio.sleep(settings.LOOP_INTERVAL)
+            return
+        # Wake up as soon as the websocket delivers an update,
+        # or after LOOP_INTERVAL at the latest so that idle feeds are still detected.
+        try:
+            await asyncio.wait_for(self.ws_updated.wait(), settings.LOOP_INTERVAL)
+            # Updates landing within the minimum publish interval are coalesced into one capture.
+            remaining_seconds = settings.MIN_PUBLISH_INTERVAL - (self.clock() - self.last_capture_time)
+            if 0 < remaining_seconds:
+                await asyncio.sleep(remaining_seconds)
+        except asyncio.TimeoutError:
+            pass
+        self.ws_updated.clear()
+
+    async def capture_loop(self):
+        try:
+            while self.capture_once():
+                await self.flush_pending()
+                await self.wait_for_next_capture()
+        finally:
+            await self.flush_pending()
+
+    async def write(self, write, argument):
+        """
+        Retries errors of the connection as MongoWriter does. A write which fails otherwise is given up.
+        """
+        num_retries = 0
+        while True:
+            try:
+                await write(argument)
+                return
+            except MongoWriter.RETRYABLE_ERRORS as e:
+                if MongoWriter.MAX_RETRIES <= num_retries:
+                    logger.error("Gave up %s: %s", write.__name__, e)
+                    break
+                num_retries += 1
+                logger.warning("Retrying %s (%d): %s", write.__name__, num_retries, e)
+                await asyncio.sleep(min(0.1 * (2 ** num_retries), MongoWriter.MAX_RETRY_INTERVAL_SECONDS))
+            except (PyMongoError, InvalidDocument) as e:
+                logger.error("Failed %s: %s", write.__name__, e)
+                break
+        if write == self.insert_trades:
+            self.is_trades_write_failed = True
+
+    async def write_loop(self):
+        while True:
+            write, argument = await self.write_queue.get()
+            try:
+                await self.write(write, argument)
+            finally:
+                self.write_queue.task_done()
+
+    async def publish_loop(self):
+        while True:
+            publish, argument = await self.publish_queue.get()
+            try:
+                await publish(argument)
+            except redis.exceptions.RedisError as e:
+                # Subscribers miss this one. The next capture publishes again.
+                logger.error("Failed %s: %s", publish.__name__, e)
+            finally:
+                self.publish_queue.task_done()
+
+    async def join_queues(self):
+        # Written snapshots are published afterwards.
+        await self.write_queue.join()
+        await self.publish_queue.join()
+
+    @staticmethod
+    async def wait_unless_failed(task, workers):
+        """
+        Waits for the task to finish. If any of the workers (which never return) fails first,
+        the task is cancelled and the error of the worker is raised.
+        """
+        done, _ = await asyncio.wait([task] + workers, return_when=asyncio.FIRST_COMPLETED)
+        if task not in done:
+            task.cancel()
+            await asyncio.wait([task])
+        for each in done:
+            each.result()
+
+    async def run_loop(self):
+        try:
+            await self.initialize_db_scheme()
+            self.trades_cursor = await self.load_trades_cursor()
+            await self.load_trades_rollups()
+            await self.load_trade_windows()
+            workers = [asyncio.ensure_future(self.write_loop()), asyncio.ensure_future(self.publish_loop())]
+            try:
+                await AsyncMarketWatcher.wait_unless_failed(asyncio.ensure_future(self.capture_loop()), workers)
+            finally:
+                if not any(w.done() for w in workers):
+                    # The last cursor may have been skipped by the throttling.
+                    self.checkpoint_trades_cursor(self.trades_cursor, force=True)
+                    await self.flush_pending()
+                    await AsyncMarketWatcher.wait_unless_failed(asyncio.ensure_future(self.join_queues()), workers)
+                for w in workers:
+                    w.cancel()
+        except Exception as e:
+            import traceback
+            traceback.print_exc(file=sys.stdout)
+
+            logger.info("Error: %s" % str(e))
+            logger.info(sys.exc_info())
+            raise e
+        finally:
+            await self.close()
+
+    async def close(self):
+        """
+        Shuts down like exit(), without exiting the process from the event loop, and closes the Redis client too.
+        """
+        if not self.is_running:
+            return
+        self.shut_down()
+        if not self.owns_clients:
+            return
+        try:
+            # aclose() is in redis 5.0.1+.
+            await getattr(self.redis, 'aclose', self.redis.close)()
+        except Exception as e:
+            logger.info("Unable to close Redis client: %s" % e)
+
+
+def start():
+    loop = asyncio.get_event_loop()
+    watcher = AsyncMarketWatcher(loop=loop)
+    loop.run_until_complete(watcher.run_loop())
+    sys.exit()
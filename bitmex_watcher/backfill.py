@@ -0,0 +1,146 @@
+import queue
+import threading
+
+from time import monotonic
+
+from pybitmex.rest import RestClient
+
+from bitmex_watcher.trade_stream import to_trade_object
+from bitmex_watcher.ws_events import to_bitmex_timestamp
+from bitmex_watcher.utils import log
+
+
+logger = log.setup_custom_logger('root')
+
+
+def create_rest_client(base_url, symbol):
+    return RestClient(base_url, symbol=symbol, agent_name='bitmex_watcher')
+
+
+###
+# Fetches the trades of gaps in the websocket feed from the REST API (GET /trade) and saves them,
+# on a background thread so that captures never wait for it.
+#
+# A gap is the trades after a cursor and before another one, the first trade of the websocket after the gap.
+# They are fetched in pages of page_size trades, a request every request_interval seconds at most,
+# to stay within the rate limit of the API.
+# Trades saved already are ignored as duplicates by save(trades).
+##
+class TradesBackfiller:
+
+    def __init__(self, rest_client, symbol, save, page_size, request_interval, max_gaps=100):
+        self.rest_client = rest_client
+        self.symbol = symbol
+        self.save = save
+        self.page_size = page_size
+        self.request_interval = request_interval
+        self.gaps = queue.Queue(max_gaps)
+        self.num_requests = 0
+        self.num_trades = 0
+        self.num_failures = 0
+        self.last_request_time = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='trades-backfiller-' + symbol)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=10.0):
+        """
+        Stops after the request in progress. Gaps left in the queue are not backfilled.
+        """
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        if not self.gaps.empty():
+            logger.warning("%d trade gaps of %s are left without backfill.", self.gaps.qsize(), self.symbol)
+        self.rest_client.close()
+
+    def request(self, after_cursor, before_cursor):
+        """
+        Queues a gap. Called on the capture thread; never blocks.
+        """
+        try:
+            self.gaps.put_nowait((after_cursor, before_cursor))
+        except queue.Full:
+            logger.error("Too many trade gaps of %s to backfill. Dropped: after %s before %s",
+                         self.symbol, after_cursor, before_cursor)
+
+    def queue_depth(self):
+        return self.gaps.qsize()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                after_cursor, before_cursor = self.gaps.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self.backfill(after_cursor, before_cursor)
+            except Exception as e:
+                self.num_failures += 1
+                logger.error("Unable to backfill trades of %s after %s: %s", self.symbol, after_cursor, e)
+
+    def _wait_for_turn(self, seconds=None):
+        """
+        Waits until the next request is allowed. Returns False if stopped meanwhile.
+        """
+        if seconds is None and self.last_request_time is not None:
+            seconds = self.request_interval - (monotonic() - self.last_request_time)
+        if seconds is not None and 0 < seconds and self._stopped.wait(seconds):
+            return False
+        self.last_request_time = monotonic()
+        return True
+
+    def fetch_page(self, start_time, end_time, offset):
+        """
+        Returns the raw trades between the times (both inclusive) in ascending order, skipping offset of them,
+        or None if rate limited.
+        pybitmex signs every request of RestClient.curl_bitmex(), so the public endpoint is requested on its session.
+        """
+        self.num_requests += 1
+        response = self.rest_client.session.get(self.rest_client.base_url + 'trade', params={
+            'symbol': self.symbol,
+            'startTime': to_bitmex_timestamp(start_time),
+            'endTime': to_bitmex_timestamp(end_time),
+            'start': offset,
+            'count': self.page_size,
+            'reverse': 'false'
+        }, timeout=self.rest_client.timeout)
+        if response.status_code == 429:
+            retry_seconds = float(response.headers.get('Retry-After', self.request_interval))
+            logger.warning("Backfill of %s is rate limited. Retrying in %.1f seconds.", self.symbol, retry_seconds)
+            self._wait_for_turn(retry_seconds)
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    @staticmethod
+    def is_between(after_cursor, before_cursor, trade):
+        return after_cursor.is_behind_of(trade) and not before_cursor.is_behind_of(trade) and\
+            trade.trd_match_id != before_cursor.trd_match_id
+
+    def backfill(self, after_cursor, before_cursor):
+        """
+        Fetches and saves the trades between the cursors, page by page. Returns the number of them.
+        """
+        logger.warning("Backfilling trades of %s after %s before %s.", self.symbol, after_cursor, before_cursor)
+        offset = 0
+        num_trades = 0
+        while self._wait_for_turn():
+            rows = self.fetch_page(after_cursor.timestamp, before_cursor.timestamp, offset)
+            if rows is None:
+                continue
+            offset += len(rows)
+            trades = [each for each in map(to_trade_object, rows)
+                      if TradesBackfiller.is_between(after_cursor, before_cursor, each)]
+            if 0 < len(trades):
+                self.save(trades)
+                num_trades += len(trades)
+            if len(rows) < self.page_size:
+                break
+        self.num_trades += num_trades
+        logger.warning("%d trades of %s are backfilled after %s.", num_trades, self.symbol, after_cursor)
+        return num_trades
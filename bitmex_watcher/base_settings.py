@@ -23,12 +23,149 @@ ORDER_BOOK_SNAPSHOTS_COLLECTION = "order_book_snapshots"
 MAX_TRADES_COLLECTION_BYTES = 100000000
 MAX_ORDER_BOOK_COLLECTION_BYTES = 100000000
 
+# "none": Keeps trades and order book snapshots in capped collections of the sizes above. Old data silently falls off.
+# "day" or "hour": Keeps them in a collection per day or hour in UTC ("trades_20190413", "trades_2019041312", ...),
+#                  and drops the partitions older than PARTITION_RETENTION_DAYS (never if 0) as new ones start.
+#                  Range queries only read the partitions overlapping the range. See partitions.py.
+STORAGE_PARTITIONING = "none"
+PARTITION_RETENTION_DAYS = 90
+
+# Parquet archive of the trades and order book snapshots, written by archive.start() (e.g. run from cron).
+# Files are partitioned by symbol and date in UTC: "<ARCHIVE_DIR>/trades/symbol=XBTUSD/date=2019-04-13/part-*.parquet".
+# Every run continues from the checkpoint of the last one, and stops ARCHIVE_LAG_SECONDS before now,
+# so that trades still being written are archived by the next run. Use ArchiveReader to load them.
+ARCHIVE_DIR = "archive"
+ARCHIVE_COMPRESSION = "snappy"
+ARCHIVE_MAX_ROWS_PER_FILE = 100000
+ARCHIVE_LAG_SECONDS = 60
+# The checkpoint is by timestamp, so trades saved after it has passed them (backfilled ones, or writes retried for
+# longer than ARCHIVE_LAG_SECONDS) are behind it. Every run archives those up to ARCHIVE_RECHECK_SECONDS behind it,
+# comparing that many seconds of MongoDB with the archive. Later ones are never archived. 0 to disable.
+ARCHIVE_RECHECK_SECONDS = 3600
+
+# Every websocket message is appended to WS_RECORD_PATH (suffixed with the symbol when SYMBOLS are watched)
+# as a JSON line with the time it was received. Empty to disable.
+# replay.start() runs the watcher through the messages recorded in REPLAY_PATH, on the recorded clock
+# and with in-memory MongoDB and Redis, and logs how fast it went. REPLAY_SPEED is the ratio to the recorded speed
+# (1.0 for real time), or None to replay as fast as possible. Captures follow CAPTURE_MODE and LOOP_INTERVAL
+# (or MIN_PUBLISH_INTERVAL) of the recorded time, so that any settings can be backtested on the same messages.
+WS_RECORD_PATH = ""
+REPLAY_PATH = ""
+REPLAY_SPEED = None
+
+# benchmark.start() times the hot paths of the capture (OrderBookSnapshot, filter_new_trades, capture_once, ...)
+# on synthetic books and trade bursts, and writes throughput, latency percentiles and allocations
+# to BENCHMARK_RESULT_PATH as JSON. A result of another commit at BENCHMARK_BASELINE_PATH is compared with.
+# Empty to skip.
+BENCHMARK_RESULT_PATH = ""
+BENCHMARK_BASELINE_PATH = ""
+
+# Rollups of trades (OHLCV, buy/sell volume, mean and variance of prices) maintained as trades arrive,
+# as a list of (interval seconds, retention seconds), e.g. [(1, 86400), (60, 2592000), (300, 15552000)].
+# Each interval has its own collection ("trades_rollup_1s", "trades_rollup_1m", ...),
+# and every interval must divide the longer ones. Use TradesRollupReader to query them. Empty to disable.
+TRADES_ROLLUP_COLLECTION = "trades_rollup"
+TRADES_ROLLUPS = []
+
+# Lengths in seconds of sliding windows (e.g. [60, 300, 1800]) over which volume, momentum, VWAP,
+# mean and SD of prices, min and max are kept in memory as trades arrive. Empty to disable.
+# The current values of all the windows are published with each order book snapshot:
+# set to the key REDIS_TRADE_STATS_CHANNEL_NAME and published on the channel of the same name before the snapshot,
+# or in the "tradeStats" field of the stream entry of the snapshot.
+TRADE_WINDOWS = []
+
+# "full": Saves every order book snapshot as a whole.
+# "delta": Saves a whole snapshot (keyframe) every KEYFRAME_INTERVAL_SNAPSHOTS snapshots or KEYFRAME_INTERVAL_SECONDS,
+#          and only the changed levels in between. Use OrderBookSnapshotReader to load them.
+ORDER_BOOK_STORAGE_MODE = "full"
+KEYFRAME_INTERVAL_SNAPSHOTS = 100
+KEYFRAME_INTERVAL_SECONDS = 60
+
+# "document": Saves the levels as {"price": ..., "size": ...} objects.
+# "binary": Saves the snapshot in the binary wire format (see models.py). Only for ORDER_BOOK_STORAGE_MODE = "full".
+#           OrderBookSnapshotReader decodes them. A snapshot which does not fit in the format (a price of more
+#           ticks than fit in 32 bits) is saved as a "document" instead.
+ORDER_BOOK_STORAGE_FORMAT = "document"
+
+# "sync": Writes to MongoDB in the capture loop.
+# "async": Queues writes to a background thread, which writes them in unordered bulk writes
+#          of up to MONGO_WRITER_FLUSH_SIZE operations or every MONGO_WRITER_FLUSH_INTERVAL seconds.
+#          Snapshot ids are published as soon as the snapshots are written.
+MONGO_WRITE_MODE = "sync"
+MONGO_WRITER_MAX_QUEUE_SIZE = 100000
+MONGO_WRITER_FLUSH_SIZE = 1000
+MONGO_WRITER_FLUSH_INTERVAL = 0.05
+# When the queue is full: "block" (the capture loop waits), "drop_newest" or "drop_oldest".
+# Dropped trades are lost, and a dropped delta of ORDER_BOOK_STORAGE_MODE = "delta" breaks the snapshots
+# after it until the next keyframe. Tasks (new partitions, rollups of backfilled trades) are never dropped,
+# so queuing them still waits while the queue is full.
+MONGO_WRITER_OVERFLOW_POLICY = "block"
+
+# The trades cursor is saved every N batches of new trades or every T seconds, whichever comes first.
+# Trades are unique by trdMatchID, so the trades after the last saved cursor are safely saved again on restart.
+TRADES_CURSOR_CHECKPOINT_BATCHES = 1
+TRADES_CURSOR_CHECKPOINT_SECONDS = 10.0
+
 REDIS_HOST = "redis"
 REDIS_PORT = 6379
 REDIS_DB = 0
 
 REDIS_ORDER_BOOK_SNAPSHOT_ID_CHANNEL_NAME = 'from-watcher:order-book-snapshot-id'
 
+# "id": Publishes the ObjectId of each snapshot, which subscribers load from MongoDB.
+# "payload": Also publishes the summary and the top REDIS_PAYLOAD_DEPTH levels of each side as compact JSON
+#            on REDIS_ORDER_BOOK_SNAPSHOT_CHANNEL_NAME, and keeps the latest one in the key of the same name,
+#            so that subscribers need no database reads. It is published before the snapshot is written to MongoDB.
+REDIS_PUBLISH_MODE = "id"
+REDIS_PAYLOAD_DEPTH = 25
+REDIS_ORDER_BOOK_SNAPSHOT_CHANNEL_NAME = 'from-watcher:order-book-snapshot'
+# "json" or "binary" (the wire format in models.py) for the payload mode.
+# In "binary", new trades are also published on REDIS_TRADES_CHANNEL_NAME, in JSON if a trdMatchID is not a UUID.
+# Snapshots and trades which do not fit in the wire format are published in JSON.
+# Decode them with parse_order_book_message() and parse_trades_message() in models.py.
+REDIS_PAYLOAD_FORMAT = "json"
+REDIS_TRADES_CHANNEL_NAME = 'from-watcher:trades'
+REDIS_TRADE_STATS_CHANNEL_NAME = 'from-watcher:trade-stats'
+
+# "pubsub": Publishes on the channels above. Subscribers miss whatever is published while they are away.
+# "stream": Adds every snapshot (its id, summary, and payload in the payload mode) once it is written,
+#           and every batch of new trades, to Redis Streams trimmed to about REDIS_STREAM_MAX_LEN entries.
+#           Consumers resume from their last entry or use consumer groups. See redis_streams.py.
+#           Instead of '*' on unchanged order books, REDIS_HEARTBEAT_KEY_NAME is set every LOOP_INTERVAL,
+#           and expires if the watcher stops.
+REDIS_PUBLISHER = "pubsub"
+REDIS_STREAM_MAX_LEN = 10000
+REDIS_ORDER_BOOK_SNAPSHOT_STREAM_NAME = 'from-watcher:stream:order-book-snapshots'
+REDIS_TRADES_STREAM_NAME = 'from-watcher:stream:trades'
+REDIS_HEARTBEAT_KEY_NAME = 'from-watcher:heartbeat'
+
+# Timings of the stages of captures (histograms), lags from the exchange, counters and gauges (see metrics.py).
+# They are served in the Prometheus text format at http://<host>:METRICS_PORT/metrics (None to disable),
+# and set as JSON to the key REDIS_METRICS_KEY_NAME every LOOP_INTERVAL (empty to disable).
+METRICS_PORT = None
+REDIS_METRICS_KEY_NAME = ''
+
+# Runs two or more watchers of the same symbols (on different hosts) as a leader and standbys.
+# Only the watcher holding the lease in the key REDIS_LEADER_LEASE_KEY_NAME saves and publishes.
+# The standbys keep their websockets and books warm, and one of them takes over on its next capture
+# once the leader exits, or LEADER_LEASE_TTL_SECONDS after it stops renewing the lease.
+# The trades cursor is then saved on every batch of trades, so that the new leader continues where the last one stopped.
+# Not supported by the asyncio runtime, which refuses to start with it.
+LEADER_ELECTION = False
+REDIS_LEADER_LEASE_KEY_NAME = 'from-watcher:leader'
+LEADER_LEASE_TTL_SECONDS = 5.0
+
+# Order book snapshots are also written to a memory-mapped file of ORDER_BOOK_RING_SLOTS slots at this path
+# (suffixed with the symbol when many symbols are watched), in the binary wire format with the top
+# ORDER_BOOK_RING_DEPTH levels (all if None). Processes on the same host read the latest ones with SnapshotRingReader
+# (see snapshot_ring.py), without MongoDB or Redis. Use a tmpfs path such as "/dev/shm/bitmex_watcher_order_books".
+# Empty to disable.
+ORDER_BOOK_RING_PATH = ""
+ORDER_BOOK_RING_SLOTS = 1024
+# Snapshots larger than a slot are left out of the ring, with a warning.
+ORDER_BOOK_RING_SLOT_BYTES = 65536
+ORDER_BOOK_RING_DEPTH = None
+
 ########################################################################################################################
 # Target
 ########################################################################################################################
@@ -36,6 +173,13 @@ REDIS_ORDER_BOOK_SNAPSHOT_ID_CHANNEL_NAME = 'from-watcher:order-book-snapshot-id
 # Instrument to market make on BitMEX.
 SYMBOL = "XBTUSD"
 
+# To watch many instruments in one process, list them here (e.g. ["XBTUSD", "ETHUSD"]). SYMBOL is ignored then.
+# One websocket subscribes to all of them, and the names of collections and the Redis channel
+# are suffixed with the symbol: "trades_XBTUSD", "from-watcher:order-book-snapshot-id:XBTUSD", ...
+# Use TRADES_SOURCE = "stream". pybitmex keeps one recent trades table of 200 rows (trimmed to 100) for all the symbols,
+# so with "snapshot" the trades of busy symbols push those of quiet ones out between captures, leaving gaps.
+SYMBOLS = []
+
 ########################################################################################################################
 # Misc Behavior, Technicals
 ########################################################################################################################
@@ -43,15 +187,64 @@ SYMBOL = "XBTUSD"
 # Subscribing "orderBookL2_25" would be sufficient.
 TARGET_ORDER_BOOK_PRICE_RATIO = 0.005
 
+# "snapshot": Sorts and filters the whole order book table of the websocket on every capture.
+# "incremental": Maintains a sorted order book from orderBookL2(_25) deltas,
+#                so that a capture only reads the levels within TARGET_ORDER_BOOK_PRICE_RATIO.
+ORDER_BOOK_SOURCE = "snapshot"
+
+# "snapshot": Sorts the whole recent trades table of the websocket on every capture.
+# "stream": Only reads the trades appended to the table since the last capture.
+TRADES_SOURCE = "snapshot"
+
 ENABLE_SAMPLE_SUBSCRIBER = False
 
+# "polling": Captures the market every LOOP_INTERVAL seconds.
+# "event": Captures the market as soon as the websocket delivers an update,
+#          but not more often than every MIN_PUBLISH_INTERVAL seconds. Updates in between are coalesced.
+CAPTURE_MODE = "polling"
+MIN_PUBLISH_INTERVAL = 0.1
+
+# "thread": Captures, writes to MongoDB and publishes to Redis in blocking calls.
+# "asyncio": Runs on an asyncio event loop with motor and redis.asyncio, so that writing and publishing
+#            overlap with the next capture. MONGO_WRITE_MODE is ignored then. Only SYMBOL is watched;
+#            the watcher refuses to start with SYMBOLS.
+RUNTIME = "thread"
+
 LOOP_INTERVAL = 1.5
 MAX_ORDERS_IDLE_COUNT = 5
 MAX_TRADES_IDLE_COUNT = 25
 
+# What happens once the order book has not changed for MAX_ORDERS_IDLE_COUNT LOOP_INTERVALs,
+# or no trades have arrived for MAX_TRADES_IDLE_COUNT LOOP_INTERVALs.
+# "exit": The watcher stops, to be restarted (e.g. by Docker).
+# "reconnect": The websocket is replaced with a new one in the process if the feed has gone quiet on it,
+#              and the watcher catches up with its tables otherwise.
+#              The MongoDB and Redis clients and the state of the watcher are kept.
+#              Trades in the recent trades table of the new websocket after the cursor are saved.
+#              The watcher stops after MAX_RECONNECTS of them in a row without fresh data.
+#              Not supported by the asyncio runtime, which exits instead.
+STALE_FEED_POLICY = "exit"
+MAX_RECONNECTS = 3
+
+# Trades fetched from the websocket which start after the trades cursor leave a gap: the recent trades table
+# has rolled over between captures, the websocket has been reconnected, or the watcher has been stopped.
+# The trades in the gap are fetched from the REST API (GET /trade of BASE_URL) and saved on a background thread,
+# in pages of TRADES_BACKFILL_PAGE_SIZE trades and a request every TRADES_BACKFILL_REQUEST_INTERVAL seconds at most
+# (BitMEX allows 30 unauthenticated requests a minute). Only logged if disabled. Not supported by the asyncio runtime.
+# Backfilled trades are not added to the rollups or the windows, nor published.
+TRADES_BACKFILL = False
+TRADES_BACKFILL_PAGE_SIZE = 1000
+TRADES_BACKFILL_REQUEST_INTERVAL = 2.0
+
 # Available levels: logging.(DEBUG|INFO|WARN|ERROR)
 LOG_LEVEL = logging.INFO
 
+# "verbose": Logs what every capture does in INFO.
+# "production": Logs them in DEBUG, and a summary of the captures every LOG_SUMMARY_INTERVAL seconds in INFO instead.
+#               Records are formatted and written by a background thread, never on the capture loop.
+LOG_MODE = "verbose"
+LOG_SUMMARY_INTERVAL = 60
+
 # Logging to files is not recommended when you run this on Docker.
 # By leaving the name empty the program avoids to create log files.
 LOG_FILE_NAME = ''
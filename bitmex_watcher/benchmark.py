@@ -0,0 +1,261 @@
+import gc
+import json
+import logging
+import platform
+import random
+import subprocess
+import tracemalloc
+
+from time import perf_counter
+from datetime import datetime, timedelta, timezone
+
+from pybitmex import Trade
+
+from bitmex_watcher.memory_stores import InMemoryMongoClient, InMemoryRedis
+from bitmex_watcher.models import OrderBookSnapshot, TradesCursor
+from bitmex_watcher.replay import ReplayBitMEXClient, ReplayMarketWatcher, Replayer, messages_from_documents
+from bitmex_watcher.settings import settings
+from bitmex_watcher.utils import log, constants
+from bitmex_watcher.watcher_server import MarketWatcher
+
+
+logger = log.setup_custom_logger('root')
+
+TICK_SIZE = 0.5
+MID_PRICE = 5000.0
+
+# Levels per side: orderBookL2_25, and the full orderBookL2 of a quiet and a busy market.
+BOOK_LEVELS = [25, 1000, 5000]
+# Trades in the recent trades table of the websocket, and new ones since the last capture.
+TRADE_BURSTS = [(1000, 10), (1000, 200)]
+
+
+def synthetic_book(num_levels, mid_price=MID_PRICE, tick_size=TICK_SIZE, seed=0):
+    """
+    Returns (bids, asks) of num_levels each, a tick apart from each other, sorted from the best.
+    """
+    rand = random.Random(seed)
+    bids = [{"price": mid_price - tick_size * (i + 1), "size": rand.randint(1, 100000)} for i in range(num_levels)]
+    asks = [{"price": mid_price + tick_size * i, "size": rand.randint(1, 100000)} for i in range(num_levels)]
+    return bids, asks
+
+
+def synthetic_trades(num_trades, start, seed=0):
+    """
+    Returns trades sorted by (timestamp, trdMatchID), a few in each millisecond as in a burst.
+    """
+    rand = random.Random(seed)
+    return [Trade("{:08d}-0000-0000-0000-000000000000".format(i), start + timedelta(milliseconds=i // 3),
+                  rand.choice(["Buy", "Sell"]), MID_PRICE + TICK_SIZE * rand.randint(-10, 10), rand.randint(1, 10000))
+            for i in range(num_trades)]
+
+
+def percentile(sorted_values, ratio):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * ratio))]
+
+
+def measure(name, params, run, setup=None, min_seconds=0.5, min_iterations=10, max_iterations=100000):
+    """
+    Runs run(setup()) (or run() without setup) repeatedly, each call timed separately.
+    Returns a dict of throughput, latency percentiles in microseconds and allocations per call.
+    Only run() is measured; setup() prepares its argument, e.g. a changed book.
+    """
+    latencies = []
+    gc.collect()
+    gc.disable()
+    try:
+        total_start = perf_counter()
+        while len(latencies) < max_iterations and \
+                (len(latencies) < min_iterations or perf_counter() - total_start < min_seconds):
+            if setup is None:
+                start = perf_counter()
+                run()
+            else:
+                arg = setup()
+                start = perf_counter()
+                run(arg)
+            latencies.append(perf_counter() - start)
+    finally:
+        gc.enable()
+
+    # Allocations are traced on separate calls, because tracing slows them down.
+    # Tracing restarts for each call, so that its peak is of the call alone (tracemalloc.reset_peak() is 3.9+).
+    num_traced = min(len(latencies), 10)
+    peak_bytes = 0
+    retained_bytes = 0
+    for _ in range(num_traced):
+        arg = setup() if setup is not None else None
+        tracemalloc.start()
+        try:
+            before_bytes, _ = tracemalloc.get_traced_memory()
+            if setup is None:
+                run()
+            else:
+                run(arg)
+            after_bytes, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        peak_bytes += peak - before_bytes
+        retained_bytes += after_bytes - before_bytes
+
+    latencies.sort()
+    total_seconds = sum(latencies)
+    return {
+        'name': name,
+        'params': params,
+        'iterations': len(latencies),
+        'opsPerSecond': len(latencies) / total_seconds if 0 < total_seconds else 0.0,
+        'latencyMicros': {
+            'mean': total_seconds / len(latencies) * 1e6,
+            'p50': percentile(latencies, 0.5) * 1e6,
+            'p90': percentile(latencies, 0.9) * 1e6,
+            'p99': percentile(latencies, 0.99) * 1e6,
+            'max': latencies[-1] * 1e6
+        },
+        # Peak of the memory allocated while the calls run, and what they leave allocated.
+        'peakBytesPerOp': peak_bytes / num_traced,
+        'retainedBytesPerOp': retained_bytes / num_traced
+    }
+
+
+def bench_order_book_snapshot(num_levels, **kwargs):
+    bids, asks = synthetic_book(num_levels)
+    timestamp = datetime(2019, 4, 13, tzinfo=timezone.utc)
+    ratio = settings.TARGET_ORDER_BOOK_PRICE_RATIO
+    snapshot = OrderBookSnapshot(timestamp, bids, asks, ratio)
+    params = {'levels': num_levels, 'filteredLevels': len(snapshot.bids) + len(snapshot.asks)}
+    return [
+        measure('OrderBookSnapshot.__init__', params,
+                lambda: OrderBookSnapshot(timestamp, bids, asks, ratio), **kwargs),
+        measure('OrderBookSnapshot.digest_string', params, snapshot.digest_string, **kwargs),
+        measure('OrderBookSnapshot.to_dict', params, snapshot.to_dict, **kwargs)
+    ]
+
+
+def bench_trades(num_trades, num_new_trades, **kwargs):
+    trades = synthetic_trades(num_trades, datetime(2019, 4, 13, tzinfo=timezone.utc))
+    last_seen = trades[-num_new_trades - 1]
+    cursor = TradesCursor(last_seen.timestamp, last_seen.trd_match_id)
+    params = {'trades': num_trades, 'newTrades': num_new_trades}
+    return [
+        measure('MarketWatcher.filter_new_trades', params,
+                lambda: MarketWatcher.filter_new_trades(cursor, trades), **kwargs),
+        measure('TradesCursor.is_behind_of', params, lambda: cursor.is_behind_of(trades[-1]), **kwargs)
+    ]
+
+
+def bench_capture(num_levels, num_trades_per_capture=5, **kwargs):
+    """
+    Times MarketWatcher.capture_once() on a replayed full order book, with in-memory MongoDB and Redis.
+    A level changes and trades arrive between captures, so that every capture saves and publishes.
+    """
+    start = datetime(2019, 4, 13, tzinfo=timezone.utc)
+    bids, asks = synthetic_book(num_levels)
+    symbol = settings.SYMBOL
+    bitmex_client = ReplayBitMEXClient(symbol)
+    snapshot = {'timestamp': start, 'bids': bids, 'asks': asks}
+    replayer = Replayer(bitmex_client, messages_from_documents(symbol, TICK_SIZE, [], [snapshot], 'orderBookL2'), 1.0)
+    replayer.prime()
+    watcher = ReplayMarketWatcher(symbol, bitmex_client,
+                                  mongo_client=InMemoryMongoClient(), redis_client=InMemoryRedis())
+    watcher.load_state()
+    ws_client = bitmex_client.ws_client
+    state = {'count': 0, 'time': start}
+
+    def next_update():
+        state['count'] += 1
+        state['time'] += timedelta(seconds=settings.LOOP_INTERVAL)
+        best_bid = bids[0]
+        ws_client.feed(state['time'], {
+            'table': 'orderBookL2', 'action': 'update',
+            'data': [{'symbol': symbol, 'id': int(round(best_bid['price'] / TICK_SIZE)), 'side': 'Buy',
+                      'size': best_bid['size'] + state['count']}]})
+        ws_client.feed(state['time'], {'table': 'trade', 'action': 'insert', 'data': [
+            {'timestamp': state['time'].strftime("%Y-%m-%dT%H:%M:%S.%fZ"), 'symbol': symbol, 'side': 'Buy',
+             'size': 1, 'price': MID_PRICE, 'trdMatchID': "{:08d}-{:04d}".format(state['count'], i)}
+            for i in range(num_trades_per_capture)]})
+
+    try:
+        return [measure('MarketWatcher.capture_once', {'levels': num_levels, 'newTrades': num_trades_per_capture},
+                        lambda _: watcher.capture_once(), setup=next_update, **kwargs)]
+    finally:
+        watcher.exit()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_all(book_levels=None, trade_bursts=None, quiet=True, **kwargs):
+    """
+    Runs the benchmarks and returns their results in a JSON-serializable dict.
+    The log of the watcher is silenced unless quiet is False, so that it does not dominate the captures.
+    """
+    root_logger = logging.getLogger('root')
+    level = root_logger.level
+    if quiet:
+        root_logger.setLevel(logging.WARNING)
+    try:
+        results = []
+        for num_levels in book_levels or BOOK_LEVELS:
+            results += bench_order_book_snapshot(num_levels, **kwargs)
+        for num_trades, num_new_trades in trade_bursts or TRADE_BURSTS:
+            results += bench_trades(num_trades, num_new_trades, **kwargs)
+        for num_levels in book_levels or BOOK_LEVELS:
+            results += bench_capture(num_levels, **kwargs)
+    finally:
+        root_logger.setLevel(level)
+    return {
+        'version': constants.VERSION,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'results': results
+    }
+
+
+def result_key(result):
+    return result['name'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare(baseline, current):
+    """
+    Returns [(name, params, ratio of p50 latencies, ratio of throughputs), ...] of the benchmarks in both runs.
+    A latency ratio above 1.0 is a regression.
+    """
+    baseline_results = {result_key(r): r for r in baseline['results']}
+    comparisons = []
+    for result in current['results']:
+        old = baseline_results.get(result_key(result))
+        if old is None:
+            continue
+        comparisons.append((result['name'], result['params'],
+                            result['latencyMicros']['p50'] / old['latencyMicros']['p50'],
+                            result['opsPerSecond'] / old['opsPerSecond']))
+    return comparisons
+
+
+def start():
+    """
+    Runs the benchmarks, writes the results to BENCHMARK_RESULT_PATH as JSON (if set),
+    and logs them compared with BENCHMARK_BASELINE_PATH (if set), a result of an earlier commit.
+    """
+    report = run_all()
+    for result in report['results']:
+        logger.info("%-34s %-44s %12.1f ops/s  p50 %10.1fus  p99 %10.1fus  peak %10.0fB/op",
+                    result['name'], json.dumps(result['params']), result['opsPerSecond'],
+                    result['latencyMicros']['p50'], result['latencyMicros']['p99'], result['peakBytesPerOp'])
+    if settings.BENCHMARK_RESULT_PATH:
+        with open(settings.BENCHMARK_RESULT_PATH, 'w') as f:
+            json.dump(report, f, indent=2)
+    if settings.BENCHMARK_BASELINE_PATH:
+        with open(settings.BENCHMARK_BASELINE_PATH) as f:
+            baseline = json.load(f)
+        logger.info("Compared with %s:", baseline.get('commit'))
+        for name, params, latency_ratio, throughput_ratio in compare(baseline, report):
+            logger.info("%-34s %-44s p50 x%.2f  ops/s x%.2f", name, json.dumps(params), latency_ratio, throughput_ratio)
+    return report
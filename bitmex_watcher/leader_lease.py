@@ -0,0 +1,106 @@
+import os
+import uuid
+import socket
+
+from time import monotonic
+
+from bitmex_watcher.utils import log
+
+
+logger = log.setup_custom_logger('root')
+
+# Extends the lease only if this instance still holds it.
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+# Deletes the lease only if this instance holds it.
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def unique_instance_id(instance_name):
+    """
+    INSTANCE_NAME suffixed with the host, the process and a random part,
+    so that instances started with the same settings never take each other's lease.
+    """
+    return "{}:{}:{:d}:{}".format(instance_name, socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+###
+# A lease in a Redis key, which one of the watchers of a symbol holds at a time.
+# The holder is the leader, which saves and publishes. The others are standbys.
+#
+# The key is set with NX and a TTL. The leader extends the TTL every third of it,
+# and considers the lease lost once it has not been extended within the TTL, a little before Redis expires it,
+# so that two leaders never overlap. A standby tries to take the key on every capture,
+# and takes over as soon as the leader releases it (on exit) or it expires (on a crash).
+##
+class LeaderLease:
+
+    # The leader steps down this much earlier than the key expires, for the clocks of the hosts and round trips.
+    SAFETY_MARGIN_RATIO = 0.1
+
+    def __init__(self, redis_client, key_name, instance_id, ttl_seconds):
+        self.redis = redis_client
+        self.key_name = key_name
+        self.instance_id = instance_id
+        self.ttl_milliseconds = int(ttl_seconds * 1000)
+        self.ttl_seconds = ttl_seconds
+        self.is_leader = False
+        self.last_renewal_time = None
+
+    def hold(self):
+        """
+        Acquires or renews the lease as needed. Returns True while this instance is the leader.
+        """
+        now = monotonic()
+        if self.is_leader:
+            elapsed_seconds = now - self.last_renewal_time
+            if elapsed_seconds < self.ttl_seconds / 3.0:
+                return True
+            if elapsed_seconds < self.ttl_seconds * (1.0 - self.SAFETY_MARGIN_RATIO) and self._renew():
+                self.last_renewal_time = now
+                return True
+            logger.warning("Leader lease %s is lost by %s.", self.key_name, self.instance_id)
+            self.is_leader = False
+            return False
+        try:
+            is_acquired = self.redis.set(self.key_name, self.instance_id, nx=True, px=self.ttl_milliseconds)
+        except Exception as e:
+            # Tried again on the next capture.
+            logger.warning("Unable to acquire leader lease %s: %s", self.key_name, e)
+            return False
+        if is_acquired:
+            logger.warning("Leader lease %s is acquired by %s.", self.key_name, self.instance_id)
+            self.is_leader = True
+            self.last_renewal_time = now
+        return self.is_leader
+
+    def _renew(self):
+        try:
+            return bool(self.redis.eval(RENEW_SCRIPT, 1, self.key_name, self.instance_id, self.ttl_milliseconds))
+        except Exception as e:
+            # Retried on the next capture while the lease lasts.
+            logger.warning("Unable to renew leader lease %s: %s", self.key_name, e)
+            return False
+
+    def holder(self):
+        value = self.redis.get(self.key_name)
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def release(self):
+        """
+        Lets a standby take over at once, instead of when the lease expires.
+        """
+        if not self.is_leader:
+            return
+        self.is_leader = False
+        self.redis.eval(RELEASE_SCRIPT, 1, self.key_name, self.instance_id)
+        logger.info("Leader lease %s is released by %s.", self.key_name, self.instance_id)
@@ -0,0 +1,291 @@
+import threading
+
+from time import monotonic
+
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson.objectid import ObjectId
+
+from bitmex_watcher.leader_lease import RENEW_SCRIPT, RELEASE_SCRIPT
+from bitmex_watcher.mongo_writer import DUPLICATE_KEY_ERROR
+
+
+###
+# In-memory stand-ins of the parts of pymongo and redis-py the watcher uses, for replays and tests.
+# Queries support equality, $gt, $gte, $lt, $lte, $in and $or, which is all the watcher and the readers send.
+##
+
+_OPERATORS = {
+    '$gt': lambda value, operand: value is not None and operand < value,
+    '$gte': lambda value, operand: value is not None and operand <= value,
+    '$lt': lambda value, operand: value is not None and value < operand,
+    '$lte': lambda value, operand: value is not None and value <= operand,
+    '$in': lambda value, operand: value in operand
+}
+
+
+def matches(document, query):
+    for key, condition in (query or {}).items():
+        if key == '$or':
+            if not any(matches(document, each) for each in condition):
+                return False
+        elif isinstance(condition, dict) and all(k in _OPERATORS for k in condition):
+            value = document.get(key)
+            if not all(_OPERATORS[k](value, operand) for k, operand in condition.items()):
+                return False
+        elif document.get(key) != condition:
+            return False
+    return True
+
+
+def _sort_documents(documents, keys):
+    if isinstance(keys, str):
+        keys = [(keys, 1)]
+    # Sorted by the least significant key first, as sorts are stable.
+    for key, direction in reversed(keys):
+        documents = sorted(documents, key=lambda d: d[key], reverse=direction < 0)
+    return documents
+
+
+class InMemoryCursor(list):
+
+    def sort(self, key_or_list, direction=None):
+        keys = key_or_list if direction is None else [(key_or_list, direction)]
+        return InMemoryCursor(_sort_documents(self, keys))
+
+    def to_list(self, length=None):
+        return list(self) if length is None else list(self)[:length]
+
+
+class _InsertOneResult:
+
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+
+class _InsertManyResult:
+
+    def __init__(self, inserted_ids):
+        self.inserted_ids = inserted_ids
+
+
+class InMemoryCollection:
+
+    def __init__(self, database_name, name):
+        self.name = name
+        self.full_name = "{}.{}".format(database_name, name)
+        self.documents = []
+        self.indices = []
+        # Values of the fields of single-field unique indices.
+        self.unique_values = {}
+        self._lock = threading.Lock()
+
+    def create_index(self, keys, unique=False, **kwargs):
+        self.indices.append(keys)
+        if unique and len(keys) == 1 and keys[0][0] not in self.unique_values:
+            self.unique_values[keys[0][0]] = {d.get(keys[0][0]) for d in self.documents}
+        return '_'.join("{}_{}".format(k, d) for k, d in keys)
+
+    def _index(self, document, is_added):
+        for field, values in self.unique_values.items():
+            if is_added:
+                values.add(document.get(field))
+            else:
+                values.discard(document.get(field))
+
+    def _insert(self, document):
+        document.setdefault('_id', ObjectId())
+        if any(document.get(field) in values for field, values in self.unique_values.items()):
+            return False
+        self.documents.append(document)
+        self._index(document, True)
+        return True
+
+    def insert_one(self, document):
+        with self._lock:
+            if not self._insert(document):
+                raise DuplicateKeyError("E11000 duplicate key error", DUPLICATE_KEY_ERROR)
+        return _InsertOneResult(document['_id'])
+
+    def insert_many(self, documents, ordered=True):
+        inserted_ids = []
+        errors = []
+        with self._lock:
+            for index, document in enumerate(documents):
+                if self._insert(document):
+                    inserted_ids.append(document['_id'])
+                else:
+                    errors.append({'index': index, 'code': DUPLICATE_KEY_ERROR})
+                    if ordered:
+                        break
+        if 0 < len(errors):
+            raise BulkWriteError({'writeErrors': errors, 'nInserted': len(inserted_ids)})
+        return _InsertManyResult(inserted_ids)
+
+    def _replace(self, query, document, upsert):
+        for i, each in enumerate(self.documents):
+            if matches(each, query):
+                document = dict(document, _id=each['_id'])
+                self._index(each, False)
+                self.documents[i] = document
+                self._index(document, True)
+                return
+        if upsert:
+            self._insert(dict(document))
+
+    def replace_one(self, query, document, upsert=False):
+        with self._lock:
+            self._replace(query, document, upsert)
+
+    def bulk_write(self, requests, ordered=True):
+        # Reads the private attributes of the pymongo operations, which have no public getters.
+        errors = []
+        with self._lock:
+            for index, request in enumerate(requests):
+                if isinstance(request, InsertOne):
+                    if not self._insert(request._doc):
+                        errors.append({'index': index, 'code': DUPLICATE_KEY_ERROR})
+                elif isinstance(request, ReplaceOne):
+                    self._replace(request._filter, request._doc, request._upsert)
+                else:
+                    raise NotImplementedError("Unsupported operation: {}".format(type(request).__name__))
+        if 0 < len(errors):
+            raise BulkWriteError({'writeErrors': errors})
+
+    def find(self, query=None):
+        with self._lock:
+            return InMemoryCursor(d for d in self.documents if matches(d, query))
+
+    def find_one(self, query=None, sort=None):
+        documents = self.find(query)
+        if sort is not None:
+            documents = documents.sort(sort)
+        return documents[0] if 0 < len(documents) else None
+
+
+class InMemoryDatabase(dict):
+
+    def __init__(self, name):
+        super(InMemoryDatabase, self).__init__()
+        self.name = name
+
+    def __missing__(self, name):
+        self[name] = InMemoryCollection(self.name, name)
+        return self[name]
+
+    def list_collection_names(self):
+        return list(self.keys())
+
+    def create_collection(self, name, **kwargs):
+        return self[name]
+
+    def drop_collection(self, name):
+        self.pop(name, None)
+
+
+class InMemoryMongoClient(dict):
+
+    def __missing__(self, name):
+        self[name] = InMemoryDatabase(name)
+        return self[name]
+
+    def close(self):
+        pass
+
+
+class _InMemoryPipeline:
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((getattr(self.redis_client, name), args, kwargs))
+            return self
+        return command
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [method(*args, **kwargs) for method, args, kwargs in commands]
+
+
+class InMemoryRedis:
+    """
+    Keeps what is published in `messages` as (channel, message), and stream entries in `streams`.
+    The Lua scripts the watcher runs are emulated.
+    """
+
+    def __init__(self):
+        self.keys = {}
+        # Key to the monotonic time it expires at.
+        self.expiries = {}
+        self.messages = []
+        self.streams = {}
+        self.num_entries = 0
+        self._lock = threading.RLock()
+        self._scripts = {
+            RENEW_SCRIPT: lambda key, value, ttl: int(self.get(key) == value and self.pexpire(key, int(ttl))),
+            RELEASE_SCRIPT: lambda key, value: self.delete(key) if self.get(key) == value else 0
+        }
+
+    def pipeline(self, transaction=True):
+        return _InMemoryPipeline(self)
+
+    def publish(self, channel, message):
+        with self._lock:
+            self.messages.append((channel, message))
+        return 0
+
+    def _expire(self, name):
+        if name in self.expiries and self.expiries[name] <= monotonic():
+            del self.expiries[name]
+            del self.keys[name]
+
+    def set(self, name, value, px=None, nx=False):
+        with self._lock:
+            self._expire(name)
+            if nx and name in self.keys:
+                return None
+            self.keys[name] = value
+            self.expiries.pop(name, None)
+            if px is not None:
+                self.expiries[name] = monotonic() + px / 1000.0
+            return True
+
+    def get(self, name):
+        with self._lock:
+            self._expire(name)
+            return self.keys.get(name)
+
+    def exists(self, name):
+        with self._lock:
+            self._expire(name)
+            return int(name in self.keys)
+
+    def pexpire(self, name, milliseconds):
+        with self._lock:
+            self._expire(name)
+            if name not in self.keys:
+                return 0
+            self.expiries[name] = monotonic() + milliseconds / 1000.0
+            return 1
+
+    def delete(self, name):
+        with self._lock:
+            self._expire(name)
+            self.expiries.pop(name, None)
+            return int(self.keys.pop(name, None) is not None)
+
+    def eval(self, script, num_keys, *keys_and_args):
+        return self._scripts[script](*keys_and_args)
+
+    def xadd(self, name, fields, maxlen=None, approximate=True):
+        with self._lock:
+            entries = self.streams.setdefault(name, [])
+            self.num_entries += 1
+            entry_id = "{:d}-0".format(self.num_entries).encode()
+            entries.append((entry_id, fields))
+            if maxlen is not None and maxlen < len(entries):
+                del entries[:len(entries) - maxlen]
+            return entry_id
@@ -0,0 +1,292 @@
+import json
+import bisect
+import threading
+import collections
+
+from time import perf_counter, monotonic
+from socketserver import ThreadingMixIn
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+# Upper bounds of the buckets of stage timings in seconds, as Prometheus histograms have them.
+STAGE_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Lags from the exchange are much longer than stages.
+LAG_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Stages of a capture, timed separately.
+STAGES = (
+    'capture',              # The whole capture_once().
+    'ws_fetch_trades',      # Reading trades from the websocket tables (or the trade stream).
+    'trade_filter',         # Trades behind the cursor.
+    'mongo_trade_insert',   # Writing new trades to MongoDB.
+    'ws_fetch_order_book',  # Reading and sorting the levels from the websocket tables (or the incremental book).
+    'snapshot_build',       # OrderBookSnapshot from the levels.
+    'book_diff',            # Changes from the last snapshot, which replaced the digest.
+    'snapshot_insert',      # Writing the snapshot to MongoDB.
+    'redis_publish'         # Every publish to Redis.
+)
+LAGS = (
+    'trade_to_saved',       # From the exchange timestamp of the newest trade to when it is saved (and published).
+    'ws_to_publish'         # From the last websocket update of the order book to when its snapshot id is published.
+)
+COUNTERS = ('captures', 'trades', 'order_book_snapshots', 'redis_publishes', 'ws_reconnects',
+            'backfilled_trades')
+
+# Samples of the counters (one per LOOP_INTERVAL) kept to calculate the recent rates.
+RATE_SAMPLES = 40
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The last one is above the last bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket in which the quantile falls, or None without observations.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        accumulated = 0
+        for i, count in enumerate(self.counts):
+            accumulated += count
+            if rank <= accumulated:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99)
+        }
+
+
+class _Timer:
+
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, perf_counter() - self.start)
+
+
+###
+# Timings of the stages of captures, lags from the exchange, counters and gauges of a watcher.
+# Updating them costs about a microsecond, so they are always kept. They are exposed in the Prometheus text format
+# by MetricsServer, and as JSON by MarketWatcher.publish_metrics().
+#
+# Stages are timed on the capture thread and by the writers of MongoDB and Redis, so updates take a lock.
+##
+class WatcherMetrics:
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.stages = {name: Histogram(STAGE_BUCKETS) for name in STAGES}
+        self.lags = {name: Histogram(LAG_BUCKETS) for name in LAGS}
+        self.counters = {name: 0 for name in COUNTERS}
+        # Name to a callable returning the current value, e.g. idle counts and queue depths.
+        self.gauges = {}
+        self.start_time = monotonic()
+        self._samples = collections.deque(maxlen=RATE_SAMPLES)
+        self._lock = threading.Lock()
+
+    def time(self, stage):
+        """
+        with metrics.time('snapshot_insert'): ...
+        """
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            self.stages[stage].observe(seconds)
+
+    def observe_lag(self, name, seconds):
+        with self._lock:
+            self.lags[name].observe(seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def add_gauge(self, name, value_fn):
+        self.gauges[name] = value_fn
+
+    def sample(self):
+        """
+        Records the counters to calculate rates from. Called every LOOP_INTERVAL.
+        """
+        with self._lock:
+            self._samples.append((monotonic(), dict(self.counters)))
+
+    def rates(self):
+        """
+        Returns the counters per second over the recent samples.
+        """
+        with self._lock:
+            if len(self._samples) < 2:
+                return {name: 0.0 for name in COUNTERS}
+            (first_time, first), (last_time, last) = self._samples[0], self._samples[-1]
+        seconds = last_time - first_time
+        return {name: (last[name] - first[name]) / seconds if 0 < seconds else 0.0 for name in COUNTERS}
+
+    def summary_state(self):
+        """
+        Returns what summary_since() takes, to summarize what happens from now on.
+        """
+        with self._lock:
+            return dict(self.counters), _copy(self.stages['capture'])
+
+    @staticmethod
+    def summary_since(previous_state, state):
+        """
+        Returns the counters and the quantiles of capture timings between two summary_state()s.
+        """
+        (previous_counters, previous_captures), (counters, captures) = previous_state, state
+        histogram = Histogram(captures.buckets)
+        histogram.counts = [c - p for c, p in zip(captures.counts, previous_captures.counts)]
+        histogram.count = captures.count - previous_captures.count
+        histogram.sum = captures.sum - previous_captures.sum
+        result = {name: counters[name] - previous_counters[name] for name in COUNTERS}
+        result['captureP50'] = histogram.quantile(0.5) or 0.0
+        result['captureP99'] = histogram.quantile(0.99) or 0.0
+        return result
+
+    def gauge_values(self):
+        result = {}
+        for name, value_fn in self.gauges.items():
+            try:
+                result[name] = value_fn()
+            except Exception:
+                # A gauge of something being torn down.
+                result[name] = None
+        return result
+
+    def to_dict(self):
+        with self._lock:
+            stages = {name: h.to_dict() for name, h in self.stages.items()}
+            lags = {name: h.to_dict() for name, h in self.lags.items()}
+            counters = dict(self.counters)
+        return {
+            'symbol': self.symbol,
+            'uptimeSeconds': monotonic() - self.start_time,
+            'stages': stages,
+            'lags': lags,
+            'counters': counters,
+            'rates': self.rates(),
+            'gauges': self.gauge_values()
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), separators=(',', ':'))
+
+    def to_prometheus_lines(self):
+        label = 'symbol="{}"'.format(self.symbol)
+        lines = []
+        with self._lock:
+            histograms = [('bitmex_watcher_stage_seconds', 'stage', name, _copy(h)) for name, h in self.stages.items()]
+            histograms += [('bitmex_watcher_lag_seconds', 'lag', name, _copy(h)) for name, h in self.lags.items()]
+            counters = dict(self.counters)
+        for metric, key, name, histogram in histograms:
+            labels = '{},{}="{}"'.format(label, key, name)
+            accumulated = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                accumulated += count
+                lines.append('{}_bucket{{{},le="{}"}} {:d}'.format(metric, labels, bound, accumulated))
+            lines.append('{}_bucket{{{},le="+Inf"}} {:d}'.format(metric, labels, histogram.count))
+            lines.append('{}_sum{{{}}} {!r}'.format(metric, labels, histogram.sum))
+            lines.append('{}_count{{{}}} {:d}'.format(metric, labels, histogram.count))
+        for name, value in counters.items():
+            lines.append('bitmex_watcher_{}_total{{{}}} {:d}'.format(name, label, value))
+        for name, value in self.gauge_values().items():
+            if value is not None:
+                lines.append('bitmex_watcher_{}{{{}}} {!r}'.format(name, label, float(value)))
+        return lines
+
+
+def _copy(histogram):
+    result = Histogram(histogram.buckets)
+    result.counts = list(histogram.counts)
+    result.count = histogram.count
+    result.sum = histogram.sum
+    return result
+
+
+def to_prometheus_text(metrics_list):
+    """
+    Returns the Prometheus text format of the metrics of watchers, each metric typed once.
+    """
+    lines = [
+        '# TYPE bitmex_watcher_stage_seconds histogram',
+        '# TYPE bitmex_watcher_lag_seconds histogram'
+    ]
+    lines += ['# TYPE bitmex_watcher_{}_total counter'.format(name) for name in COUNTERS]
+    for metrics in metrics_list:
+        lines += metrics.to_prometheus_lines()
+    return '\n'.join(lines) + '\n'
+
+
+# http.server.ThreadingHTTPServer is only in Python 3.7+.
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+###
+# Serves GET /metrics in the Prometheus text format on a daemon thread.
+##
+class MetricsServer:
+
+    def __init__(self, port, metrics_list, host=''):
+        metrics_list = list(metrics_list)
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = to_prometheus_text(metrics_list).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes are not logged.
+                pass
+
+        self.server = _ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics-server")
+        self.thread.daemon = True
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,6 +1,13 @@
 from bitmex_watcher.utils import constants
 import math
+import json
+import uuid
+import struct
 import hashlib
+from datetime import datetime, timedelta
+
+from dateutil.parser import parse
+from pybitmex import Trade
 
 
 # Rounding float numbers.
@@ -9,6 +16,88 @@ def _round_float(v):
     return round(v, _num_digits)
 
 
+###
+# Binary wire format (little endian) of order book snapshots and trades.
+# Prices are in ticks of the instrument, so that they fit in int32.
+#
+# Order book snapshot: the header, sizes of bids and asks (int64), and then prices of bids and asks (int32).
+# The arrays stay aligned, so that they can be read without copying. See OrderBookArrays.from_bytes().
+# Trades: the header and fixed-width records.
+##
+WIRE_FORMAT_MAGIC = b'BW'
+WIRE_FORMAT_VERSION = 1
+WIRE_KIND_ORDER_BOOK = 1
+WIRE_KIND_TRADES = 2
+
+# magic, version, kind, snapshot id (ObjectId or zeros), tick size, timestamp (microseconds since the epoch),
+# midPrice, priceFromDepth, depthBias, bidsRatio, bidsVolume, asksVolume,
+# highestBid, lowestBid, lowestAsk, highestAsk (ticks), and the numbers of bids and asks.
+ORDER_BOOK_HEADER = struct.Struct('<2sBB12sdqddddqqiiiiII')
+# magic, version, kind, tick size, and the number of trades.
+TRADES_HEADER = struct.Struct('<2sBBdI')
+# trdMatchID (UUID), timestamp (microseconds since the epoch), side (0: Buy, 1: Sell), price (ticks), size.
+TRADE_RECORD = struct.Struct('<16sqBiq')
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=constants.TIMEZONE)
+_SIDES = ('Buy', 'Sell')
+
+
+def _to_micros(timestamp):
+    return (timestamp - _EPOCH) // timedelta(microseconds=1)
+
+
+def _from_micros(micros):
+    return _EPOCH + timedelta(microseconds=micros)
+
+
+def _to_ticks(price, tick_size):
+    return int(round(price / tick_size))
+
+
+def _from_ticks(ticks, tick_size):
+    # The nearest float to the decimal price, as BitMEX sends it.
+    return round(ticks * tick_size, 8)
+
+
+def _unpack_header(header_struct, data, kind):
+    fields = header_struct.unpack_from(data)
+    if fields[0] != WIRE_FORMAT_MAGIC or fields[2] != kind:
+        raise ValueError("Not encoded in the wire format of kind {:d}.".format(kind))
+    if fields[1] != WIRE_FORMAT_VERSION:
+        raise ValueError("Unsupported wire format version: {:d}".format(fields[1]))
+    return fields
+
+
+def read_order_book_header(data):
+    """
+    Returns the header of OrderBookSnapshot.to_bytes() as a dict.
+    """
+    (_, _, _, snapshot_id, tick_size, micros, mid_price, price_from_depth, depth_bias, bids_ratio,
+     bids_volume, asks_volume, highest_bid, lowest_bid, lowest_ask, highest_ask,
+     num_bids, num_asks) = _unpack_header(ORDER_BOOK_HEADER, data, WIRE_KIND_ORDER_BOOK)
+    return {
+        'id': snapshot_id.hex() if any(snapshot_id) else None,
+        'tickSize': tick_size,
+        'timestamp': _from_micros(micros),
+        'midPrice': mid_price,
+        'priceFromDepth': price_from_depth,
+        'depthBias': depth_bias,
+        'bidsRatio': bids_ratio,
+        'totalVolume': bids_volume + asks_volume,
+
+        'highestBid': _from_ticks(highest_bid, tick_size),
+        'lowestBid': _from_ticks(lowest_bid, tick_size),
+        'bidsVolume': bids_volume,
+
+        'lowestAsk': _from_ticks(lowest_ask, tick_size),
+        'highestAsk': _from_ticks(highest_ask, tick_size),
+        'asksVolume': asks_volume,
+
+        'numBids': num_bids,
+        'numAsks': num_asks
+    }
+
+
 ###
 # A snapshot of order books.
 ##
@@ -95,9 +184,9 @@ class OrderBookSnapshot:
             return logical_mid_price
 
     def __str__(self):
-        return str(self._to_summary_dict())
+        return str(self.to_summary_dict())
 
-    def _to_summary_dict(self):
+    def to_summary_dict(self):
         return {
             'timestamp': self.timestamp,
             'midPrice': self.mid_price,
@@ -112,21 +201,244 @@ class OrderBookSnapshot:
 
             'lowestAsk': self.lowest_ask,
             'highestAsk': self.highest_ask,
-            'asksVolume': self.asks_volume,
-
-            'bids': self.bids,
-            'asks': self.asks
+            'asksVolume': self.asks_volume
         }
 
     def to_dict(self):
-        result = self._to_summary_dict()
+        result = self.to_summary_dict()
         result.update({'bids': self.bids, 'asks': self.asks})
         return result
 
+    def to_payload(self, depth, order_book_snapshot_id=None):
+        """
+        Returns compact JSON of the summary and the top `depth` levels of each side,
+        which subscribers can use without reading the database. See parse_order_book_payload().
+        """
+        result = self.to_summary_dict()
+        result.update({
+            'id': order_book_snapshot_id,
+            'timestamp': self.timestamp.isoformat(),
+            'bids': self.bids[:depth],
+            'asks': self.asks[:depth]
+        })
+        return json.dumps(result, separators=(',', ':'))
+
+    def to_bytes(self, tick_size, depth=None, order_book_snapshot_id=None):
+        """
+        Encodes the snapshot in the binary wire format, with the top `depth` levels of each side (all if None).
+        The summary values are of the whole snapshot in any case.
+        """
+        bids = self.bids if depth is None else self.bids[:depth]
+        asks = self.asks if depth is None else self.asks[:depth]
+        try:
+            return self._pack(tick_size, bids, asks, order_book_snapshot_id)
+        except struct.error as e:
+            # E.g. a price of more ticks than fit in the fields.
+            raise ValueError("The order book snapshot does not fit in the wire format: {}".format(e))
+
+    def _pack(self, tick_size, bids, asks, order_book_snapshot_id):
+        header = ORDER_BOOK_HEADER.pack(
+            WIRE_FORMAT_MAGIC, WIRE_FORMAT_VERSION, WIRE_KIND_ORDER_BOOK,
+            bytes.fromhex(order_book_snapshot_id) if order_book_snapshot_id else bytes(12),
+            tick_size, _to_micros(self.timestamp),
+            self.mid_price, self.price_from_depth, self.depth_bias, self.bids_ratio,
+            self.bids_volume, self.asks_volume,
+            _to_ticks(self.highest_bid, tick_size), _to_ticks(self.lowest_bid, tick_size),
+            _to_ticks(self.lowest_ask, tick_size), _to_ticks(self.highest_ask, tick_size),
+            len(bids), len(asks))
+        num_levels = len(bids) + len(asks)
+        sizes = struct.pack('<{:d}q'.format(num_levels), *[int(each["size"]) for each in bids + asks])
+        ticks = struct.pack('<{:d}i'.format(num_levels), *[_to_ticks(each["price"], tick_size) for each in bids + asks])
+        return header + sizes + ticks
+
+    @staticmethod
+    def from_bytes(data):
+        """
+        Decodes to_bytes(). The summary values are not calculated again.
+        """
+        header = read_order_book_header(data)
+        num_bids = header['numBids']
+        num_levels = num_bids + header['numAsks']
+        offset = ORDER_BOOK_HEADER.size
+        sizes = struct.unpack_from('<{:d}q'.format(num_levels), data, offset)
+        ticks = struct.unpack_from('<{:d}i'.format(num_levels), data, offset + 8 * num_levels)
+        tick_size = header['tickSize']
+        levels = [{"price": _from_ticks(t, tick_size), "size": s} for t, s in zip(ticks, sizes)]
+
+        result = OrderBookSnapshot.__new__(OrderBookSnapshot)
+        result.timestamp = header['timestamp']
+        result.mid_price = header['midPrice']
+        result.bids = levels[:num_bids]
+        result.asks = levels[num_bids:]
+        result.highest_bid = header['highestBid']
+        result.lowest_bid = header['lowestBid']
+        result.lowest_ask = header['lowestAsk']
+        result.highest_ask = header['highestAsk']
+        result.bids_volume = header['bidsVolume']
+        result.asks_volume = header['asksVolume']
+        result.total_volume = header['totalVolume']
+        result.price_from_depth = header['priceFromDepth']
+        result.depth_bias = header['depthBias']
+        result.bids_ratio = header['bidsRatio']
+        return result
+
     def digest_string(self):
         document = str(self.bids) + str(self.asks)
         return hashlib.sha256(document.encode('utf-8')).hexdigest()
 
+    def is_same_book_as(self, other):
+        # List comparison stops at the first differing level.
+        return (other is not None) and (self.bids == other.bids) and (self.asks == other.asks)
+
+    def changes_from(self, previous):
+        """
+        Returns the levels that differ from the previous snapshot as OrderBookChanges.
+        Compared to digest_string(), this neither builds a large string nor hashes it.
+        """
+        if previous is None:
+            return OrderBookChanges(self.bids, self.asks)
+        if self.is_same_book_as(previous):
+            return OrderBookChanges([], [])
+        return OrderBookChanges(_diff_levels(previous.bids, self.bids), _diff_levels(previous.asks, self.asks))
+
+
+def parse_order_book_payload(payload):
+    """
+    Parses OrderBookSnapshot.to_payload() into a dict like OrderBookSnapshot.to_dict() (plus 'id').
+    """
+    result = json.loads(payload)
+    result['timestamp'] = parse(result['timestamp'])
+    return result
+
+
+def parse_order_book_bytes(data):
+    """
+    Parses OrderBookSnapshot.to_bytes() into a dict like OrderBookSnapshot.to_dict() (plus 'id').
+    """
+    result = OrderBookSnapshot.from_bytes(data).to_dict()
+    result['id'] = read_order_book_header(data)['id']
+    return result
+
+
+def parse_order_book_message(data):
+    """
+    Parses a payload of the binary wire format, or JSON for snapshots which it cannot encode.
+    """
+    if data[:len(WIRE_FORMAT_MAGIC)] == WIRE_FORMAT_MAGIC:
+        return parse_order_book_bytes(data)
+    return parse_order_book_payload(data)
+
+
+def trade_from_dict(document):
+    """
+    Returns a pybitmex Trade of a document saved in the trades collection.
+    """
+    timestamp = document['timestamp']
+    if timestamp.tzinfo is None:
+        # MongoDB returns naive datetimes in UTC.
+        timestamp = timestamp.replace(tzinfo=constants.TIMEZONE)
+    return Trade(document['trdMatchID'], timestamp, document['side'], document['price'], document['size'])
+
+
+def trades_to_payload(trades):
+    """
+    Returns compact JSON of pybitmex Trade objects. See parse_trades_payload().
+    """
+    rows = [[t.trd_match_id, t.timestamp.isoformat(), t.side, t.price, t.size] for t in trades]
+    return json.dumps(rows, separators=(',', ':'))
+
+
+def parse_trades_payload(payload):
+    return [Trade(trd_match_id, parse(timestamp), side, price, size)
+            for trd_match_id, timestamp, side, price, size in json.loads(payload)]
+
+
+def _trd_match_id_bytes(trd_match_id):
+    # Only canonical UUIDs are decoded to the same string.
+    try:
+        result = uuid.UUID(trd_match_id)
+    except (TypeError, ValueError):
+        result = None
+    if result is None or str(result) != trd_match_id:
+        raise ValueError("trdMatchID is not a UUID: {!r}".format(trd_match_id))
+    return result.bytes
+
+
+def trades_to_bytes(trades, tick_size):
+    """
+    Encodes pybitmex Trade objects in the binary wire format.
+    Raises ValueError if a trdMatchID is not a UUID in the canonical form, or a price or size does not fit;
+    publish trades_to_payload() then.
+    """
+    header = TRADES_HEADER.pack(WIRE_FORMAT_MAGIC, WIRE_FORMAT_VERSION, WIRE_KIND_TRADES, tick_size, len(trades))
+    try:
+        records = [
+            TRADE_RECORD.pack(_trd_match_id_bytes(t.trd_match_id), _to_micros(t.timestamp), _SIDES.index(t.side),
+                              _to_ticks(t.price, tick_size), int(t.size))
+            for t in trades
+        ]
+    except struct.error as e:
+        raise ValueError("The trades do not fit in the wire format: {}".format(e))
+    return header + b''.join(records)
+
+
+def trades_from_bytes(data):
+    """
+    Decodes trades_to_bytes() into pybitmex Trade objects.
+    """
+    _, _, _, tick_size, num_trades = _unpack_header(TRADES_HEADER, data, WIRE_KIND_TRADES)
+    end = TRADES_HEADER.size + TRADE_RECORD.size * num_trades
+    return [
+        Trade(str(uuid.UUID(bytes=trd_match_id)), _from_micros(micros), _SIDES[side],
+              _from_ticks(ticks, tick_size), size)
+        for trd_match_id, micros, side, ticks, size in TRADE_RECORD.iter_unpack(data[TRADES_HEADER.size:end])
+    ]
+
+
+def parse_trades_message(data):
+    """
+    Decodes a message of the trades channel: the binary wire format, or JSON for trades which it cannot encode.
+    """
+    if data[:len(WIRE_FORMAT_MAGIC)] == WIRE_FORMAT_MAGIC:
+        return trades_from_bytes(data)
+    return parse_trades_payload(data)
+
+
+def _diff_levels(prev_levels, levels):
+    prev_sizes = {each["price"]: each["size"] for each in prev_levels}
+    result = []
+    for each in levels:
+        if prev_sizes.pop(each["price"], None) != each["size"]:
+            result.append(each)
+    # Levels which no longer exist (or went out of range) are reported with size 0.
+    result.extend({"price": price, "size": 0} for price in prev_sizes)
+    return result
+
+
+###
+# Levels of an order book which have changed. A size of 0 means the level has been removed.
+##
+class OrderBookChanges:
+
+    def __init__(self, _bids, _asks):
+        self.bids = _bids
+        self.asks = _asks
+
+    def __len__(self):
+        return len(self.bids) + len(self.asks)
+
+    def is_empty(self):
+        return len(self) == 0
+
+    def __str__(self):
+        return "({:d} bids, {:d} asks)".format(len(self.bids), len(self.asks))
+
+    def to_dict(self):
+        return {
+            'bids': self.bids,
+            'asks': self.asks
+        }
+
 
 class TradesCursor:
 
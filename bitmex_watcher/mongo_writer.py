@@ -0,0 +1,234 @@
+import queue
+import threading
+from collections import OrderedDict
+from time import sleep, monotonic
+
+from bson.errors import InvalidDocument
+from pymongo.errors import AutoReconnect, BulkWriteError, ConnectionFailure, NetworkTimeout, PyMongoError
+
+from bitmex_watcher.utils import log
+
+
+logger = log.setup_custom_logger('root')
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+###
+# Writes to MongoDB on a background thread, so that the capture loop never waits for database round-trips.
+# Write operations (pymongo.InsertOne, ReplaceOne, ...) are queued, batched up to flush_size or flush_interval,
+# and written as unordered bulk writes per collection.
+#
+# Only errors of the connection (e.g. a primary stepping down) are retried, up to MAX_RETRIES times.
+# Operations which fail otherwise, or are dropped by a drop_* overflow policy, are lost. Their on_failed callbacks
+# are called instead of on_written. A dropped trade is never saved, and a dropped snapshot of
+# ORDER_BOOK_STORAGE_MODE = "delta" breaks the deltas after it until the next keyframe.
+# Use the drop_* policies only where losing data is acceptable.
+##
+class MongoWriter:
+
+    # What write() does when the queue is full.
+    OVERFLOW_BLOCK = 'block'
+    OVERFLOW_DROP_NEWEST = 'drop_newest'
+    OVERFLOW_DROP_OLDEST = 'drop_oldest'
+
+    # Errors after which the same write is likely to succeed.
+    RETRYABLE_ERRORS = (AutoReconnect, ConnectionFailure, NetworkTimeout)
+    MAX_RETRY_INTERVAL_SECONDS = 5.0
+    MAX_RETRIES = 10
+    MAX_RETRIES_ON_STOP = 3
+
+    def __init__(self, max_queue_size, flush_size, flush_interval, overflow_policy=OVERFLOW_BLOCK):
+        if overflow_policy not in (self.OVERFLOW_BLOCK, self.OVERFLOW_DROP_NEWEST, self.OVERFLOW_DROP_OLDEST):
+            raise ValueError("Unknown overflow policy: %s" % overflow_policy)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._run, name='mongo-writer')
+        self._thread.daemon = True
+        self._is_stopping = False
+
+        # Backpressure metrics.
+        self.enqueued_count = 0
+        self.written_count = 0
+        self.duplicated_count = 0
+        self.dropped_count = 0
+        self.failed_count = 0
+        self.retried_count = 0
+        self.max_queue_depth = 0
+        self.last_flush_seconds = 0.0
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        """
+        Writes what is left in the queue and stops the background thread.
+        """
+        self._is_stopping = True
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error("MongoWriter did not stop in %.1f seconds. %d operations left.", timeout, self._queue.qsize())
+
+    def write(self, collection, operation, on_written=None, on_failed=None):
+        """
+        Queues a write operation. on_written is called on the writer thread after the operation is written,
+        in the order of queuing within a collection. on_failed is called instead if it fails (on the writer thread)
+        or is dropped (on the calling thread). Returns False if the operation is dropped.
+        """
+        item = (collection, operation, on_written, on_failed)
+        if self.overflow_policy == self.OVERFLOW_BLOCK:
+            self._queue.put(item)
+        else:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                if self.overflow_policy == self.OVERFLOW_DROP_NEWEST:
+                    self.dropped_count += 1
+                    MongoWriter._call(on_failed)
+                    return False
+                dropped = self._drop_oldest_write()
+                if dropped is None:
+                    # Nothing but tasks in the queue.
+                    self._queue.put(item)
+                else:
+                    self.dropped_count += 1
+                    MongoWriter._call(dropped[3])
+                    self._queue.put_nowait(item)
+        self.enqueued_count += 1
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return True
+
+    def _drop_oldest_write(self):
+        """
+        Removes the oldest write operation from the queue, skipping tasks. Returns it, or None if there is none.
+        """
+        with self._queue.mutex:
+            for i, item in enumerate(self._queue.queue):
+                if item[0] is not None:
+                    del self._queue.queue[i]
+                    self._queue.not_full.notify()
+                    return item
+        return None
+
+    def run(self, task):
+        """
+        Queues a function to run on the writer thread once the operations queued before it are written,
+        and before those queued after it, e.g. creating the indices of a new collection.
+        Never dropped, whatever the overflow policy. Blocks while the queue is full, even with a drop_* policy.
+        """
+        self._queue.put((None, task, None, None))
+        self.enqueued_count += 1
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {
+            'queueDepth': self.queue_depth(),
+            'maxQueueDepth': self.max_queue_depth,
+            'enqueued': self.enqueued_count,
+            'written': self.written_count,
+            'duplicated': self.duplicated_count,
+            'dropped': self.dropped_count,
+            'failed': self.failed_count,
+            'retried': self.retried_count,
+            'lastFlushSeconds': self.last_flush_seconds
+        }
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if 0 < len(batch):
+                self._flush(batch)
+            elif self._is_stopping:
+                break
+
+    def _take_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = monotonic() + self.flush_interval
+        while len(batch) < self.flush_size:
+            remaining_seconds = deadline - monotonic()
+            try:
+                if 0 < remaining_seconds:
+                    batch.append(self._queue.get(timeout=remaining_seconds))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        start_time = monotonic()
+        # Collections are written in the order of their first operations, up to the next task.
+        groups = OrderedDict()
+        for collection, operation, on_written, on_failed in batch:
+            if collection is not None:
+                groups.setdefault(collection.full_name, (collection, []))[1].append(
+                    (operation, on_written, on_failed))
+                continue
+            for each in groups.values():
+                self._write_group(*each)
+            groups = OrderedDict()
+            try:
+                operation()
+            except Exception as e:
+                logger.error("Error in a task of MongoWriter: %s", e)
+        for each in groups.values():
+            self._write_group(*each)
+        self.last_flush_seconds = monotonic() - start_time
+
+    def _write_group(self, collection, items):
+        failed_indices = set()
+        num_retries = 0
+        while True:
+            try:
+                collection.bulk_write([operation for operation, _, _ in items], ordered=False)
+                self.written_count += len(items)
+                break
+            except BulkWriteError as e:
+                # Duplicates are expected when the same data is written again, e.g. after a restart.
+                write_errors = e.details.get('writeErrors', [])
+                errors = [each for each in write_errors if each.get('code') != DUPLICATE_KEY_ERROR]
+                self.duplicated_count += len(write_errors) - len(errors)
+                self.written_count += len(items) - len(write_errors)
+                if 0 < len(errors):
+                    failed_indices = {each.get('index') for each in errors}
+                    self.failed_count += len(errors)
+                    logger.error("Failed to write %d documents to %s: %s",
+                                 len(errors), collection.full_name, errors[0].get('errmsg'))
+                break
+            except self.RETRYABLE_ERRORS as e:
+                max_retries = self.MAX_RETRIES_ON_STOP if self._is_stopping else self.MAX_RETRIES
+                if max_retries <= num_retries:
+                    self.failed_count += len(items)
+                    logger.error("Gave up writing %d operations to %s: %s", len(items), collection.full_name, e)
+                    failed_indices = set(range(len(items)))
+                    break
+                num_retries += 1
+                self.retried_count += 1
+                logger.warning("Retrying to write %d operations to %s (%d): %s",
+                               len(items), collection.full_name, num_retries, e)
+                sleep(min(0.1 * (2 ** num_retries), self.MAX_RETRY_INTERVAL_SECONDS))
+            except (PyMongoError, InvalidDocument) as e:
+                # E.g. a document too large or a failed validation. Writing it again fails again.
+                self.failed_count += len(items)
+                logger.error("Failed to write %d operations to %s: %s", len(items), collection.full_name, e)
+                failed_indices = set(range(len(items)))
+                break
+        for i, (_, on_written, on_failed) in enumerate(items):
+            MongoWriter._call(on_failed if i in failed_indices else on_written)
+
+    @staticmethod
+    def _call(callback):
+        if callback is None:
+            return
+        try:
+            callback()
+        except Exception as e:
+            logger.error("Error in a callback of MongoWriter: %s", e)
@@ -0,0 +1,107 @@
+import urllib.parse
+from datetime import datetime, timezone
+
+from pybitmex import BitMEXClient
+from pybitmex.ws import BitMEXWebSocketClient
+
+from bitmex_watcher.ws_events import WsMessageDispatcher
+
+
+###
+# A websocket subscribing to the same tables of many symbols at once.
+# The tables hold the rows of all the symbols; SymbolBitMEXClient filters them.
+##
+class MultiplexedWebSocketClient(BitMEXWebSocketClient):
+
+    def __init__(self, endpoint, symbols, subscriptions):
+        self.symbols = list(symbols)
+        super(MultiplexedWebSocketClient, self).__init__(endpoint, self.symbols[0], subscriptions=subscriptions)
+
+    # Overrides the private BitMEXWebSocketClient.__get_url(), which subscribes to a single symbol.
+    def _BitMEXWebSocketClient__get_url(self):
+        subscriptions = [sub + ':' + symbol for symbol in self.symbols for sub in self.subscription_list]
+        uri_parts = list(urllib.parse.urlparse(self.endpoint))
+        uri_parts[0] = uri_parts[0].replace('http', 'ws')
+        uri_parts[2] = "/realtime?subscribe={}".format(','.join(subscriptions))
+        return urllib.parse.urlunparse(uri_parts)
+
+
+###
+# A BitMEXClient-compatible view of one symbol of a MultiplexedWebSocketClient.
+# The times of the last updates of the tables are those of the symbol, if a SymbolRouter is given.
+##
+class SymbolBitMEXClient(BitMEXClient):
+
+    # The constructor of BitMEXClient is not called, because it would connect to the exchange by itself.
+    # noinspection PyMissingConstructor
+    def __init__(self, ws_client, symbol, router=None):
+        self.uri = ws_client.endpoint
+        self.symbol = symbol
+        self.is_running = True
+        self.ws_client = ws_client
+        self.rest_client = None
+        self.order_id_prefix = ""
+        self.router = router
+
+    def close(self):
+        # The websocket is shared with other symbols, and closed by its owner.
+        self.is_running = False
+
+    def _rows_of_symbol(self, rows):
+        return [each for each in rows if each.get('symbol') == self.symbol]
+
+    def get_last_ws_update(self, table_name):
+        # pybitmex keeps the time of the last message of a table, whichever symbol it was for.
+        if self.router is None:
+            return super(SymbolBitMEXClient, self).get_last_ws_update(table_name)
+        return self.router.get_last_update(self.symbol, table_name)
+
+    def ws_raw_instrument(self):
+        instruments = self._rows_of_symbol(self.ws_client.data['instrument'])
+        return instruments[0]
+
+    def ws_raw_order_books_of_market(self):
+        return self._rows_of_symbol(super(SymbolBitMEXClient, self).ws_raw_order_books_of_market())
+
+    def ws_raw_recent_trades_of_market(self):
+        return self._rows_of_symbol(super(SymbolBitMEXClient, self).ws_raw_recent_trades_of_market())
+
+
+###
+# Routes websocket messages to the dispatcher of the symbol of their rows, parsing each message only once.
+# Keeps the time of the last message of each table and symbol, so that a quiet symbol is found idle
+# even while the others keep the websocket busy.
+##
+class SymbolRouter:
+
+    def __init__(self, symbols):
+        self.dispatchers = {symbol: WsMessageDispatcher() for symbol in symbols}
+        self.updates = {symbol: {} for symbol in symbols}
+
+    def attach(self, ws_client):
+        root_dispatcher = WsMessageDispatcher()
+        root_dispatcher.add_listener(self.on_message)
+        root_dispatcher.attach(ws_client)
+
+    def on_message(self, message):
+        rows_by_symbol = {}
+        # Partials are sent per symbol, even when they have no rows.
+        filter_symbol = message.get('filter', {}).get('symbol')
+        if filter_symbol is not None:
+            rows_by_symbol[filter_symbol] = []
+        for row in message.get('data', []):
+            rows_by_symbol.setdefault(row.get('symbol'), []).append(row)
+        table = message.get('table')
+        now = datetime.now(timezone.utc)
+        for symbol, rows in rows_by_symbol.items():
+            dispatcher = self.dispatchers.get(symbol)
+            if dispatcher is not None:
+                if table:
+                    self.updates[symbol][table] = now
+                dispatcher.dispatch(dict(message, data=rows))
+
+    def get_last_update(self, symbol, table_name):
+        """
+        Returns the time (in UTC) of the last message of the table with rows of the symbol, or None.
+        """
+        return self.updates[symbol].get(table_name)
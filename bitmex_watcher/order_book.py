@@ -0,0 +1,164 @@
+import bisect
+import math
+import threading
+
+
+###
+# One side (bids or asks) of an order book, kept sorted by price.
+##
+class _BookSide:
+
+    def __init__(self, is_bid):
+        # Bids are kept in descending order of price by sorting negated prices.
+        self._sign = -1.0 if is_bid else 1.0
+        self._keys = []
+        self._sizes = {}
+        self.total_volume = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def set_level(self, price, size):
+        old_size = self._sizes.get(price)
+        if old_size is None:
+            bisect.insort(self._keys, self._sign * price)
+            old_size = 0
+        self._sizes[price] = size
+        self.total_volume += size - old_size
+
+    def remove_level(self, price):
+        old_size = self._sizes.pop(price, None)
+        if old_size is None:
+            return
+        i = bisect.bisect_left(self._keys, self._sign * price)
+        del self._keys[i]
+        self.total_volume -= old_size
+
+    def best_price(self):
+        return self._sign * self._keys[0] if self._keys else None
+
+    def levels_within(self, std_price, allowable_price_diff):
+        # Same criterion as OrderBookSnapshot.filter_order_books, scanning from the best price outwards.
+        result = []
+        for key in self._keys:
+            price = self._sign * key
+            if allowable_price_diff < math.fabs(price - std_price):
+                break
+            result.append({"price": price, "size": self._sizes[price]})
+        return result
+
+
+###
+# An order book maintained from orderBookL2 (or orderBookL2_25) websocket deltas.
+# Levels are keyed by their BitMEX L2 id, so each insert/update/delete is applied in O(log n) lookups
+# instead of re-sorting and re-filtering the whole book on every capture.
+##
+class IncrementalOrderBook:
+
+    def __init__(self, table_name, symbol=None):
+        self.table_name = table_name
+        self.symbol = symbol
+        # L2 id -> (side, price). Update and delete messages may not carry prices.
+        self._levels = {}
+        self._bids = _BookSide(is_bid=True)
+        self._asks = _BookSide(is_bid=False)
+        self._lock = threading.Lock()
+        # Incremented on every applied change, so that readers can cheaply tell that nothing has changed.
+        self.version = 0
+
+    def on_message(self, message):
+        """
+        Listener for WsMessageDispatcher.
+        """
+        if message.get('table') != self.table_name:
+            return
+        action = message.get('action')
+        rows = message.get('data', [])
+        if action == 'partial':
+            self.reset(rows)
+        elif action in ('insert', 'update', 'delete'):
+            self.apply(action, rows)
+
+    def reset(self, rows):
+        with self._lock:
+            # The rows may be a live websocket table. Copy it while listeners wait for the lock.
+            rows = list(rows)
+            self._levels = {}
+            self._bids = _BookSide(is_bid=True)
+            self._asks = _BookSide(is_bid=False)
+            for row in rows:
+                if self._is_target(row):
+                    self._insert(row)
+            self.version += 1
+
+    def apply(self, action, rows):
+        with self._lock:
+            for row in rows:
+                if not self._is_target(row):
+                    continue
+                if action == 'insert':
+                    self._insert(row)
+                elif action == 'update':
+                    self._update(row)
+                else:
+                    self._delete(row)
+            self.version += 1
+
+    def _is_target(self, row):
+        return self.symbol is None or row.get('symbol', self.symbol) == self.symbol
+
+    def _side_of(self, side_name):
+        return self._bids if side_name == "Buy" else self._asks
+
+    def _insert(self, row):
+        # Inserting a known id overwrites it, so that replaying a delta is harmless.
+        self._delete(row)
+        price = float(row["price"])
+        self._levels[row["id"]] = (row["side"], price)
+        self._side_of(row["side"]).set_level(price, int(row["size"]))
+
+    def _update(self, row):
+        level = self._levels.get(row["id"])
+        if level is None:
+            # Not known yet. Could happen before the partial arrives.
+            return
+        # The price of a level never changes, because BitMEX derives L2 ids from prices.
+        side_name, price = level
+        if "size" in row:
+            self._side_of(side_name).set_level(price, int(row["size"]))
+
+    def _delete(self, row):
+        level = self._levels.pop(row["id"], None)
+        if level is None:
+            return
+        side_name, price = level
+        self._side_of(side_name).remove_level(price)
+
+    def volumes(self):
+        """
+        Running totals of the whole book: (bids_volume, asks_volume).
+        """
+        with self._lock:
+            return self._bids.total_volume, self._asks.total_volume
+
+    def sorted_bids_and_asks(self, accept_price_range_ratio=None):
+        """
+        Returns (bids, asks) in the same format as BitMEXClient.ws_sorted_bids_and_asks_of_market().
+        If accept_price_range_ratio is given, only the levels around the mid price are returned,
+        so the cost is proportional to the size of that window rather than the depth of the book.
+        """
+        with self._lock:
+            highest_bid = self._bids.best_price()
+            lowest_ask = self._asks.best_price()
+            if highest_bid is None or lowest_ask is None:
+                return [], []
+            if accept_price_range_ratio is None:
+                allowable_price_diff = math.inf
+                mid_price = 0.0
+            else:
+                # The same mid price as OrderBookSnapshot.
+                mid_price = round(float(highest_bid + lowest_ask) / 2, 4)
+                allowable_price_diff = mid_price * accept_price_range_ratio
+            bids = self._bids.levels_within(mid_price, allowable_price_diff)
+            asks = self._asks.levels_within(mid_price, allowable_price_diff)
+            return bids, asks
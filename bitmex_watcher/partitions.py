@@ -0,0 +1,171 @@
+import re
+from datetime import datetime, timedelta, timezone
+
+from bson.objectid import ObjectId
+
+
+DAY = 'day'
+HOUR = 'hour'
+
+# Suffix format, its number of digits and length of a partition.
+_UNITS = {
+    DAY: ('%Y%m%d', 8, timedelta(days=1)),
+    HOUR: ('%Y%m%d%H', 10, timedelta(hours=1))
+}
+
+
+def to_utc(timestamp):
+    if timestamp.tzinfo is None:
+        # MongoDB returns naive datetimes in UTC.
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc)
+
+
+def partition_start(timestamp, unit):
+    timestamp = to_utc(timestamp).replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0) if unit == DAY else timestamp
+
+
+def partition_name(base_name, timestamp, unit):
+    """
+    Returns the name of the partition holding the timestamp, e.g. "trades_20190413" (day) or "trades_2019041312" (hour).
+    Partitions are in UTC.
+    """
+    suffix_format, _, _ = _UNITS[unit]
+    return "{}_{}".format(base_name, partition_start(timestamp, unit).strftime(suffix_format))
+
+
+def partition_starts(collection_names, base_name, unit):
+    """
+    Returns [(start, name), ...] of the partitions of base_name in collection_names from the oldest.
+    """
+    suffix_format, digits, _ = _UNITS[unit]
+    pattern = re.compile(r"^{}_(\d{{{:d}}})$".format(re.escape(base_name), digits))
+    result = []
+    for name in collection_names:
+        match = pattern.match(name)
+        if match is not None:
+            result.append((partition_start(datetime.strptime(match.group(1), suffix_format), unit), name))
+    return sorted(result)
+
+
+def expired_partition_names(collection_names, base_name, unit, now, retention_seconds):
+    """
+    Returns the names of the partitions of base_name in collection_names which end at or before now - retention_seconds.
+    """
+    _, _, length = _UNITS[unit]
+    expires_at = to_utc(now) - timedelta(seconds=retention_seconds)
+    return [name for start, name in partition_starts(collection_names, base_name, unit)
+            if start + length <= expires_at]
+
+
+###
+# A collection split into a collection per day or hour (partition) by the 'timestamp' of documents.
+#
+# Writes go to the partition of their timestamp. A range query only reads the partitions overlapping the range,
+# so recent-window queries stay fast however much history is kept, and retention drops whole partitions
+# instead of relying on capped collections.
+#
+# No I/O is done here except through the collection objects given out, so that it works with motor too.
+##
+class TimePartitionedCollection:
+
+    def __init__(self, db, base_name, unit, on_new_partition=None):
+        """
+        on_new_partition(collection) is called the first time a partition is written by this process,
+        before anything is written to it. Creating indices there is safe even if the partition exists.
+        """
+        if unit not in _UNITS:
+            raise ValueError("Unknown partition unit: {}".format(unit))
+        self.db = db
+        self.base_name = base_name
+        self.unit = unit
+        self.on_new_partition = on_new_partition
+        self.partitions = {}
+
+    def name_of(self, timestamp):
+        return partition_name(self.base_name, timestamp, self.unit)
+
+    def partition_for(self, timestamp):
+        name = self.name_of(timestamp)
+        collection = self.partitions.get(name)
+        if collection is None:
+            collection = self.db[name]
+            if self.on_new_partition is not None:
+                self.on_new_partition(collection)
+            self.partitions[name] = collection
+        return collection
+
+    def split(self, documents):
+        """
+        Returns [(partition, [documents in it]), ...] keeping the order of documents.
+        """
+        result = []
+        for each in documents:
+            collection = self.partition_for(each['timestamp'])
+            if len(result) == 0 or result[-1][0] is not collection:
+                result.append((collection, []))
+            result[-1][1].append(each)
+        return result
+
+    def partitions_between(self, start, end):
+        """
+        Returns the partitions overlapping [start, end] from the oldest. Those never written are empty.
+        """
+        _, _, length = _UNITS[self.unit]
+        result = []
+        timestamp = partition_start(start, self.unit)
+        end = to_utc(end)
+        while timestamp <= end:
+            result.append(self.db[self.name_of(timestamp)])
+            timestamp += length
+        return result
+
+    def partitions_before(self, timestamp, count):
+        """
+        Returns count partitions from the one holding the timestamp, the newest first.
+        """
+        _, _, length = _UNITS[self.unit]
+        return list(reversed(self.partitions_between(partition_start(timestamp, self.unit) - length * (count - 1),
+                                                     timestamp)))
+
+    def partitions_for_id(self, object_id):
+        """
+        Returns the partitions which may hold the document of the ObjectId generated when it was captured.
+        ObjectIds have a precision of a second, so the partition before is also a candidate.
+        """
+        generation_time = ObjectId(object_id).generation_time
+        return list(reversed(self.partitions_between(generation_time - timedelta(seconds=1), generation_time)))
+
+    def find(self, query, start, end, sort=None):
+        """
+        Yields the documents matching the query in the partitions overlapping [start, end], partition by partition.
+        The query should limit 'timestamp' to the same range.
+        """
+        for collection in self.partitions_between(start, end):
+            cursor = collection.find(query)
+            if sort is not None:
+                cursor = cursor.sort(sort)
+            for each in cursor:
+                yield each
+
+    def existing_partitions(self, collection_names, since=None):
+        """
+        Returns the partitions in collection_names from the oldest, except those ending at or before since.
+        """
+        _, _, length = _UNITS[self.unit]
+        return [self.db[name] for start, name in partition_starts(collection_names, self.base_name, self.unit)
+                if since is None or to_utc(since) < start + length]
+
+    def expired_partition_names(self, collection_names, now, retention_seconds):
+        return expired_partition_names(collection_names, self.base_name, self.unit, now, retention_seconds)
+
+    def drop_expired(self, now, retention_seconds):
+        """
+        Drops the partitions ending at or before now - retention_seconds. Returns their names.
+        """
+        names = self.expired_partition_names(self.db.list_collection_names(), now, retention_seconds)
+        for name in names:
+            self.db.drop_collection(name)
+            self.partitions.pop(name, None)
+        return names
@@ -0,0 +1,60 @@
+import threading
+
+from time import perf_counter
+
+from pybitmex.ws import BitMEXWebSocketClient
+
+from bitmex_watcher.multiplex import MultiplexedWebSocketClient
+from bitmex_watcher.utils import log
+
+
+logger = log.setup_custom_logger('root')
+
+
+def connect_like(ws_client):
+    """
+    Returns a new websocket subscribing to the same tables as the given one, once their partials have arrived.
+    """
+    if isinstance(ws_client, MultiplexedWebSocketClient):
+        return MultiplexedWebSocketClient(ws_client.endpoint, ws_client.symbols, ws_client.subscription_list)
+    return BitMEXWebSocketClient(ws_client.endpoint, ws_client.symbol, subscriptions=ws_client.subscription_list)
+
+
+###
+# Replaces a stale websocket with a new one in the process, instead of the watcher exiting
+# and its container restarting it. The MongoDB and Redis clients and the state of the watchers are kept.
+#
+# Shared by the watchers of a websocket. Whichever finds it stale first reconnects it,
+# and the others find the new one in their BitMEXClient. on_connected(ws_client) puts it there.
+##
+class WsReconnector:
+
+    def __init__(self, ws_client, on_connected, connect=connect_like):
+        self.ws_client = ws_client
+        self.on_connected = on_connected
+        self.connect = connect
+        self.num_reconnects = 0
+        self._lock = threading.Lock()
+
+    def reconnect(self, stale_ws_client):
+        """
+        Returns True once stale_ws_client has been replaced, by this call or by another watcher.
+        """
+        with self._lock:
+            if self.ws_client is not stale_ws_client:
+                return True
+            start = perf_counter()
+            try:
+                ws_client = self.connect(stale_ws_client)
+            except Exception as e:
+                logger.error("Unable to reconnect the websocket: %s", e)
+                return False
+            self.on_connected(ws_client)
+            self.ws_client = ws_client
+            self.num_reconnects += 1
+            logger.warning("The websocket is reconnected in %.2f seconds.", perf_counter() - start)
+        try:
+            stale_ws_client.exit()
+        except Exception as e:
+            logger.info("Unable to close the stale websocket: %s", e)
+        return True
@@ -0,0 +1,107 @@
+import json
+from time import time
+
+import redis
+
+
+###
+# Adds order book snapshots and trade batches to Redis Streams, trimmed to about max_len entries each.
+# Unlike pub/sub, consumers which were away resume from the last entry they have read. See StreamConsumer.
+#
+# The methods return what the Redis client returns, so that they work with redis.asyncio too (await the result).
+##
+class StreamPublisher:
+
+    def __init__(self, order_book_snapshots_stream_name, trades_stream_name, heartbeat_key_name,
+                 max_len, heartbeat_ttl_seconds):
+        self.order_book_snapshots_stream_name = order_book_snapshots_stream_name
+        self.trades_stream_name = trades_stream_name
+        self.heartbeat_key_name = heartbeat_key_name
+        self.max_len = max_len
+        self.heartbeat_ttl_milliseconds = int(heartbeat_ttl_seconds * 1000)
+
+    def order_book_snapshot_entry(self, order_book_snapshot_id, order_book_snapshot, payload=None, trade_stats=None):
+        """
+        Builds the entry of a snapshot, which is passed to add_order_book_snapshot() once the snapshot is written,
+        so that every entry in the stream can be loaded from MongoDB.
+        """
+        summary = order_book_snapshot.to_summary_dict()
+        summary['timestamp'] = order_book_snapshot.timestamp.isoformat()
+        fields = {'id': order_book_snapshot_id, 'summary': json.dumps(summary, separators=(',', ':'))}
+        if payload is not None:
+            fields['payload'] = payload
+        if trade_stats is not None:
+            fields['tradeStats'] = trade_stats
+        return fields
+
+    def add_order_book_snapshot(self, redis_client, fields):
+        return redis_client.xadd(self.order_book_snapshots_stream_name, fields,
+                                 maxlen=self.max_len, approximate=True)
+
+    def add_trades(self, redis_client, payload):
+        return redis_client.xadd(self.trades_stream_name, {'trades': payload}, maxlen=self.max_len, approximate=True)
+
+    def set_heartbeat(self, redis_client):
+        # Nobody is woken up. Consumers check whether the key exists.
+        return redis_client.set(self.heartbeat_key_name, int(time() * 1000), px=self.heartbeat_ttl_milliseconds)
+
+
+###
+# Reads a stream written by StreamPublisher.
+#
+# Without a group, reading starts after last_id ('$': the entries added from now on),
+# and the consumer keeps the id of the last entry it has read, which can be saved to resume later.
+# With a group, Redis keeps the position of the group, and entries read but not acknowledged
+# by this consumer before a restart are read again first.
+##
+class StreamConsumer:
+
+    def __init__(self, redis_client, stream_name, last_id='$', group_name=None, consumer_name=None):
+        self.redis = redis_client
+        self.stream_name = stream_name
+        self.last_id = last_id
+        self.group_name = group_name
+        self.consumer_name = consumer_name
+        if group_name is not None:
+            self._create_group()
+            # Pending entries of this consumer first, then new ones ('>').
+            self.last_id = '0'
+
+    def _create_group(self):
+        try:
+            self.redis.xgroup_create(self.stream_name, self.group_name, id='0', mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise e
+
+    def _resolve_last_id(self):
+        # '$' would skip the entries added between two reads, so it is replaced by the id of the latest entry.
+        if self.last_id == '$':
+            latest = self.redis.xrevrange(self.stream_name, count=1)
+            self.last_id = latest[0][0] if latest else '0-0'
+
+    def read(self, count=100, block_milliseconds=None):
+        """
+        Returns a list of (entry id, fields) in the order of the stream.
+        Blocks up to block_milliseconds if there are no entries (never if None).
+        """
+        if self.group_name is None:
+            self._resolve_last_id()
+            response = self.redis.xread({self.stream_name: self.last_id}, count=count, block=block_milliseconds)
+        else:
+            response = self.redis.xreadgroup(self.group_name, self.consumer_name, {self.stream_name: self.last_id},
+                                             count=count, block=block_milliseconds)
+        entries = response[0][1] if response else []
+        if 0 < len(entries):
+            if self.last_id != '>':
+                self.last_id = entries[-1][0]
+        elif self.group_name is not None and self.last_id != '>':
+            # No more pending entries.
+            self.last_id = '>'
+            return self.read(count, block_milliseconds)
+        return entries
+
+    def ack(self, entry_ids):
+        if self.group_name is None or len(entry_ids) == 0:
+            return 0
+        return self.redis.xack(self.stream_name, self.group_name, *entry_ids)
@@ -0,0 +1,243 @@
+import json
+import heapq
+import logging
+
+from time import sleep, monotonic
+from datetime import timedelta
+
+from pybitmex import BitMEXClient
+from pybitmex.ws import BitMEXWebSocketClient
+
+from bitmex_watcher.memory_stores import InMemoryMongoClient, InMemoryRedis
+from bitmex_watcher.partitions import to_utc
+from bitmex_watcher.settings import settings
+from bitmex_watcher.utils import log, constants
+from bitmex_watcher.ws_events import to_bitmex_timestamp, read_recorded_messages
+from bitmex_watcher.watcher_server import MarketWatcher
+
+
+logger = log.setup_custom_logger('root')
+
+
+def messages_from_documents(symbol, tick_size, trades, order_book_snapshots, order_book_table_name='orderBookL2_25'):
+    """
+    Yields (time, message) of websocket messages which reproduce stored trades and order book snapshots,
+    both sorted by their timestamps (e.g. find().sort("timestamp") or what OrderBookSnapshotReader returns).
+    Every snapshot becomes a partial of the order book table, and trades are inserted into the trade table.
+    """
+    trades = iter(trades)
+    order_book_snapshots = iter(order_book_snapshots)
+    first_trade = next(trades, None)
+    first_snapshot = next(order_book_snapshots, None)
+    if first_trade is None and first_snapshot is None:
+        return
+    start = min(to_utc(each['timestamp']) for each in (first_trade, first_snapshot) if each is not None)
+    yield start, {'table': 'instrument', 'action': 'partial', 'keys': ['symbol'],
+                  'data': [{'symbol': symbol, 'state': 'Open', 'tickSize': tick_size}]}
+    yield start, {'table': 'trade', 'action': 'partial', 'keys': [], 'data': []}
+
+    def trade_messages(documents):
+        for each in documents:
+            row = {'timestamp': to_bitmex_timestamp(to_utc(each['timestamp'])), 'symbol': symbol, 'side': each['side'],
+                   'size': each['size'], 'price': each['price'], 'trdMatchID': each['trdMatchID']}
+            yield to_utc(each['timestamp']), 1, {'table': 'trade', 'action': 'insert', 'data': [row]}
+
+    def order_book_messages(documents):
+        for each in documents:
+            # BitMEX derives L2 ids from prices too.
+            rows = [{'symbol': symbol, 'id': int(round(level['price'] / tick_size)), 'side': side,
+                     'size': level['size'], 'price': level['price']}
+                    for side, levels in (('Buy', each['bids']), ('Sell', each['asks'])) for level in levels]
+            yield to_utc(each['timestamp']), 0, {'table': order_book_table_name, 'action': 'partial',
+                                                 'keys': ['symbol', 'id', 'side'], 'data': rows}
+
+    def prepend(first, rest):
+        if first is not None:
+            yield first
+        yield from rest
+
+    # Snapshots go first among messages of the same time, so that the order book is there before trades.
+    merged = heapq.merge(trade_messages(prepend(first_trade, trades)),
+                         order_book_messages(prepend(first_snapshot, order_book_snapshots)),
+                         key=lambda m: (m[0], m[1]))
+    for timestamp, _, message in merged:
+        yield timestamp, message
+
+
+class _ReplayWebSocketApp:
+
+    def __init__(self, on_message):
+        self.on_message = on_message
+
+
+###
+# A BitMEXWebSocketClient fed with recorded messages instead of a connection.
+# Messages go through the same handler as live ones, and the time of updates is the recorded time.
+##
+class ReplayWebSocketClient(BitMEXWebSocketClient):
+
+    # The constructor of BitMEXWebSocketClient is not called, because it would connect to the exchange.
+    # noinspection PyMissingConstructor
+    def __init__(self, symbol):
+        self.logger = logging.getLogger(__name__)
+        self.endpoint = 'replay'
+        self.symbol = symbol
+        self.subscription_list = []
+        self.updates = {}
+        self.data = {}
+        self.keys = {}
+        self.exited = False
+        self.recorded_time = None
+        # WsMessageDispatcher wraps the handler of the websocket app, as it does live.
+        self.ws = _ReplayWebSocketApp(self._BitMEXWebSocketClient__on_message)
+
+    def _now(self):
+        return self.recorded_time
+
+    def feed(self, recorded_time, message):
+        self.recorded_time = recorded_time
+        if message.get('action') == 'partial':
+            # A partial is the whole table, even when it comes again.
+            self.data[message['table']] = []
+        self.ws.on_message(json.dumps(message))
+
+    def is_ready(self):
+        return 'instrument' in self.data and 'trade' in self.data and\
+            any(name.startswith('orderBook') for name in self.data)
+
+    def exit(self):
+        self.exited = True
+
+
+###
+# A BitMEXClient on a ReplayWebSocketClient.
+##
+class ReplayBitMEXClient(BitMEXClient):
+
+    # noinspection PyMissingConstructor
+    def __init__(self, symbol):
+        self.uri = 'replay'
+        self.symbol = symbol
+        self.is_running = True
+        self.ws_client = ReplayWebSocketClient(symbol)
+        self.rest_client = None
+        self.order_id_prefix = ""
+
+    def close(self):
+        self.is_running = False
+
+
+###
+# MarketWatcher on the recorded clock, so that replays are deterministic however fast they run.
+##
+class ReplayMarketWatcher(MarketWatcher):
+
+    def now(self):
+        return self.bitmex_client.ws_client.recorded_time.astimezone(constants.TIMEZONE)
+
+    def clock(self):
+        return self.bitmex_client.ws_client.recorded_time.timestamp()
+
+
+###
+# Feeds recorded messages to a ReplayBitMEXClient and runs the captures of a watcher in between,
+# every capture_interval seconds of the recorded time.
+#
+# speed is the ratio to the recorded speed (1.0 to replay in real time), or None to replay as fast as possible.
+##
+class Replayer:
+
+    def __init__(self, bitmex_client, messages, capture_interval=None, speed=None):
+        self.bitmex_client = bitmex_client
+        self.messages = iter(messages)
+        if capture_interval is None:
+            capture_interval = settings.MIN_PUBLISH_INTERVAL if settings.CAPTURE_MODE == 'event'\
+                else settings.LOOP_INTERVAL
+        self.capture_interval = timedelta(seconds=capture_interval)
+        self.speed = speed
+        self.num_messages = 0
+        self.num_captures = 0
+        self.first_time = None
+        self.start_clock = None
+
+    def feed(self, recorded_time, message):
+        if self.first_time is None:
+            self.first_time = recorded_time
+            self.start_clock = monotonic()
+        self.pace(recorded_time)
+        self.bitmex_client.ws_client.feed(recorded_time, message)
+        self.num_messages += 1
+
+    def prime(self):
+        """
+        Feeds messages until the client has the tables a watcher needs. Call it before creating the watcher.
+        """
+        while not self.bitmex_client.ws_client.is_ready():
+            recorded_time, message = next(self.messages)
+            self.feed(recorded_time, message)
+
+    def pace(self, recorded_time):
+        if self.speed is None:
+            return
+        remaining_seconds = (recorded_time - self.first_time).total_seconds() / self.speed -\
+            (monotonic() - self.start_clock)
+        if 0 < remaining_seconds:
+            sleep(remaining_seconds)
+
+    def capture(self, watcher, recorded_time):
+        self.pace(recorded_time)
+        self.bitmex_client.ws_client.recorded_time = recorded_time
+        self.num_captures += 1
+        return watcher.capture_once()
+
+    def run(self, watcher):
+        """
+        Replays the rest of the messages through the watcher. Returns the statistics of the replay.
+        """
+        start_clock = monotonic()
+        try:
+            watcher.load_state()
+            next_capture_time = self.bitmex_client.ws_client.recorded_time
+            is_running = True
+            for recorded_time, message in self.messages:
+                while is_running and next_capture_time <= recorded_time:
+                    is_running = self.capture(watcher, next_capture_time)
+                    next_capture_time += self.capture_interval
+                if not is_running:
+                    break
+                self.feed(recorded_time, message)
+            if is_running:
+                # Captures what the last messages have brought.
+                self.capture(watcher, next_capture_time)
+        finally:
+            watcher.exit()
+        elapsed_seconds = monotonic() - start_clock
+        result = {
+            'messages': self.num_messages,
+            'captures': self.num_captures,
+            'recordedSeconds': (self.bitmex_client.ws_client.recorded_time - self.first_time).total_seconds(),
+            'elapsedSeconds': elapsed_seconds,
+            'capturesPerSecond': self.num_captures / elapsed_seconds if 0 < elapsed_seconds else 0.0
+        }
+        logger.info("Replayed: %s", str(result))
+        return result
+
+
+def replay(messages, symbol=None, mongo_client=None, redis_client=None, capture_interval=None, speed=None):
+    """
+    Runs MarketWatcher through the messages, with in-memory MongoDB and Redis unless given.
+    Returns (statistics, watcher); what the watcher has saved and published is in its clients.
+    """
+    bitmex_client = ReplayBitMEXClient(symbol or settings.SYMBOL)
+    replayer = Replayer(bitmex_client, messages, capture_interval, speed)
+    replayer.prime()
+    watcher = ReplayMarketWatcher(symbol, bitmex_client, mongo_client or InMemoryMongoClient(),
+                                  redis_client or InMemoryRedis())
+    return replayer.run(watcher), watcher
+
+
+def start():
+    """
+    Replays REPLAY_PATH (recorded with WS_RECORD_PATH) with in-memory MongoDB and Redis, and logs the statistics.
+    """
+    replay(read_recorded_messages(settings.REPLAY_PATH), speed=settings.REPLAY_SPEED)
@@ -0,0 +1,309 @@
+import math
+from datetime import datetime, timedelta, timezone
+
+import pymongo
+
+from bitmex_watcher.models import TradesCursor
+
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def interval_name(interval_seconds):
+    for unit_seconds, unit in ((86400, 'd'), (3600, 'h'), (60, 'm')):
+        if interval_seconds % unit_seconds == 0:
+            return "{:d}{}".format(interval_seconds // unit_seconds, unit)
+    return "{:d}s".format(interval_seconds)
+
+
+def _as_utc(timestamp):
+    # MongoDB returns naive datetimes in UTC.
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc)
+
+
+def rollup_collection_name(collection_name, interval_seconds):
+    return "{}_{}".format(collection_name, interval_name(interval_seconds))
+
+
+def floor_timestamp(timestamp, interval_seconds):
+    seconds = (_as_utc(timestamp) - _EPOCH) // timedelta(seconds=1)
+    return _EPOCH + timedelta(seconds=seconds - seconds % interval_seconds)
+
+
+def ceil_timestamp(timestamp, interval_seconds):
+    floor = floor_timestamp(timestamp, interval_seconds)
+    return floor if floor == _as_utc(timestamp) else floor + timedelta(seconds=interval_seconds)
+
+
+###
+# OHLCV and trade flow of the trades in a time bucket.
+# The mean and the variance of prices (per trade, as $avg and $stdDevPop) are kept by Welford's algorithm,
+# and buckets are merged by the parallel algorithm of Chan et al., so that nothing is summed over trades again.
+##
+class RollupBucket:
+
+    def __init__(self, _timestamp):
+        self.timestamp = _timestamp
+        self.open = None
+        self.high = None
+        self.low = None
+        self.close = None
+        self.volume = 0
+        self.buy_volume = 0
+        self.sell_volume = 0
+        self.turnover = 0.0
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.last_timestamp = None
+        self.last_trd_match_id = None
+
+    def add(self, trade):
+        if self.count == 0:
+            self.open = self.high = self.low = trade.price
+        else:
+            self.high = max(self.high, trade.price)
+            self.low = min(self.low, trade.price)
+        self.close = trade.price
+        self.volume += trade.size
+        if trade.side == "Buy":
+            self.buy_volume += trade.size
+        else:
+            self.sell_volume += trade.size
+        self.turnover += trade.price * trade.size
+        self.count += 1
+        delta = trade.price - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (trade.price - self.mean)
+        self.last_timestamp = trade.timestamp
+        self.last_trd_match_id = trade.trd_match_id
+
+    def merge(self, later):
+        """
+        Merges a bucket which follows this one in time.
+        """
+        if later.count == 0:
+            return
+        if self.count == 0:
+            self.open, self.high, self.low = later.open, later.high, later.low
+        else:
+            self.high = max(self.high, later.high)
+            self.low = min(self.low, later.low)
+        self.close = later.close
+        self.volume += later.volume
+        self.buy_volume += later.buy_volume
+        self.sell_volume += later.sell_volume
+        self.turnover += later.turnover
+        count = self.count + later.count
+        delta = later.mean - self.mean
+        self.mean += delta * later.count / count
+        self.m2 += later.m2 + delta * delta * self.count * later.count / count
+        self.count = count
+        self.last_timestamp = later.last_timestamp
+        self.last_trd_match_id = later.last_trd_match_id
+
+    def merge_earlier(self, earlier, is_opening):
+        """
+        Merges the trades of a bucket which are older than the last trade of this one, e.g. backfilled ones.
+        They open this bucket if is_opening, and never close it.
+        """
+        if earlier.count == 0:
+            return
+        if self.count == 0:
+            self.merge(earlier)
+            return
+        open_price, close_price = self.open, self.close
+        last_timestamp, last_trd_match_id = self.last_timestamp, self.last_trd_match_id
+        self.merge(earlier)
+        self.open = earlier.open if is_opening else open_price
+        self.close = close_price
+        self.last_timestamp, self.last_trd_match_id = last_timestamp, last_trd_match_id
+
+    @property
+    def momentum(self):
+        return self.buy_volume - self.sell_volume
+
+    @property
+    def vwap(self):
+        return self.turnover / self.volume if 0 < self.volume else None
+
+    @property
+    def sd(self):
+        return math.sqrt(self.m2 / self.count) if 0 < self.count else None
+
+    def to_dict(self):
+        return {
+            'timestamp': self.timestamp,
+            'open': self.open,
+            'high': self.high,
+            'low': self.low,
+            'close': self.close,
+            'volume': self.volume,
+            'buyVolume': self.buy_volume,
+            'sellVolume': self.sell_volume,
+            'momentum': self.momentum,
+            'turnover': self.turnover,
+            'count': self.count,
+            'mean': self.mean,
+            'm2': self.m2,
+            'lastTimestamp': self.last_timestamp,
+            'lastTrdMatchID': self.last_trd_match_id
+        }
+
+    @staticmethod
+    def from_dict(document):
+        result = RollupBucket(_as_utc(document['timestamp']))
+        for key, attribute in (('open', 'open'), ('high', 'high'), ('low', 'low'), ('close', 'close'),
+                               ('volume', 'volume'), ('buyVolume', 'buy_volume'), ('sellVolume', 'sell_volume'),
+                               ('turnover', 'turnover'), ('count', 'count'), ('mean', 'mean'), ('m2', 'm2'),
+                               ('lastTrdMatchID', 'last_trd_match_id')):
+            setattr(result, attribute, document[key])
+        if document['lastTimestamp'] is not None:
+            result.last_timestamp = _as_utc(document['lastTimestamp'])
+        return result
+
+    def to_stats_dict(self):
+        return {
+            'timestamp': self.timestamp,
+            'open': self.open,
+            'high': self.high,
+            'low': self.low,
+            'close': self.close,
+            'volume': self.volume,
+            'momentum': self.momentum,
+            'vwap': self.vwap,
+            'count': self.count,
+            'mean': self.mean,
+            'sd': self.sd
+        }
+
+
+###
+# Maintains the buckets in progress of every interval as trades arrive.
+##
+class TradeRollups:
+
+    def __init__(self, intervals):
+        self.intervals = sorted(intervals)
+        self.buckets = {}
+        # Trades up to this cursor are already in the buckets.
+        self.cursor = None
+        # Cursors of the first trades of the buckets in progress. Unknown for the buckets seeded.
+        self.first_cursors = {}
+        # Trades up to this cursor were added before a restart.
+        self.seed_cursor = None
+
+    def seed(self, documents_by_interval):
+        """
+        Continues from the latest stored buckets, so that a restart neither loses nor double counts trades.
+        """
+        for interval, document in documents_by_interval.items():
+            if document is None:
+                continue
+            bucket = RollupBucket.from_dict(document)
+            self.buckets[interval] = bucket
+            self.first_cursors.pop(interval, None)
+            if bucket.last_timestamp is None:
+                continue
+            cursor = TradesCursor(bucket.last_timestamp, bucket.last_trd_match_id)
+            if self.cursor is None or self.cursor.is_behind_of(cursor):
+                self.cursor = cursor
+        self.seed_cursor = self.cursor
+
+    def add(self, trades):
+        """
+        Adds trades sorted by (timestamp, trdMatchID).
+        Returns {interval: [buckets changed]}, to be upserted by their timestamps.
+        """
+        changed = {interval: [] for interval in self.intervals}
+        for trade in trades:
+            if self.cursor is not None and not self.cursor.is_behind_of(trade):
+                continue
+            for interval in self.intervals:
+                start = floor_timestamp(trade.timestamp, interval)
+                bucket = self.buckets.get(interval)
+                if bucket is None or bucket.timestamp != start:
+                    bucket = RollupBucket(start)
+                    self.buckets[interval] = bucket
+                    self.first_cursors[interval] = TradesCursor(trade.timestamp, trade.trd_match_id)
+                bucket.add(trade)
+                if len(changed[interval]) == 0 or changed[interval][-1] is not bucket:
+                    changed[interval].append(bucket)
+        if 0 < len(trades):
+            last = trades[-1]
+            if self.cursor is None or self.cursor.is_behind_of(last):
+                self.cursor = TradesCursor(last.timestamp, last.trd_match_id)
+        return changed
+
+    def add_earlier(self, trades):
+        """
+        Adds trades behind the cursor (e.g. backfilled ones) sorted by (timestamp, trdMatchID)
+        to the buckets in progress. Those of earlier buckets are left out. Returns {interval: [buckets changed]}.
+        """
+        changed = {interval: [] for interval in self.intervals}
+        for interval in self.intervals:
+            bucket = self.buckets.get(interval)
+            if bucket is None:
+                continue
+            earlier = [t for t in trades if floor_timestamp(t.timestamp, interval) == bucket.timestamp and
+                       (self.seed_cursor is None or self.seed_cursor.is_behind_of(t))]
+            if len(earlier) == 0:
+                continue
+            earlier_bucket = RollupBucket(bucket.timestamp)
+            for trade in earlier:
+                earlier_bucket.add(trade)
+            # The first trade of a seeded bucket is unknown, but older than any trade after the seed.
+            first_cursor = self.first_cursors.get(interval)
+            is_opening = first_cursor is not None and not first_cursor.is_behind_of(earlier[0])
+            bucket.merge_earlier(earlier_bucket, is_opening)
+            if is_opening:
+                self.first_cursors[interval] = TradesCursor(earlier[0].timestamp, earlier[0].trd_match_id)
+            changed[interval].append(bucket)
+        return changed
+
+
+def cover_range(start, end, intervals):
+    """
+    Splits [start, end) into ranges of bucket timestamps [(interval, from, to), ...] in the order of time,
+    taking the coarsest buckets that fit. Every interval must divide the coarser ones.
+    """
+    if end <= start or len(intervals) == 0:
+        return []
+    coarsest = intervals[-1]
+    if len(intervals) == 1:
+        return [(coarsest, start, end)]
+    aligned_start = ceil_timestamp(start, coarsest)
+    aligned_end = floor_timestamp(end, coarsest)
+    if aligned_end <= aligned_start:
+        return cover_range(start, end, intervals[:-1])
+    return cover_range(start, aligned_start, intervals[:-1]) + [(coarsest, aligned_start, aligned_end)] +\
+        cover_range(aligned_end, end, intervals[:-1])
+
+
+###
+# Windowed statistics of trades from the rollup collections, reading O(buckets) documents instead of the trades.
+##
+class TradesRollupReader:
+
+    def __init__(self, collections_by_interval):
+        self.collections_by_interval = collections_by_interval
+        self.intervals = sorted(collections_by_interval)
+
+    def load_buckets(self, interval, start, end):
+        documents = self.collections_by_interval[interval].find(
+            {"timestamp": {"$gte": start, "$lt": end}}).sort("timestamp", pymongo.ASCENDING)
+        return [RollupBucket.from_dict(each) for each in documents]
+
+    def stats(self, start, end):
+        """
+        Returns RollupBucket.to_stats_dict() of the trades in [start, end), to the precision of the finest interval.
+        """
+        finest = self.intervals[0]
+        start = floor_timestamp(start, finest)
+        result = RollupBucket(start)
+        for interval, range_start, range_end in cover_range(start, ceil_timestamp(end, finest), self.intervals):
+            for bucket in self.load_buckets(interval, range_start, range_end):
+                result.merge(bucket)
+        return result.to_stats_dict()
@@ -1,13 +1,20 @@
 import concurrent.futures
+import math
 
 from datetime import datetime, timedelta
 
 import pymongo
-from bson.objectid import ObjectId
 import redis
 
+from bitmex_watcher.models import parse_order_book_payload, parse_order_book_message
+from bitmex_watcher.partitions import TimePartitionedCollection
+from bitmex_watcher.redis_streams import StreamConsumer
+from bitmex_watcher.rollups import TradesRollupReader, rollup_collection_name
 from bitmex_watcher.settings import settings
+from bitmex_watcher.snapshot_store import OrderBookSnapshotReader
+from bitmex_watcher.trade_windows import parse_trade_stats_payload
 from bitmex_watcher.utils import log, constants
+from bitmex_watcher.watcher_server import symbol_scoped_name, symbol_scoped_channel_name
 
 
 logger = log.setup_custom_logger('root')
@@ -15,64 +22,193 @@ logger = log.setup_custom_logger('root')
 
 class SampleSubscriber:
 
-    def __init__(self):
+    def __init__(self, symbol=None):
+        """
+        symbol is given to read what the watcher of a symbol in SYMBOLS saves. Names are suffixed with it.
+        """
+        self.symbol = symbol
         # MongoDB client.
         self.mongo_client = pymongo.MongoClient(settings.MONGO_DB_URI)
         self.bitmex_db = self.mongo_client[settings.BITMEX_DB]
         # Collections to save data in.
-        self.trades_collection = self.bitmex_db[settings.TRADES_COLLECTION]
-        self.order_book_snapshot_collection = self.bitmex_db[settings.ORDER_BOOK_SNAPSHOTS_COLLECTION]
+        trades_collection_name = symbol_scoped_name(settings.TRADES_COLLECTION, symbol)
+        order_book_snapshots_collection_name = symbol_scoped_name(settings.ORDER_BOOK_SNAPSHOTS_COLLECTION, symbol)
+        self.trades_collection = self.bitmex_db[trades_collection_name]
+        self.order_book_snapshot_collection = self.bitmex_db[order_book_snapshots_collection_name]
+        self.partitioned_trades = None
+        partitioned_order_book_snapshots = None
+        if settings.STORAGE_PARTITIONING != 'none':
+            self.partitioned_trades = TimePartitionedCollection(
+                self.bitmex_db, trades_collection_name, settings.STORAGE_PARTITIONING)
+            partitioned_order_book_snapshots = TimePartitionedCollection(
+                self.bitmex_db, order_book_snapshots_collection_name, settings.STORAGE_PARTITIONING)
+        self.order_book_snapshot_reader = OrderBookSnapshotReader(
+            self.order_book_snapshot_collection, partitioned_order_book_snapshots)
+        self.trades_rollup_reader = None
+        if settings.TRADES_ROLLUPS:
+            self.trades_rollup_reader = TradesRollupReader({
+                interval: self.bitmex_db[symbol_scoped_name(
+                    rollup_collection_name(settings.TRADES_ROLLUP_COLLECTION, interval), symbol)]
+                for interval, _ in settings.TRADES_ROLLUPS
+            })
 
         # Redis client.
         self.redis = redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
 
+    def load_order_book_snapshot(self, data):
+        if settings.REDIS_PUBLISH_MODE == 'payload':
+            # The message is the snapshot itself. No database reads.
+            if settings.REDIS_PAYLOAD_FORMAT == 'binary':
+                # In JSON if the snapshot does not fit in the wire format.
+                return parse_order_book_message(data)
+            return parse_order_book_payload(data)
+        order_book_snapshot_id = data.decode(encoding='utf-8')
+        logger.info("[SUB] Received OrderBookSnapshotID: %s" % order_book_snapshot_id)
+        return self.order_book_snapshot_reader.load_by_id(order_book_snapshot_id)
+
+    def load_trade_stats(self):
+        if not settings.TRADE_WINDOWS:
+            return None
+        # Set by the watcher before the snapshot is published.
+        return self.redis.get(symbol_scoped_channel_name(settings.REDIS_TRADE_STATS_CHANNEL_NAME, self.symbol))
+
+    def on_order_book_snapshot(self, loaded_snapshot, trade_stats=None):
+        # logger.info("[SUB] Loaded: %s", str(loaded_snapshot))
+        logger.info("[SUB] Loaded: %d bids and %d asks",
+                    len(loaded_snapshot['bids']), len(loaded_snapshot['asks']))
+
+        if trade_stats is not None:
+            # Computed by the watcher as trades arrive. Nothing to query.
+            for name, stats in parse_trade_stats_payload(trade_stats).items():
+                if name != 'timestamp' and 0 < stats['count']:
+                    logger.info(
+                        "[SUB] %s: %d trade vol. MarketMomentum: %d. Avg price: %.2f, SD: %.2f, [%.1f - %.1f]",
+                        name, stats['volume'], stats['momentum'], stats['mean'], stats['sd'],
+                        stats['min'], stats['max'])
+            return
+
+        now = datetime.now().astimezone(constants.TIMEZONE)
+        std_datetime = now - timedelta(minutes=30)
+        logger.info("[SUB] StdDateTime: %s", std_datetime.strftime(constants.DATE_FORMAT))
+
+        if self.trades_rollup_reader is not None:
+            # Reads tens of buckets instead of scanning the trades.
+            stats = self.trades_rollup_reader.stats(std_datetime, now)
+            if 0 < stats['count']:
+                logger.info(
+                    "[SUB] %d trade vol. MarketMomentum: %d. Avg price: %.2f, SD: %.2f, [%.1f - %.1f]",
+                    stats['volume'], stats['momentum'], stats['mean'], stats['sd'], stats['low'], stats['high'])
+            return
+
+        if self.partitioned_trades is not None:
+            # Only the partitions overlapping the last 30 minutes are read.
+            self.log_partitioned_trades_stats(std_datetime, now)
+            return
+
+        trades_pipeline = [
+            {'$match':
+                 {'timestamp': {'$gte': std_datetime}}
+             },
+            {'$group':
+                 {'_id': 'null',
+                  'total_volume': {'$sum': '$size'},
+                  'market_momentum': {'$sum': '$momentum'},
+                  'average_price': {'$avg': '$price'},
+                  'sd_of_price': {'$stdDevPop': '$price'},
+                  'min_price': {'$min': '$price'},
+                  'max_price': {'$max': '$price'}
+                  }
+             }
+        ]
+        rows = self.trades_collection.aggregate(pipeline=trades_pipeline)
+        for row in rows:
+            logger.info(
+                "[SUB] %d trade vol. MarketMomentum: %d. Avg price: %.2f, SD: %.2f, [%.1f - %.1f]",
+                row['total_volume'], row['market_momentum'],
+                row['average_price'], row['sd_of_price'], row['min_price'], row['max_price'])
+
+    def log_partitioned_trades_stats(self, start, end):
+        # Sums are merged across partitions, because MongoDB 4.0 cannot aggregate over many collections.
+        trades_pipeline = [
+            {'$match': {'timestamp': {'$gte': start}}},
+            {'$group':
+                 {'_id': 'null',
+                  'total_volume': {'$sum': '$size'},
+                  'market_momentum': {'$sum': '$momentum'},
+                  'count': {'$sum': 1},
+                  'sum_of_price': {'$sum': '$price'},
+                  'sum_of_squared_price': {'$sum': {'$multiply': ['$price', '$price']}},
+                  'min_price': {'$min': '$price'},
+                  'max_price': {'$max': '$price'}
+                  }
+             }
+        ]
+        total = None
+        for collection in self.partitioned_trades.partitions_between(start, end):
+            for row in collection.aggregate(pipeline=trades_pipeline):
+                if total is None:
+                    total = row
+                    continue
+                for key in ('total_volume', 'market_momentum', 'count', 'sum_of_price', 'sum_of_squared_price'):
+                    total[key] += row[key]
+                total['min_price'] = min(total['min_price'], row['min_price'])
+                total['max_price'] = max(total['max_price'], row['max_price'])
+        if total is None:
+            return
+        average_price = total['sum_of_price'] / total['count']
+        sd_of_price = math.sqrt(max(0.0, total['sum_of_squared_price'] / total['count'] - average_price ** 2))
+        logger.info(
+            "[SUB] %d trade vol. MarketMomentum: %d. Avg price: %.2f, SD: %.2f, [%.1f - %.1f]",
+            total['total_volume'], total['market_momentum'],
+            average_price, sd_of_price, total['min_price'], total['max_price'])
+
+    def consume_stream(self):
+        # A consumer group remembers where we stopped, so nothing is missed across restarts.
+        consumer = StreamConsumer(
+            self.redis, symbol_scoped_channel_name(settings.REDIS_ORDER_BOOK_SNAPSHOT_STREAM_NAME, self.symbol),
+            group_name='sample-subscriber', consumer_name=settings.INSTANCE_NAME)
+        heartbeat_key_name = symbol_scoped_channel_name(settings.REDIS_HEARTBEAT_KEY_NAME, self.symbol)
+        while True:
+            try:
+                entries = consumer.read(count=100, block_milliseconds=int(settings.LOOP_INTERVAL * 1000))
+                if 0 < len(entries):
+                    # Only the latest snapshot matters to us.
+                    entry_id, fields = entries[-1]
+                    loaded_snapshot = self.load_order_book_snapshot(fields.get(b'payload', fields[b'id']))
+                    if loaded_snapshot is None:
+                        logger.info("[SUB] Cannot load snapshot for %s" % str(fields[b'id']))
+                    else:
+                        self.on_order_book_snapshot(loaded_snapshot, fields.get(b'tradeStats'))
+                    consumer.ack([each[0] for each in entries])
+                elif not self.redis.exists(heartbeat_key_name):
+                    logger.info("[SUB] The watcher is NOT alive.")
+            except Exception as e:
+                logger.error(e)
+
     def wait_and_load_market_data(self):
+        if settings.REDIS_PUBLISHER == 'stream':
+            self.consume_stream()
+            return
         pubsub = self.redis.pubsub()
-        pubsub.subscribe(settings.REDIS_ORDER_BOOK_SNAPSHOT_ID_CHANNEL_NAME)
+        if settings.REDIS_PUBLISH_MODE == 'payload':
+            channel_name = settings.REDIS_ORDER_BOOK_SNAPSHOT_CHANNEL_NAME
+        else:
+            channel_name = settings.REDIS_ORDER_BOOK_SNAPSHOT_ID_CHANNEL_NAME
+        pubsub.subscribe(symbol_scoped_channel_name(channel_name, self.symbol))
         for message in pubsub.listen():
             try:
                 logger.debug("[SUB] Message arrived from Redis: %s" % str(message))
 
-                raw_order_book_snapshot_id = message.get("data")
-                if raw_order_book_snapshot_id is None or raw_order_book_snapshot_id == 1:
+                data = message.get("data")
+                # '*' is published while the order book does not change.
+                if data is None or data == 1 or data == b'*':
                     continue
 
-                order_book_snapshot_id = raw_order_book_snapshot_id.decode(encoding='utf-8')
-                logger.info("[SUB] Received OrderBookSnapshotID: %s" % order_book_snapshot_id)
-                self.order_book_snapshot_collection.find_one()
-                loaded_snapshot = self.order_book_snapshot_collection.find_one(
-                    {"_id": ObjectId(order_book_snapshot_id)})
+                loaded_snapshot = self.load_order_book_snapshot(data)
                 if loaded_snapshot is None:
-                    logger.info("[SUB] Cannot load snapshot for %s" % order_book_snapshot_id)
+                    logger.info("[SUB] Cannot load snapshot for %s" % str(data))
                     continue
-                # logger.info("[SUB] Loaded from MongoDB: %s", str(loaded_snapshot))
-                logger.info("[SUB] Loaded from MongoDB: %d bids and %d asks",
-                            len(loaded_snapshot['bids']), len(loaded_snapshot['asks']))
-
-                std_datetime = datetime.now().astimezone(constants.TIMEZONE) - timedelta(minutes=30)
-                logger.info("[SUB] StdDateTime: %s", std_datetime.strftime(constants.DATE_FORMAT))
-
-                trades_pipeline = [
-                    {'$match':
-                         {'timestamp': {'$gte': std_datetime}}
-                     },
-                    {'$group':
-                         {'_id': 'null',
-                          'total_volume': {'$sum': '$size'},
-                          'market_momentum': {'$sum': '$momentum'},
-                          'average_price': {'$avg': '$price'},
-                          'sd_of_price': {'$stdDevPop': '$price'},
-                          'min_price': {'$min': '$price'},
-                          'max_price': {'$max': '$price'}
-                          }
-                     }
-                ]
-                rows = self.trades_collection.aggregate(pipeline=trades_pipeline)
-                for row in rows:
-                    logger.info(
-                        "[SUB] %d trade vol. MarketMomentum: %d. Avg price: %.2f, SD: %.2f, [%.1f - %.1f]",
-                        row['total_volume'], row['market_momentum'],
-                        row['average_price'], row['sd_of_price'], row['min_price'], row['max_price'])
+                self.on_order_book_snapshot(loaded_snapshot, self.load_trade_stats())
             except Exception as e:
                 logger.error(e)
 
@@ -81,6 +217,7 @@ def start():
     from time import sleep
     sleep(10)
 
-    subscriber = SampleSubscriber()
+    # The first of SYMBOLS, if many symbols are watched.
+    subscriber = SampleSubscriber(settings.SYMBOLS[0] if settings.SYMBOLS else None)
     executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
     executor.submit(subscriber.wait_and_load_market_data)
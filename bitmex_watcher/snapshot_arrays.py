@@ -0,0 +1,211 @@
+import numpy as np
+
+from bitmex_watcher.models import OrderBookSnapshot, ORDER_BOOK_HEADER, read_order_book_header, _round_float
+
+
+BOARD_PRICE_INTERVAL = OrderBookSnapshot.BOARD_PRICE_INTERVAL
+
+
+def _round_floats(values):
+    # Python's round() is applied element by element, because numpy.round() may round differently.
+    return np.array([_round_float(float(v)) for v in values], dtype=np.float64)
+
+
+def filter_order_books(std_prices, prices, counts, accept_range_ratio):
+    """
+    Vectorized OrderBookSnapshot.filter_order_books.
+    prices is a (num_snapshots, max_levels) array padded beyond counts.
+    Returns the number of leading levels of each row within the accepted range.
+    """
+    allowable_price_diffs = std_prices * accept_range_ratio
+    columns = np.arange(prices.shape[1])
+    is_out_of_range = (allowable_price_diffs[:, None] < np.abs(prices - std_prices[:, None])) |\
+                      (counts[:, None] <= columns[None, :])
+    return np.where(is_out_of_range.any(axis=1), is_out_of_range.argmax(axis=1), prices.shape[1])
+
+
+def calculate_weighed_average_price_from_orders(
+        bid_prices, bid_sizes, num_bids, ask_prices, ask_sizes, num_asks,
+        logical_highest_bids, logical_lowest_asks, logical_nums_boards_of_side
+):
+    """
+    Vectorized OrderBookSnapshot.calculate_weighed_average_price_from_orders over rows of snapshots.
+    The reflected prices are accumulated in the same order as the original (bid, ask, bid, ask, ...),
+    so that the results are identical to the last bit.
+    """
+    logical_mid_prices = (logical_highest_bids + logical_lowest_asks) / 2.0
+    end_indices = logical_nums_boards_of_side
+
+    def weigh(prices, sizes, num_levels, direction):
+        columns = np.arange(prices.shape[1])
+        is_used = (columns[None, :] < num_levels[:, None]) & (columns[None, :] < end_indices[:, None])
+        idx = (direction * (logical_mid_prices[:, None] - prices)) // BOARD_PRICE_INTERVAL
+        price_diffs_to_reflect = ((end_indices[:, None] - 1) - idx) * BOARD_PRICE_INTERVAL
+        if 0 < direction:
+            # Price is biased high by high and large bids.
+            reflected_prices = (logical_mid_prices[:, None] + (BOARD_PRICE_INTERVAL / 2.0)) + price_diffs_to_reflect
+        else:
+            # Price is biased low by low and large asks.
+            reflected_prices = (logical_mid_prices[:, None] - (BOARD_PRICE_INTERVAL / 2.0)) - price_diffs_to_reflect
+        used_sizes = np.where(is_used, sizes, 0)
+        return np.where(is_used, reflected_prices * used_sizes, 0.0), used_sizes.sum(axis=1)
+
+    width = max(bid_prices.shape[1], ask_prices.shape[1])
+    bid_accums, bid_vols = weigh(_pad(bid_prices, width), _pad(bid_sizes, width), num_bids, 1)
+    ask_accums, ask_vols = weigh(_pad(ask_prices, width), _pad(ask_sizes, width), num_asks, -1)
+    # cumsum() adds sequentially, unlike sum() which adds pairwise.
+    interleaved = np.stack([bid_accums, ask_accums], axis=2).reshape(len(logical_mid_prices), 2 * width)
+    accums = interleaved.cumsum(axis=1)[:, -1] if 0 < width else np.zeros(len(logical_mid_prices))
+    accum_vols = bid_vols + ask_vols
+    has_volume = 0 < accum_vols
+    averages = accums / np.where(has_volume, accum_vols, 1)
+    return np.where(has_volume, _round_floats(averages), logical_mid_prices)
+
+
+def _pad(values, width):
+    if values.shape[1] == width:
+        return values
+    return np.pad(values, ((0, 0), (0, width - values.shape[1])), mode='constant')
+
+
+###
+# Contiguous price and size arrays of one order book snapshot.
+##
+class OrderBookArrays:
+
+    def __init__(self, timestamp, bid_prices, bid_sizes, ask_prices, ask_sizes):
+        self.timestamp = timestamp
+        self.bid_prices = np.ascontiguousarray(bid_prices, dtype=np.float64)
+        self.bid_sizes = np.ascontiguousarray(bid_sizes, dtype=np.int64)
+        self.ask_prices = np.ascontiguousarray(ask_prices, dtype=np.float64)
+        self.ask_sizes = np.ascontiguousarray(ask_sizes, dtype=np.int64)
+
+    @staticmethod
+    def from_levels(timestamp, bids, asks):
+        """
+        Creates arrays from sorted lists of {"price": ..., "size": ...} as returned by pybitmex.
+        """
+        return OrderBookArrays(
+            timestamp,
+            [b["price"] for b in bids], [b["size"] for b in bids],
+            [a["price"] for a in asks], [a["size"] for a in asks]
+        )
+
+    @staticmethod
+    def from_document(document):
+        """
+        Creates arrays from a document of the order book snapshots collection.
+        """
+        return OrderBookArrays.from_levels(document['timestamp'], document['bids'], document['asks'])
+
+    @staticmethod
+    def from_bytes(data):
+        """
+        Creates arrays from OrderBookSnapshot.to_bytes(). The size arrays are views of the data, not copies.
+        """
+        header = read_order_book_header(data)
+        num_bids = header['numBids']
+        num_levels = num_bids + header['numAsks']
+        offset = ORDER_BOOK_HEADER.size
+        sizes = np.frombuffer(data, dtype='<i8', count=num_levels, offset=offset)
+        ticks = np.frombuffer(data, dtype='<i4', count=num_levels, offset=offset + 8 * num_levels)
+        prices = np.round(ticks * header['tickSize'], 8)
+        return OrderBookArrays(header['timestamp'], prices[:num_bids], sizes[:num_bids],
+                               prices[num_bids:], sizes[num_bids:])
+
+    def to_levels(self):
+        bids = [{"price": float(p), "size": int(s)} for p, s in zip(self.bid_prices, self.bid_sizes)]
+        asks = [{"price": float(p), "size": int(s)} for p, s in zip(self.ask_prices, self.ask_sizes)]
+        return bids, asks
+
+    def compute_metrics(self, accept_price_range_ratio: float):
+        """
+        Returns the summary values of OrderBookSnapshot as a dict of Python scalars.
+        """
+        metrics = OrderBookArraysBatch.from_arrays([self]).compute_metrics(accept_price_range_ratio)
+        return {k: v[0].item() for k, v in metrics.items()}
+
+
+###
+# Many snapshots stacked into (num_snapshots, max_levels) arrays, padded beyond the level counts.
+##
+class OrderBookArraysBatch:
+
+    def __init__(self, timestamps, bid_prices, bid_sizes, num_bids, ask_prices, ask_sizes, num_asks):
+        self.timestamps = timestamps
+        self.bid_prices = bid_prices
+        self.bid_sizes = bid_sizes
+        self.num_bids = num_bids
+        self.ask_prices = ask_prices
+        self.ask_sizes = ask_sizes
+        self.num_asks = num_asks
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @staticmethod
+    def from_arrays(arrays_list):
+        def stack(values_list, dtype):
+            counts = np.array([len(v) for v in values_list], dtype=np.int64)
+            result = np.zeros((len(values_list), counts.max(initial=0)), dtype=dtype)
+            for i, values in enumerate(values_list):
+                result[i, :len(values)] = values
+            return result, counts
+
+        bid_prices, num_bids = stack([a.bid_prices for a in arrays_list], np.float64)
+        bid_sizes, _ = stack([a.bid_sizes for a in arrays_list], np.int64)
+        ask_prices, num_asks = stack([a.ask_prices for a in arrays_list], np.float64)
+        ask_sizes, _ = stack([a.ask_sizes for a in arrays_list], np.int64)
+        return OrderBookArraysBatch([a.timestamp for a in arrays_list],
+                                    bid_prices, bid_sizes, num_bids, ask_prices, ask_sizes, num_asks)
+
+    @staticmethod
+    def from_documents(documents):
+        """
+        Creates a batch from documents of the order book snapshots collection, e.g. the result of find().
+        """
+        return OrderBookArraysBatch.from_arrays([OrderBookArrays.from_document(d) for d in documents])
+
+    def compute_metrics(self, accept_price_range_ratio: float):
+        """
+        Computes the summary values of OrderBookSnapshot for all the snapshots at once.
+        Returns a dict of arrays keyed by the attribute names of OrderBookSnapshot.
+        """
+        rows = np.arange(len(self))
+        mid_prices = _round_floats((self.bid_prices[:, 0] + self.ask_prices[:, 0]) / 2)
+
+        num_bids = filter_order_books(mid_prices, self.bid_prices, self.num_bids, accept_price_range_ratio)
+        num_asks = filter_order_books(mid_prices, self.ask_prices, self.num_asks, accept_price_range_ratio)
+
+        def total_volumes(sizes, counts):
+            return np.where(np.arange(sizes.shape[1])[None, :] < counts[:, None], sizes, 0).sum(axis=1)
+
+        bids_volumes = total_volumes(self.bid_sizes, num_bids)
+        asks_volumes = total_volumes(self.ask_sizes, num_asks)
+        total_volumes = bids_volumes + asks_volumes
+
+        price_ranges_for_side = (mid_prices * accept_price_range_ratio) + (BOARD_PRICE_INTERVAL / 2)
+        prices_from_depth = calculate_weighed_average_price_from_orders(
+            self.bid_prices, self.bid_sizes, num_bids, self.ask_prices, self.ask_sizes, num_asks,
+            mid_prices - (BOARD_PRICE_INTERVAL / 2),
+            mid_prices + (BOARD_PRICE_INTERVAL / 2),
+            (price_ranges_for_side / BOARD_PRICE_INTERVAL).astype(np.int64)
+        )
+        has_volume = 0 < total_volumes
+        bids_ratios = np.where(has_volume, _round_floats(bids_volumes / np.where(has_volume, total_volumes, 1)), -1)
+
+        return {
+            'mid_price': mid_prices,
+            'price_from_depth': prices_from_depth,
+            'depth_bias': _round_floats(prices_from_depth - mid_prices),
+            'bids_ratio': bids_ratios,
+            'total_volume': total_volumes,
+
+            'highest_bid': self.bid_prices[:, 0],
+            'lowest_bid': self.bid_prices[rows, num_bids - 1],
+            'bids_volume': bids_volumes,
+
+            'lowest_ask': self.ask_prices[:, 0],
+            'highest_ask': self.ask_prices[rows, num_asks - 1],
+            'asks_volume': asks_volumes
+        }
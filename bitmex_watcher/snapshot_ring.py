@@ -0,0 +1,163 @@
+import os
+import mmap
+import struct
+
+
+RING_MAGIC = b'BWRB'
+RING_VERSION = 1
+
+# magic, version, the number of slots, bytes of a slot, and the number of the last snapshot written (0 if none).
+RING_HEADER = struct.Struct('<4sIIIQ')
+# Offset of the last number in the header, which is updated on every write.
+_LAST_NUMBER_OFFSET = 16
+# Sequence lock (odd while the slot is being written), the number of the snapshot and its length in bytes.
+SLOT_HEADER = struct.Struct('<QQI4x')
+_LOCK = struct.Struct('<Q')
+
+# Attempts to read a slot which keeps being written, before giving up.
+_MAX_READ_ATTEMPTS = 100
+
+
+def ring_file_size(num_slots, slot_bytes):
+    return RING_HEADER.size + num_slots * (SLOT_HEADER.size + slot_bytes)
+
+
+###
+# A file of fixed-size slots to which the watcher writes order book snapshots (in the binary wire format)
+# one after another, overwriting the oldest. Processes on the same host map the file and read the latest
+# snapshots without going through MongoDB or Redis. See SnapshotRingReader.
+#
+# Snapshots are numbered from 1. Each slot has a sequence lock, which is odd while the slot is being written,
+# so that readers detect torn reads and retry instead of taking locks. There must be one writer per file.
+# Put the file on tmpfs (e.g. /dev/shm) so that writes never wait for the disk.
+##
+class SnapshotRingWriter:
+
+    def __init__(self, path, num_slots, slot_bytes):
+        self.path = path
+        self.num_slots = num_slots
+        self.slot_bytes = slot_bytes
+        size = ring_file_size(num_slots, slot_bytes)
+        # Created again on every start, because the number of the last snapshot starts over.
+        # The file of the previous start is replaced, not truncated, so that its readers keep a valid mapping
+        # until they find the new file.
+        temp_path = '{}.{:d}.tmp'.format(path, os.getpid())
+        fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.buffer = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.last_number = 0
+        RING_HEADER.pack_into(self.buffer, 0, RING_MAGIC, RING_VERSION, num_slots, slot_bytes, self.last_number)
+        os.replace(temp_path, path)
+
+    def write(self, data):
+        """
+        Writes a snapshot encoded by OrderBookSnapshot.to_bytes(). Returns its number.
+        """
+        if self.slot_bytes < len(data):
+            raise ValueError("A snapshot of {:d} bytes does not fit in a slot of {:d} bytes."
+                             .format(len(data), self.slot_bytes))
+        number = self.last_number + 1
+        offset = RING_HEADER.size + ((number - 1) % self.num_slots) * (SLOT_HEADER.size + self.slot_bytes)
+        lock = _LOCK.unpack_from(self.buffer, offset)[0]
+        _LOCK.pack_into(self.buffer, offset, lock + 1)
+        SLOT_HEADER.pack_into(self.buffer, offset, lock + 1, number, len(data))
+        data_offset = offset + SLOT_HEADER.size
+        self.buffer[data_offset:data_offset + len(data)] = data
+        _LOCK.pack_into(self.buffer, offset, lock + 2)
+        # Published after the slot is complete.
+        struct.pack_into('<Q', self.buffer, _LAST_NUMBER_OFFSET, number)
+        self.last_number = number
+        return number
+
+    def close(self):
+        self.buffer.close()
+
+
+###
+# Reads the snapshots written by SnapshotRingWriter to a file on the same host.
+#
+# A restarted writer replaces the file. The reader maps the new one when last_number() finds it,
+# and the numbers start over from it. generation counts the files mapped so far.
+##
+class SnapshotRingReader:
+
+    def __init__(self, path):
+        self.path = path
+        self.buffer = None
+        self.file_id = None
+        self.generation = 0
+        self.remap()
+
+    def remap(self):
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, num_slots, slot_bytes, _ = RING_HEADER.unpack_from(buffer)
+        if magic != RING_MAGIC:
+            buffer.close()
+            raise ValueError("Not a snapshot ring file: {}".format(self.path))
+        if version != RING_VERSION:
+            buffer.close()
+            raise ValueError("Unsupported snapshot ring version: {:d}".format(version))
+        if self.buffer is not None:
+            self.buffer.close()
+        self.buffer, self.num_slots, self.slot_bytes = buffer, num_slots, slot_bytes
+        self.file_id = (stat.st_dev, stat.st_ino)
+        self.generation += 1
+
+    def is_replaced(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_dev, stat.st_ino) != self.file_id
+
+    def last_number(self):
+        """
+        Returns the number of the latest snapshot, or 0 if none has been written.
+        Maps the file again first if the writer has replaced it.
+        """
+        if self.is_replaced():
+            self.remap()
+        return struct.unpack_from('<Q', self.buffer, _LAST_NUMBER_OFFSET)[0]
+
+    def read(self, number):
+        """
+        Returns the bytes of the snapshot of the number, or None if it has been overwritten (or not written yet).
+        Decode them with OrderBookSnapshot.from_bytes(), OrderBookArrays.from_bytes() or parse_order_book_bytes().
+        """
+        if number <= 0:
+            return None
+        offset = RING_HEADER.size + ((number - 1) % self.num_slots) * (SLOT_HEADER.size + self.slot_bytes)
+        data_offset = offset + SLOT_HEADER.size
+        for _ in range(_MAX_READ_ATTEMPTS):
+            lock, slot_number, length = SLOT_HEADER.unpack_from(self.buffer, offset)
+            if lock % 2 == 1:
+                continue
+            if slot_number != number:
+                return None
+            data = self.buffer[data_offset:data_offset + length]
+            if _LOCK.unpack_from(self.buffer, offset)[0] == lock:
+                return data
+        return None
+
+    def read_latest(self, count=1):
+        """
+        Returns [(number, bytes), ...] of up to count latest snapshots, the newest first.
+        """
+        result = []
+        number = self.last_number()
+        while 0 < number and len(result) < count:
+            data = self.read(number)
+            if data is None:
+                # Overwritten while we were reading the newer ones.
+                break
+            result.append((number, data))
+            number -= 1
+        return result
+
+    def close(self):
+        self.buffer.close()
@@ -0,0 +1,169 @@
+import pymongo
+from bson.binary import Binary
+from bson.objectid import ObjectId
+
+from bitmex_watcher.models import OrderBookSnapshot
+
+
+KEYFRAME = 'keyframe'
+DELTA = 'delta'
+BINARY = 'binary'
+
+
+def to_binary_document(order_book_snapshot, tick_size):
+    """
+    Returns a document holding the snapshot in the binary wire format.
+    The timestamp is kept as a field of its own for the index.
+    """
+    return {
+        'timestamp': order_book_snapshot.timestamp,
+        'type': BINARY,
+        'data': Binary(order_book_snapshot.to_bytes(tick_size))
+    }
+
+
+def rebuild_levels(keyframe, deltas):
+    """
+    Applies delta documents (in the order of 'seq') to a keyframe document.
+    Returns (bids, asks) sorted in the same way as OrderBookSnapshot.
+    """
+    bids = {each["price"]: each["size"] for each in keyframe['bids']}
+    asks = {each["price"]: each["size"] for each in keyframe['asks']}
+
+    def apply(levels, changes):
+        for each in changes:
+            if each["size"] == 0:
+                levels.pop(each["price"], None)
+            else:
+                levels[each["price"]] = each["size"]
+
+    for delta in deltas:
+        apply(bids, delta['bidsChanges'])
+        apply(asks, delta['asksChanges'])
+    return ([{"price": p, "size": bids[p]} for p in sorted(bids, reverse=True)],
+            [{"price": p, "size": asks[p]} for p in sorted(asks)])
+
+
+###
+# Encodes order book snapshots into a keyframe (the whole snapshot) every N snapshots or seconds,
+# and into small documents of changed levels in between.
+##
+class OrderBookSnapshotEncoder:
+
+    def __init__(self, keyframe_interval_snapshots, keyframe_interval_seconds):
+        self.keyframe_interval_snapshots = keyframe_interval_snapshots
+        self.keyframe_interval_seconds = keyframe_interval_seconds
+        self.keyframe_id = None
+        self.keyframe_timestamp = None
+        self.keyframe_partition = None
+        self.seq = 0
+
+    def _is_keyframe_due(self, timestamp, partition):
+        if self.keyframe_id is None or partition != self.keyframe_partition:
+            return True
+        if self.keyframe_interval_snapshots <= self.seq + 1:
+            return True
+        return self.keyframe_interval_seconds <= (timestamp - self.keyframe_timestamp).total_seconds()
+
+    def encode(self, order_book_snapshot, order_book_changes, partition=None):
+        """
+        Returns a document to be inserted in the order book snapshots collection.
+        order_book_changes must be the changes from the snapshot encoded last time.
+        The document already has its '_id', because deltas refer to the id of their keyframe.
+        A new partition (the name of the collection, if they are partitioned) starts with a keyframe,
+        so that deltas are always in the same collection as their keyframe.
+        """
+        document = order_book_snapshot.to_summary_dict()
+        document['_id'] = ObjectId()
+        if self._is_keyframe_due(order_book_snapshot.timestamp, partition):
+            self.keyframe_id = document['_id']
+            self.keyframe_timestamp = order_book_snapshot.timestamp
+            self.keyframe_partition = partition
+            self.seq = 0
+            document.update({
+                'type': KEYFRAME,
+                'bids': order_book_snapshot.bids,
+                'asks': order_book_snapshot.asks
+            })
+        else:
+            self.seq += 1
+            document.update({
+                'type': DELTA,
+                'bidsChanges': order_book_changes.bids,
+                'asksChanges': order_book_changes.asks
+            })
+        document.update({'keyframeId': self.keyframe_id, 'seq': self.seq})
+        return document
+
+
+###
+# Loads order book snapshots, rebuilding the levels of delta documents from their keyframes.
+# Binary documents are decoded. Other documents (the whole snapshot in each) are returned as they are.
+# With a TimePartitionedCollection, only the partitions which may hold the snapshot are read.
+##
+class OrderBookSnapshotReader:
+
+    def __init__(self, order_book_snapshot_collection, partitioned_collection=None):
+        self.collection = order_book_snapshot_collection
+        self.partitioned_collection = partitioned_collection
+
+    @staticmethod
+    def create_indices(order_book_snapshot_collection):
+        return order_book_snapshot_collection.create_index(
+            [("keyframeId", pymongo.ASCENDING), ("seq", pymongo.ASCENDING)])
+
+    def load_by_id(self, order_book_snapshot_id):
+        if self.partitioned_collection is None:
+            collections = [self.collection]
+        else:
+            collections = self.partitioned_collection.partitions_for_id(order_book_snapshot_id)
+        for collection in collections:
+            document = collection.find_one({"_id": ObjectId(order_book_snapshot_id)})
+            if document is not None:
+                return self.rebuild(document, collection)
+        return None
+
+    def load_at(self, timestamp):
+        """
+        Returns the order book as of the given timestamp, or None if it is not stored (any more).
+        Partitions are read back to the one before the timestamp at most.
+        """
+        if self.partitioned_collection is None:
+            collections = [self.collection]
+        else:
+            collections = self.partitioned_collection.partitions_before(timestamp, 2)
+        for collection in collections:
+            document = collection.find_one({"timestamp": {"$lte": timestamp}},
+                                           sort=[("timestamp", pymongo.DESCENDING)])
+            if document is not None:
+                return self.rebuild(document, collection)
+        return None
+
+    def rebuild(self, document, collection=None):
+        """
+        collection is where the document was found. Deltas are in the same collection as their keyframe.
+        """
+        if document is not None and document.get('type') == BINARY:
+            result = OrderBookSnapshot.from_bytes(document['data']).to_dict()
+            result['_id'] = document['_id']
+            return result
+        if document is None or document.get('type') != DELTA:
+            return document
+        if collection is None:
+            collection = self.collection
+        keyframe = collection.find_one({"_id": document['keyframeId']})
+        if keyframe is None:
+            # The keyframe has been removed from the capped collection.
+            return None
+        deltas = collection.find(
+            {"keyframeId": document['keyframeId'], "seq": {"$gt": 0, "$lte": document['seq']}}
+        ).sort("seq", pymongo.ASCENDING)
+        deltas = list(deltas)
+        if len(deltas) != document['seq']:
+            return None
+        bids, asks = rebuild_levels(keyframe, deltas)
+        result = dict(document)
+        for key in ('bidsChanges', 'asksChanges'):
+            result.pop(key)
+        result.update({'bids': bids, 'asks': asks})
+        return result
@@ -0,0 +1,61 @@
+import threading
+from datetime import datetime, timezone
+
+from dateutil.parser import parse
+from pybitmex import Trade
+
+
+BITMEX_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+def parse_timestamp(s):
+    try:
+        # Much faster than dateutil for the format BitMEX always uses.
+        return datetime.strptime(s, BITMEX_TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+    except ValueError:
+        return parse(s).astimezone(timezone.utc)
+
+
+def to_trade_object(row):
+    return Trade(row["trdMatchID"], parse_timestamp(row["timestamp"]), row["side"],
+                 float(row["price"]), int(row["size"]))
+
+
+###
+# Collects the trades appended to the websocket 'trade' table,
+# so that the watcher only reads the trades which arrived since the last capture
+# instead of re-sorting and re-scanning the whole recent trades table.
+##
+class TradeStream:
+
+    def __init__(self, symbol=None, table_name='trade'):
+        self.symbol = symbol
+        self.table_name = table_name
+        self._rows = []
+        self._lock = threading.Lock()
+
+    def on_message(self, message):
+        """
+        Listener for WsMessageDispatcher. Only keeps the raw rows; they are converted when drained.
+        """
+        if message.get('table') != self.table_name or message.get('action') not in ('partial', 'insert'):
+            return
+        self.append(message.get('data', []))
+
+    def append(self, rows):
+        with self._lock:
+            self._rows.extend(rows)
+
+    def drain(self):
+        """
+        Returns the trades appended since the last call, sorted by (timestamp, trdMatchID) and without duplicates.
+        """
+        with self._lock:
+            rows, self._rows = self._rows, []
+        trades = {}
+        for row in rows:
+            if self.symbol is None or row.get('symbol', self.symbol) == self.symbol:
+                trades[row["trdMatchID"]] = row
+        result = [to_trade_object(row) for row in trades.values()]
+        result.sort(key=lambda t: (t.timestamp, t.trd_match_id))
+        return result
@@ -0,0 +1,167 @@
+import json
+import math
+from collections import deque
+from datetime import timedelta
+
+from bitmex_watcher.models import TradesCursor
+from bitmex_watcher.rollups import interval_name
+
+
+###
+# Volume, momentum, VWAP, mean and standard deviation (population, per trade) of prices, min and max
+# of the trades in the last `seconds`, kept current as trades come in and go out of the window.
+#
+# Sums are updated on both ends, and min/max come from monotonic deques, so a trade costs O(1) amortized
+# to add and to expire, however long the window is.
+# Prices are summed relative to the first price in the window, which keeps the sum of squares small;
+# the sums start over whenever the window becomes empty.
+##
+class TradeWindow:
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.length = timedelta(seconds=seconds)
+        # (sequence number, timestamp, price, size, momentum) in the order of arrival.
+        self.trades = deque()
+        # (sequence number, price) with decreasing (max) or increasing (min) prices.
+        self.max_prices = deque()
+        self.min_prices = deque()
+        self.sequence = 0
+        self.origin = None
+        self._reset_sums()
+
+    def _reset_sums(self):
+        self.volume = 0
+        self.momentum = 0
+        self.turnover = 0.0
+        self.price_sum = 0.0
+        self.price_square_sum = 0.0
+
+    def add(self, trade):
+        if self.origin is None:
+            self.origin = trade.price
+        sequence = self.sequence
+        self.sequence += 1
+        self.trades.append((sequence, trade.timestamp, trade.price, trade.size, trade.momentum))
+        self.volume += trade.size
+        self.momentum += trade.momentum
+        self.turnover += trade.price * trade.size
+        relative_price = trade.price - self.origin
+        self.price_sum += relative_price
+        self.price_square_sum += relative_price * relative_price
+        while self.max_prices and self.max_prices[-1][1] <= trade.price:
+            self.max_prices.pop()
+        self.max_prices.append((sequence, trade.price))
+        while self.min_prices and trade.price <= self.min_prices[-1][1]:
+            self.min_prices.pop()
+        self.min_prices.append((sequence, trade.price))
+
+    def expire(self, now):
+        """
+        Removes the trades at or before now - seconds.
+        """
+        since = now - self.length
+        while self.trades and self.trades[0][1] <= since:
+            sequence, _, price, size, momentum = self.trades.popleft()
+            self.volume -= size
+            self.momentum -= momentum
+            self.turnover -= price * size
+            relative_price = price - self.origin
+            self.price_sum -= relative_price
+            self.price_square_sum -= relative_price * relative_price
+            if self.max_prices[0][0] == sequence:
+                self.max_prices.popleft()
+            if self.min_prices[0][0] == sequence:
+                self.min_prices.popleft()
+        if not self.trades:
+            # Nothing is left to drift.
+            self.origin = None
+            self._reset_sums()
+
+    @property
+    def count(self):
+        return len(self.trades)
+
+    @property
+    def vwap(self):
+        return self.turnover / self.volume if 0 < self.volume else None
+
+    @property
+    def mean(self):
+        return self.origin + self.price_sum / self.count if 0 < self.count else None
+
+    @property
+    def sd(self):
+        if self.count == 0:
+            return None
+        relative_mean = self.price_sum / self.count
+        # Rounding may take the variance slightly below zero.
+        return math.sqrt(max(0.0, self.price_square_sum / self.count - relative_mean * relative_mean))
+
+    @property
+    def min(self):
+        return self.min_prices[0][1] if self.min_prices else None
+
+    @property
+    def max(self):
+        return self.max_prices[0][1] if self.max_prices else None
+
+    def to_dict(self):
+        return {
+            'volume': self.volume,
+            'momentum': self.momentum,
+            'vwap': self.vwap,
+            'mean': self.mean,
+            'sd': self.sd,
+            'min': self.min,
+            'max': self.max,
+            'count': self.count
+        }
+
+
+###
+# Windows of several lengths fed with the same trades.
+##
+class TradeWindows:
+
+    def __init__(self, windows_seconds):
+        self.windows = [TradeWindow(seconds) for seconds in sorted(windows_seconds)]
+        # Trades up to this cursor are already in the windows.
+        self.cursor = None
+
+    @property
+    def longest_seconds(self):
+        return self.windows[-1].seconds
+
+    def add(self, trades):
+        """
+        Adds trades sorted by (timestamp, trdMatchID). Trades up to the last one added are skipped.
+        """
+        for trade in trades:
+            if self.cursor is not None and not self.cursor.is_behind_of(trade):
+                continue
+            for window in self.windows:
+                window.add(trade)
+            self.cursor = TradesCursor(trade.timestamp, trade.trd_match_id)
+
+    def expire(self, now):
+        for window in self.windows:
+            window.expire(now)
+
+    def to_dict(self, now):
+        """
+        Returns {"1m": TradeWindow.to_dict(), "5m": ..., "timestamp": now} as of now.
+        """
+        self.expire(now)
+        result = {interval_name(window.seconds): window.to_dict() for window in self.windows}
+        result['timestamp'] = now.isoformat()
+        return result
+
+    def to_payload(self, now):
+        return json.dumps(self.to_dict(now), separators=(',', ':'))
+
+
+def parse_trade_stats_payload(payload):
+    if isinstance(payload, bytes):
+        payload = payload.decode(encoding='utf-8')
+    return json.loads(payload)
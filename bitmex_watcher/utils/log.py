@@ -1,5 +1,7 @@
+import queue
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from bitmex_watcher.settings import settings
 
 
@@ -8,10 +10,58 @@ def setup_custom_logger(name, log_level=settings.LOG_LEVEL):
     logger = logging.getLogger(name)
     logger.setLevel(log_level)
 
-    if 0 < len(settings.LOG_FILE_NAME):
+    # Every module sets up the same logger. The file is only opened once.
+    if 0 < len(settings.LOG_FILE_NAME) and not _has_handler(logger, RotatingFileHandler):
         rotating_handler = RotatingFileHandler(settings.LOG_FILE_NAME, maxBytes=10000000, backupCount=5)
         formatter = logging.Formatter(fmt='%(asctime)s - %(levelname)s - %(module)s - %(message)s')
         rotating_handler.setFormatter(formatter)
         logger.addHandler(rotating_handler)
 
+    if settings.LOG_MODE == 'production':
+        for each in {logging.getLogger(), logger}:
+            use_queue_handler(each)
+
     return logger
+
+
+def _has_handler(logger, handler_class):
+    return any(isinstance(h, handler_class) for h in logger.handlers)
+
+
+###
+# Puts records on a queue as they are. Unlike QueueHandler, the message is not formatted here,
+# so that neither formatting nor I/O is done on the thread which logs.
+##
+class DeferredQueueHandler(QueueHandler):
+
+    def prepare(self, record):
+        if record.exc_info:
+            # Tracebacks do not outlive the frames they refer to. Formatted now.
+            return super(DeferredQueueHandler, self).prepare(record)
+        return record
+
+
+def use_queue_handler(logger):
+    """
+    Moves the handlers of the logger to a background thread, which they are fed through a queue.
+    Records are formatted and written there. Arguments of log calls must not be modified after the calls.
+    """
+    if _has_handler(logger, QueueHandler) or len(logger.handlers) == 0:
+        return None
+    handlers = list(logger.handlers)
+    # Unbounded. queue.SimpleQueue is only in Python 3.7+.
+    records = queue.Queue(-1)
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    for each in handlers:
+        logger.removeHandler(each)
+    logger.addHandler(DeferredQueueHandler(records))
+    listener.start()
+    # Records left in the queue are written on exit.
+    atexit.register(_stop_listener, listener)
+    return listener
+
+
+def _stop_listener(listener):
+    # Unless stopped already.
+    if listener._thread is not None:
+        listener.stop()
@@ -1,55 +1,255 @@
 from __future__ import absolute_import
 
 import sys
+import queue
 import atexit
 import signal
+import threading
 
-from time import sleep
-from datetime import datetime
+from collections import deque
+from time import sleep, monotonic, perf_counter
+from datetime import datetime, timedelta
 
 import logging
 
 import pymongo
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+from bson.objectid import ObjectId
 import redis
 
 from pybitmex import *
 
 from bitmex_watcher.models import *
+from bitmex_watcher.order_book import IncrementalOrderBook
+from bitmex_watcher.trade_stream import TradeStream
+from bitmex_watcher.backfill import TradesBackfiller, create_rest_client
+from bitmex_watcher.leader_lease import LeaderLease, unique_instance_id
+from bitmex_watcher.metrics import WatcherMetrics, MetricsServer
+from bitmex_watcher.mongo_writer import MongoWriter, DUPLICATE_KEY_ERROR
+from bitmex_watcher.multiplex import MultiplexedWebSocketClient, SymbolBitMEXClient, SymbolRouter
+from bitmex_watcher.partitions import TimePartitionedCollection
+from bitmex_watcher.reconnect import WsReconnector
+from bitmex_watcher.redis_streams import StreamPublisher
+from bitmex_watcher.rollups import RollupBucket, TradeRollups, floor_timestamp, rollup_collection_name
+from bitmex_watcher.snapshot_ring import SnapshotRingWriter
+from bitmex_watcher.snapshot_store import OrderBookSnapshotEncoder, OrderBookSnapshotReader, to_binary_document
+from bitmex_watcher.trade_windows import TradeWindows
 from bitmex_watcher.settings import settings
 from bitmex_watcher.utils import log, constants, errors
+from bitmex_watcher.ws_events import WsMessageDispatcher, WsMessageRecorder
 
 
 logger = log.setup_custom_logger('root')
 
+# The order of trades, as the cursor compares them.
+TRADES_SORT = [("timestamp", pymongo.ASCENDING), ("trdMatchID", pymongo.ASCENDING)]
+
+
+def symbol_scoped_name(name, symbol):
+    return name if symbol is None else "{}_{}".format(name, symbol)
+
+
+def symbol_scoped_channel_name(channel_name, symbol):
+    return channel_name if symbol is None else "{}:{}".format(channel_name, symbol)
+
+
+def is_partitioned():
+    return settings.STORAGE_PARTITIONING != 'none'
+
+
+def is_ws_dispatcher_required():
+    return settings.CAPTURE_MODE == 'event' or settings.ORDER_BOOK_SOURCE == 'incremental' or\
+        settings.TRADES_SOURCE == 'stream' or bool(settings.WS_RECORD_PATH)
+
 
 class MarketWatcher:
 
-    def __init__(self):
+    MARKET_CLOSED_WAIT_SECONDS = 1.0
+
+    def __init__(self, symbol=None, bitmex_client=None, mongo_client=None, redis_client=None, ws_dispatcher=None):
+        """
+        Clients are created for this watcher unless given.
+        Given clients are shared with other watchers, so this watcher never closes them.
+        """
         self.instance_name = settings.INSTANCE_NAME
+        self.symbol = symbol or settings.SYMBOL
+        self.owns_clients = bitmex_client is None
+
+        # Names of collections and channels. They are suffixed with the symbol when many symbols are watched.
+        self.trades_collection_name = symbol_scoped_name(settings.TRADES_COLLECTION, symbol)
+        self.trades_cursor_collection_name = symbol_scoped_name(settings.TRADES_CURSOR_COLLECTION, symbol)
+        self.order_book_snapshots_collection_name = symbol_scoped_name(settings.ORDER_BOOK_SNAPSHOTS_COLLECTION, symbol)
+        self.order_book_snapshot_id_channel_name = symbol_scoped_channel_name(
+            settings.REDIS_ORDER_BOOK_SNAPSHOT_ID_CHANNEL_NAME, symbol)
+        self.order_book_snapshot_channel_name = symbol_scoped_channel_name(
+            settings.REDIS_ORDER_BOOK_SNAPSHOT_CHANNEL_NAME, symbol)
+        self.trades_channel_name = symbol_scoped_channel_name(settings.REDIS_TRADES_CHANNEL_NAME, symbol)
+        self.trade_stats_channel_name = symbol_scoped_channel_name(settings.REDIS_TRADE_STATS_CHANNEL_NAME, symbol)
+        self.metrics_key_name = symbol_scoped_channel_name(settings.REDIS_METRICS_KEY_NAME, symbol)
 
         # Client to the BitMex exchange.
-        logger.info("Connecting to BitMEX exchange: %s %s %s",
-                    settings.BASE_URL, settings.SYMBOL, settings.MARKET_ORDER_BOOK_DATA_NAME)
-        self.bitmex_client = BitMEXClient(
-            settings.BASE_URL, settings.SYMBOL,
-            api_key=None, api_secret=None,
-            use_websocket=True, use_rest=False,
-            subscriptions=["instrument", settings.MARKET_ORDER_BOOK_DATA_NAME, "trade"]
-        )
+        if bitmex_client is None:
+            logger.info("Connecting to BitMEX exchange: %s %s %s",
+                        settings.BASE_URL, self.symbol, settings.MARKET_ORDER_BOOK_DATA_NAME)
+            bitmex_client = BitMEXClient(
+                settings.BASE_URL, self.symbol,
+                api_key=None, api_secret=None,
+                use_websocket=True, use_rest=False,
+                subscriptions=["instrument", settings.MARKET_ORDER_BOOK_DATA_NAME, "trade"]
+            )
+        self.bitmex_client = bitmex_client
 
         # MongoDB client.
-        logger.info("Connecting to %s" % settings.MONGO_DB_URI)
-        self.mongo_client = pymongo.MongoClient(settings.MONGO_DB_URI)
+        if mongo_client is None:
+            logger.info("Connecting to %s" % settings.MONGO_DB_URI)
+            mongo_client = pymongo.MongoClient(settings.MONGO_DB_URI)
+        self.mongo_client = mongo_client
         self.bitmex_db = self.mongo_client[settings.BITMEX_DB]
         # Create indices and set caps to collections.
         self._initialize_db_scheme()
         # Collections to save data in.
-        self.trades_collection = self.bitmex_db[settings.TRADES_COLLECTION]
-        self.order_book_snapshot_collection = self.bitmex_db[settings.ORDER_BOOK_SNAPSHOTS_COLLECTION]
-        self.trades_cursor_collection = self.bitmex_db[settings.TRADES_CURSOR_COLLECTION]
+        self.trades_collection = self.bitmex_db[self.trades_collection_name]
+        self.order_book_snapshot_collection = self.bitmex_db[self.order_book_snapshots_collection_name]
+        self.trades_cursor_collection = self.bitmex_db[self.trades_cursor_collection_name]
+        # Trades and order book snapshots in a collection per day or hour, if enabled.
+        self.partitioned_trades = None
+        self.partitioned_order_book_snapshots = None
+        if is_partitioned():
+            self.partitioned_trades = TimePartitionedCollection(
+                self.bitmex_db, self.trades_collection_name, settings.STORAGE_PARTITIONING,
+                self.initialize_trades_partition)
+            self.partitioned_order_book_snapshots = TimePartitionedCollection(
+                self.bitmex_db, self.order_book_snapshots_collection_name, settings.STORAGE_PARTITIONING,
+                self.initialize_order_book_snapshots_partition)
+        # Writes keyframes and level diffs instead of whole snapshots.
+        self.order_book_snapshot_encoder = None
+        if settings.ORDER_BOOK_STORAGE_MODE == 'delta':
+            self.order_book_snapshot_encoder = OrderBookSnapshotEncoder(
+                settings.KEYFRAME_INTERVAL_SNAPSHOTS, settings.KEYFRAME_INTERVAL_SECONDS)
+        # Rollups of trades by intervals, if enabled.
+        self.trades_rollups = None
+        self.trades_rollup_collections = {}
+        if settings.TRADES_ROLLUPS:
+            self.trades_rollups = TradeRollups([interval for interval, _ in settings.TRADES_ROLLUPS])
+            self.trades_rollup_collections = {
+                interval: self.bitmex_db[symbol_scoped_name(
+                    rollup_collection_name(settings.TRADES_ROLLUP_COLLECTION, interval), symbol)]
+                for interval, _ in settings.TRADES_ROLLUPS
+            }
+        self._create_indices()
+        # Sliding windows of trade statistics, if enabled.
+        self.trade_windows = None
+        if settings.TRADE_WINDOWS:
+            self.trade_windows = TradeWindows(settings.TRADE_WINDOWS)
+
+        # Writes to MongoDB in the background, if enabled.
+        self.mongo_writer = self._create_mongo_writer()
+        # Fetches the trades missed by the websocket from the REST API, if enabled.
+        # Pages of them are handed to the capture thread, which owns the partitions and the rollups.
+        self.backfilled_trades = queue.Queue()
+        self.trades_backfiller = None
+        if settings.TRADES_BACKFILL:
+            self.trades_backfiller = self._create_trades_backfiller()
 
         # Redis client.
-        self.redis = redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+        if redis_client is None:
+            redis_client = redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+        self.redis = redis_client
+        # Publishes to Redis Streams instead of the channels, if enabled.
+        self.stream_publisher = None
+        if settings.REDIS_PUBLISHER == 'stream':
+            self.stream_publisher = StreamPublisher(
+                symbol_scoped_channel_name(settings.REDIS_ORDER_BOOK_SNAPSHOT_STREAM_NAME, symbol),
+                symbol_scoped_channel_name(settings.REDIS_TRADES_STREAM_NAME, symbol),
+                symbol_scoped_channel_name(settings.REDIS_HEARTBEAT_KEY_NAME, symbol),
+                settings.REDIS_STREAM_MAX_LEN, settings.LOOP_INTERVAL * 3)
+        # Only the holder of the lease saves and publishes, if enabled. The others are standbys.
+        self.leader_lease = None
+        if settings.LEADER_ELECTION:
+            self.leader_lease = self._create_leader_lease()
+
+        # Order book snapshots for readers on the same host, if enabled.
+        self.snapshot_ring = None
+        if settings.ORDER_BOOK_RING_PATH:
+            self.snapshot_ring = SnapshotRingWriter(symbol_scoped_name(settings.ORDER_BOOK_RING_PATH, symbol),
+                                                    settings.ORDER_BOOK_RING_SLOTS, settings.ORDER_BOOK_RING_SLOT_BYTES)
+
+        # Notified of every websocket update in the event-driven capture mode.
+        if ws_dispatcher is None:
+            ws_dispatcher = WsMessageDispatcher()
+            if is_ws_dispatcher_required():
+                ws_dispatcher.attach(self.bitmex_client.ws_client)
+        self.ws_dispatcher = ws_dispatcher
+        # Replaces a stale websocket in the process instead of exiting, if enabled.
+        # Watchers of a shared websocket are given the reconnector of its owner.
+        self.ws_reconnector = None
+        if self.owns_clients and settings.STALE_FEED_POLICY == 'reconnect':
+            self.ws_reconnector = self._create_ws_reconnector()
+        # Websocket messages recorded to be replayed, if enabled.
+        self.ws_recorder = None
+        if settings.WS_RECORD_PATH:
+            self.ws_recorder = WsMessageRecorder(symbol_scoped_name(settings.WS_RECORD_PATH, symbol))
+            self.ws_dispatcher.add_listener(self.ws_recorder.on_message)
+        # Order book maintained from websocket deltas.
+        self.order_book = None
+        if settings.ORDER_BOOK_SOURCE == 'incremental':
+            self.order_book = self._create_incremental_order_book()
+        # Trades appended since the last capture.
+        self.trade_stream = None
+        if settings.TRADES_SOURCE == 'stream':
+            self.trade_stream = TradeStream(self.symbol)
+            self.ws_dispatcher.add_listener(self.trade_stream.on_message)
+            # Trades both in the table and in the stream are returned only once.
+            self.trade_stream.append(list(self.bitmex_client.ws_raw_recent_trades_of_market()))
+
+        # Prices are encoded in ticks in the binary wire format. Read from the instrument when first needed.
+        self.tick_size = None
+
+        # State of the capture loop.
+        self.trades_cursor = None
+        self.saved_trades_cursor = None
+        self.trades_batches_since_checkpoint = 0
+        self.last_checkpoint_time = self.clock()
+        # With the MongoWriter, a cursor is saved once its batch of trades and every batch before it are written.
+        # [[the number of trades of the batch not written yet, the cursor of the batch or None], ...]
+        self.pending_trades_batches = deque()
+        # Set when a trade fails to be written or is dropped. No cursor is saved after it.
+        self.is_trades_write_failed = False
+        self.trades_cursor_lock = threading.Lock()
+        self.order_book_snapshot = None
+        self.order_book_version = None
+        self.orders_idle_count = 0
+        self.trades_idle_count = 0
+        self.loop_count = 0
+        self.last_capture_time = 0.0
+        self.last_idle_check_time = 0.0
+        # Reconnects since fresh data last arrived.
+        self.num_recoveries = 0
+        # Whether the trades fetched next may start after the cursor, leaving a gap.
+        # Always with the recent trades table, and only after a start or a resync with the trade stream.
+        self.is_trades_gap_check_due = True
+        self.ws_client_in_use = getattr(self.bitmex_client, 'ws_client', None)
+
+        # Timings of the stages of captures, and counters.
+        self.metrics = WatcherMetrics(self.symbol)
+        self.metrics.add_gauge('orders_idle_count', lambda: self.orders_idle_count)
+        self.metrics.add_gauge('trades_idle_count', lambda: self.trades_idle_count)
+        if self.mongo_writer is not None:
+            self.metrics.add_gauge('mongo_writer_queue_depth', self.mongo_writer.queue_depth)
+        if self.trades_backfiller is not None:
+            self.metrics.add_gauge('backfill_queue_depth', self.trades_backfiller.queue_depth)
+        if self.leader_lease is not None:
+            self.metrics.add_gauge('is_leader', lambda: int(self.leader_lease.is_leader))
+        # Records of every capture are only logged in DEBUG in the production log mode,
+        # where a summary is logged every LOG_SUMMARY_INTERVAL seconds instead.
+        self.loop_log_level = logging.DEBUG if settings.LOG_MODE == 'production' else logging.INFO
+        self.last_log_summary_time = self.clock()
+        self.last_log_summary = self.metrics.summary_state()
+        self.metrics_server = None
+        if self.owns_clients and settings.METRICS_PORT is not None:
+            # Watchers of many symbols are served together by MultiMarketWatcher.
+            self.metrics_server = MetricsServer(settings.METRICS_PORT, [self.metrics]).start()
 
         # Now the clients are all up.
         self.is_running = True
@@ -58,26 +258,204 @@ class MarketWatcher:
         Once db, redis and exchange clients are created,
         register exit handler that will always release resources on any error.
         """
-        atexit.register(self.exit)
-        signal.signal(signal.SIGTERM, self.exit)
+        if self.owns_clients:
+            atexit.register(self.exit)
+            signal.signal(signal.SIGTERM, self.exit)
 
         self.sanity_check()
 
     def _initialize_db_scheme(self):
+        if is_partitioned():
+            logger.info("MongoDB partitions are initialized as they start.")
+            return
         collections = self.bitmex_db.list_collection_names()
-        if (settings.TRADES_COLLECTION in collections) and (settings.ORDER_BOOK_SNAPSHOTS_COLLECTION in collections):
+        if (self.trades_collection_name in collections) and (self.order_book_snapshots_collection_name in collections):
             logger.info("MongoDB scheme is already initialized. Do nothing.")
         else:
             logger.info("INITIALIZING MongoDB scheme.")
-            self.bitmex_db.create_collection(settings.TRADES_COLLECTION,
+            self.bitmex_db.create_collection(self.trades_collection_name,
                                              capped=True, size=settings.MAX_TRADES_COLLECTION_BYTES)
-            self.bitmex_db[settings.TRADES_COLLECTION].create_index([("timestamp", pymongo.ASCENDING)])
+            self.bitmex_db[self.trades_collection_name].create_index([("timestamp", pymongo.ASCENDING)])
 
-            self.bitmex_db.create_collection(settings.ORDER_BOOK_SNAPSHOTS_COLLECTION,
+            self.bitmex_db.create_collection(self.order_book_snapshots_collection_name,
                                              capped=True, size=settings.MAX_ORDER_BOOK_COLLECTION_BYTES)
-            self.bitmex_db[settings.ORDER_BOOK_SNAPSHOTS_COLLECTION].create_index([("timestamp", pymongo.ASCENDING)])
+            self.bitmex_db[self.order_book_snapshots_collection_name].create_index([("timestamp", pymongo.ASCENDING)])
             logger.info("INITIALIZED MongoDB scheme.")
 
+    def _create_incremental_order_book(self):
+        table_name = self.bitmex_client.ws_client.get_order_book_table_name()
+        order_book = IncrementalOrderBook(table_name, self.symbol)
+        # Start listening before seeding with the current table, so that no delta falls in between.
+        # Deltas applied twice are harmless.
+        self.ws_dispatcher.add_listener(order_book.on_message)
+        order_book.reset(self.bitmex_client.ws_raw_order_books_of_market())
+        logger.info("Incremental order book is initialized from %s.", table_name)
+        return order_book
+
+    def _use_ws_client(self, ws_client):
+        # Called by the reconnector once the new websocket has its partials.
+        if is_ws_dispatcher_required():
+            self.ws_dispatcher.attach(ws_client)
+        self.bitmex_client.ws_client = ws_client
+
+    def fetch_bids_and_asks(self):
+        if self.order_book is None:
+            return self.bitmex_client.ws_sorted_bids_and_asks_of_market()
+        return self.order_book.sorted_bids_and_asks(settings.TARGET_ORDER_BOOK_PRICE_RATIO)
+
+    def fetch_order_book_snapshot(self):
+        if self.order_book is not None:
+            version = self.order_book.version
+            if (version == self.order_book_version) and (self.order_book_snapshot is not None):
+                # No delta has arrived since the last capture.
+                return self.order_book_snapshot
+            self.order_book_version = version
+        timestamp = self.now()
+        with self.metrics.time('ws_fetch_order_book'):
+            bids, asks = self.fetch_bids_and_asks()
+        with self.metrics.time('snapshot_build'):
+            return self.create_order_book_snapshot(timestamp, bids, asks)
+
+    def get_tick_size(self):
+        if self.tick_size is None:
+            self.tick_size = float(self.bitmex_client.ws_raw_instrument()['tickSize'])
+        return self.tick_size
+
+    def is_binary_payload(self):
+        return settings.REDIS_PUBLISH_MODE == 'payload' and settings.REDIS_PAYLOAD_FORMAT == 'binary'
+
+    def order_book_snapshot_collection_for(self, timestamp):
+        if self.partitioned_order_book_snapshots is None:
+            return self.order_book_snapshot_collection
+        return self.partitioned_order_book_snapshots.partition_for(timestamp)
+
+    def to_order_book_snapshot_document(self, order_book_snapshot, order_book_changes):
+        if self.order_book_snapshot_encoder is not None:
+            partition = None
+            if self.partitioned_order_book_snapshots is not None:
+                partition = self.partitioned_order_book_snapshots.name_of(order_book_snapshot.timestamp)
+            return self.order_book_snapshot_encoder.encode(order_book_snapshot, order_book_changes, partition)
+        if settings.ORDER_BOOK_STORAGE_FORMAT == 'binary':
+            try:
+                return to_binary_document(order_book_snapshot, self.get_tick_size())
+            except ValueError as e:
+                # OrderBookSnapshotReader reads either.
+                logger.warning("The snapshot is saved as a plain document: %s", e)
+        return order_book_snapshot.to_dict()
+
+    def to_order_book_snapshot_payload(self, order_book_snapshot, order_book_snapshot_id):
+        if settings.REDIS_PAYLOAD_FORMAT == 'binary':
+            try:
+                return order_book_snapshot.to_bytes(
+                    self.get_tick_size(), settings.REDIS_PAYLOAD_DEPTH, order_book_snapshot_id)
+            except ValueError as e:
+                logger.warning("The snapshot is published in JSON: %s", e)
+        return order_book_snapshot.to_payload(settings.REDIS_PAYLOAD_DEPTH, order_book_snapshot_id)
+
+    def to_trades_payload(self, trades):
+        if settings.REDIS_PAYLOAD_FORMAT == 'binary':
+            try:
+                return trades_to_bytes(trades, self.get_tick_size())
+            except ValueError as e:
+                logger.warning("Trades are published in JSON: %s", e)
+        return trades_to_payload(trades)
+
+    def _create_indices(self):
+        # Creating an existing index does nothing.
+        if not is_partitioned():
+            self.create_trades_indices(self.trades_collection)
+            if self.order_book_snapshot_encoder is not None:
+                OrderBookSnapshotReader.create_indices(self.order_book_snapshot_collection)
+        for interval, retention_seconds in settings.TRADES_ROLLUPS:
+            self.trades_rollup_collections[interval].create_index(
+                [("timestamp", pymongo.ASCENDING)], unique=True, expireAfterSeconds=retention_seconds)
+
+    @staticmethod
+    def create_trades_indices(collection):
+        # The unique index makes inserting the same trades again (after a crash between checkpoints) harmless.
+        try:
+            collection.create_index([("trdMatchID", pymongo.ASCENDING)], unique=True)
+        except pymongo.errors.PyMongoError as e:
+            logger.warning("Unable to create the unique index of trdMatchID: %s", e)
+
+    def initialize_trades_partition(self, collection):
+        """
+        Called before the first write to a partition of trades.
+        With the MongoWriter, the partition is created on its thread ahead of the write instead of in the capture.
+        """
+        if self.mongo_writer is not None:
+            self.mongo_writer.run(lambda: self.create_trades_partition(collection))
+        else:
+            self.create_trades_partition(collection)
+
+    def initialize_order_book_snapshots_partition(self, collection):
+        """
+        Called before the first write to a partition of order book snapshots. See initialize_trades_partition().
+        """
+        if self.mongo_writer is not None:
+            self.mongo_writer.run(lambda: self.create_order_book_snapshots_partition(collection))
+        else:
+            self.create_order_book_snapshots_partition(collection)
+
+    def create_trades_partition(self, collection):
+        collection.create_index([("timestamp", pymongo.ASCENDING)])
+        self.create_trades_indices(collection)
+        self.drop_expired_partitions(self.partitioned_trades)
+
+    def create_order_book_snapshots_partition(self, collection):
+        collection.create_index([("timestamp", pymongo.ASCENDING)])
+        if self.order_book_snapshot_encoder is not None:
+            OrderBookSnapshotReader.create_indices(collection)
+        self.drop_expired_partitions(self.partitioned_order_book_snapshots)
+
+    @staticmethod
+    def partition_retention_seconds():
+        return settings.PARTITION_RETENTION_DAYS * 24 * 60 * 60
+
+    def drop_expired_partitions(self, partitioned_collection):
+        if settings.PARTITION_RETENTION_DAYS <= 0:
+            return
+        names = partitioned_collection.drop_expired(self.now(), MarketWatcher.partition_retention_seconds())
+        if 0 < len(names):
+            logger.info("Expired partitions are dropped: %s", names)
+
+    @staticmethod
+    def _create_mongo_writer():
+        if settings.MONGO_WRITE_MODE != 'async':
+            return None
+        mongo_writer = MongoWriter(
+            settings.MONGO_WRITER_MAX_QUEUE_SIZE, settings.MONGO_WRITER_FLUSH_SIZE,
+            settings.MONGO_WRITER_FLUSH_INTERVAL, settings.MONGO_WRITER_OVERFLOW_POLICY)
+        mongo_writer.start()
+        return mongo_writer
+
+    def _create_trades_backfiller(self):
+        return TradesBackfiller(create_rest_client(settings.BASE_URL, self.symbol), self.symbol,
+                                self.save_backfilled_trades, settings.TRADES_BACKFILL_PAGE_SIZE,
+                                settings.TRADES_BACKFILL_REQUEST_INTERVAL).start()
+
+    def _create_ws_reconnector(self):
+        return WsReconnector(self.bitmex_client.ws_client, self._use_ws_client)
+
+    def _create_leader_lease(self):
+        return LeaderLease(self.redis,
+                           symbol_scoped_channel_name(settings.REDIS_LEADER_LEASE_KEY_NAME, self.symbol),
+                           unique_instance_id(self.instance_name), settings.LEADER_LEASE_TTL_SECONDS)
+
+    @staticmethod
+    def now():
+        """
+        The time of captures. ReplayMarketWatcher returns the recorded time instead.
+        """
+        return datetime.now().astimezone(constants.TIMEZONE)
+
+    @staticmethod
+    def clock():
+        """
+        Seconds to measure the intervals of captures and checkpoints with.
+        """
+        return monotonic()
+
     def sanity_check(self):
         # Ensure market is open.
         if not self.bitmex_client.is_market_in_normal_state():
@@ -88,16 +466,53 @@ class MarketWatcher:
         last_update = self.bitmex_client.get_last_ws_update(table_name)
         if last_update is None:
             return True
-        elapsed_seconds = (datetime.now() - last_update).total_seconds()
+        elapsed_seconds = (self.now() - last_update.astimezone()).total_seconds()
         logger.warning("WS elapsed seconds: %d", elapsed_seconds)
         return ((max_idle_count / 2.0) * settings.LOOP_INTERVAL) < elapsed_seconds
 
     def exit(self, p1=None, p2=None, p3=None):
         if not self.is_running:
             return
+        self.shut_down()
+        if self.owns_clients:
+            sleep(1)
+            sys.exit()
 
+    def shut_down(self):
+        """
+        Stops the background work of this watcher and closes the clients it owns, without exiting the process.
+        """
         logger.info('SHUTTING DOWN BitMEX Watcher. Version %s' % constants.VERSION)
 
+        try:
+            # The last cursor may have been skipped by the throttling.
+            self.checkpoint_trades_cursor(self.trades_cursor, force=True)
+        except Exception as e:
+            logger.info("Unable to save trades cursor: %s" % e)
+        if self.trades_backfiller is not None:
+            self.trades_backfiller.stop()
+            self.save_queued_backfilled_trades()
+        if self.mongo_writer is not None:
+            # Write what is left in the queue before closing the client.
+            self.mongo_writer.stop()
+            self.flush_trades_cursor()
+            logger.info("MongoWriter stopped: %s", str(self.mongo_writer.stats()))
+        if self.snapshot_ring is not None:
+            self.snapshot_ring.close()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        if self.ws_recorder is not None:
+            self.ws_recorder.close()
+        if self.leader_lease is not None:
+            try:
+                # A standby takes over on its next capture, instead of when the lease expires.
+                self.leader_lease.release()
+            except Exception as e:
+                logger.info("Unable to release leader lease: %s" % e)
+        if not self.owns_clients:
+            # Shared clients are closed by their owner.
+            self.is_running = False
+            return
         try:
             self.mongo_client.close()
         except Exception as e:
@@ -110,9 +525,6 @@ class MarketWatcher:
         # Now the clients are all down.
         self.is_running = False
 
-        sleep(1)
-        sys.exit()
-
     @staticmethod
     def create_order_book_snapshot(timestamp, bids, asks):
         return OrderBookSnapshot(timestamp, bids, asks, settings.TARGET_ORDER_BOOK_PRICE_RATIO)
@@ -120,14 +532,23 @@ class MarketWatcher:
     @staticmethod
     def filter_new_trades(cursor, all_trades):
         if cursor is None:
-            new_trades = all_trades
-        else:
-            num_trades = len(all_trades)
-            i = 0
-            while (i < num_trades) and (not cursor.is_behind_of(all_trades[i])):
-                i += 1
-            new_trades = all_trades[i:]
-        return new_trades
+            return all_trades
+        # Trades are sorted by (timestamp, trdMatchID),
+        # so the first trade behind the cursor is found by binary search.
+        lo = 0
+        hi = len(all_trades)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if cursor.is_behind_of(all_trades[mid]):
+                hi = mid
+            else:
+                lo = mid + 1
+        return all_trades[lo:]
+
+    def fetch_trades(self):
+        if self.trade_stream is None:
+            return self.bitmex_client.ws_sorted_recent_trade_objects_of_market()
+        return self.trade_stream.drain()
 
     @staticmethod
     def is_healthy(order_book_snapshot):
@@ -145,99 +566,629 @@ class MarketWatcher:
             logger.info("Trades cursor is loaded: %s", str(result))
             return result
 
+    def load_trades_rollups(self):
+        if self.trades_rollups is None:
+            return
+        self.trades_rollups.seed({
+            interval: collection.find_one(sort=[("timestamp", pymongo.DESCENDING)])
+            for interval, collection in self.trades_rollup_collections.items()
+        })
+        logger.info("Trades rollups are loaded: %s", str(self.trades_rollups.cursor))
+
+    def trade_windows_query(self):
+        since = self.now() - timedelta(seconds=self.trade_windows.longest_seconds)
+        return {"timestamp": {"$gt": since}}
+
+    def load_trade_windows(self):
+        if self.trade_windows is None:
+            return
+        # The trades saved before a restart, so that the windows are full from the start.
+        query = self.trade_windows_query()
+        if self.partitioned_trades is None:
+            documents = self.trades_collection.find(query).sort(TRADES_SORT)
+        else:
+            documents = self.partitioned_trades.find(
+                query, query["timestamp"]["$gt"], self.now(), TRADES_SORT)
+        self.trade_windows.add([trade_from_dict(each) for each in documents])
+        logger.info("Trade windows are loaded: %s", str(self.trade_windows.cursor))
+
+    def save_trades_rollups(self, changed_buckets):
+        for interval, buckets in changed_buckets.items():
+            if len(buckets) == 0:
+                continue
+            collection = self.trades_rollup_collections[interval]
+            operations = [ReplaceOne({"timestamp": b.timestamp}, b.to_dict(), upsert=True) for b in buckets]
+            if self.mongo_writer is None:
+                collection.bulk_write(operations, ordered=False)
+            else:
+                for each in operations:
+                    self.mongo_writer.write(collection, each)
+
     def save_trades_cursor(self, cursor):
         if cursor is None:
             return
-        self.trades_cursor_collection.remove()
-        self.trades_cursor_collection.insert(cursor.to_dict())
-        if logger.isEnabledFor(logging.ERROR):
-            logger.debug("Trades cursor is saved: %s", str(cursor))
+        if self.mongo_writer is None:
+            self.write_trades_cursor(cursor)
+        else:
+            with self.trades_cursor_lock:
+                if 0 < len(self.pending_trades_batches):
+                    # Saved by on_trade_written() after the trades it covers, the batch queued last.
+                    self.pending_trades_batches[-1][1] = cursor
+                elif not self.is_trades_write_failed:
+                    # Every trade queued is written already.
+                    self.write_trades_cursor(cursor)
+        self.saved_trades_cursor = cursor
+
+    def write_trades_cursor(self, cursor):
+        # A single atomic upsert. There is always exactly one cursor.
+        # Written directly with the MongoWriter too, since queuing from its thread would block it when it is full.
+        self.trades_cursor_collection.replace_one({}, cursor.to_dict(), upsert=True)
+        logger.debug("Trades cursor is saved: %s", cursor)
+
+    def on_trade_written(self, batch):
+        """
+        Called on the writer thread after a trade of the batch is written.
+        Saves the cursor of the last batch which is written, as are all the batches before it.
+        """
+        with self.trades_cursor_lock:
+            batch[0] -= 1
+            cursor = None
+            while 0 < len(self.pending_trades_batches) and self.pending_trades_batches[0][0] == 0:
+                cursor = self.pending_trades_batches.popleft()[1] or cursor
+            if cursor is not None:
+                self.write_trades_cursor(cursor)
+
+    def on_trade_failed(self):
+        """
+        Called when a trade queued to the MongoWriter fails or is dropped. The cursor saved last stays before it,
+        so that the trades after it are captured again after a restart.
+        """
+        with self.trades_cursor_lock:
+            if not self.is_trades_write_failed:
+                logger.error("A trade is not written. The trades cursor is no longer saved.")
+            self.is_trades_write_failed = True
+            self.pending_trades_batches.clear()
+
+    def flush_trades_cursor(self):
+        """
+        Saves the cursor of the batches written, once the MongoWriter has stopped.
+        """
+        with self.trades_cursor_lock:
+            cursor = None
+            while 0 < len(self.pending_trades_batches) and self.pending_trades_batches[0][0] == 0:
+                cursor = self.pending_trades_batches.popleft()[1] or cursor
+            if cursor is not None and not self.is_trades_write_failed:
+                self.write_trades_cursor(cursor)
+            if 0 < len(self.pending_trades_batches):
+                logger.warning("%d batches of trades are left unwritten.", len(self.pending_trades_batches))
+
+    def checkpoint_trades_cursor(self, cursor, force=False):
+        """
+        Saves the cursor every TRADES_CURSOR_CHECKPOINT_BATCHES batches of trades
+        or TRADES_CURSOR_CHECKPOINT_SECONDS seconds. Trades replayed from an older cursor are ignored as duplicates.
+        """
+        if cursor is None or cursor is self.saved_trades_cursor:
+            return
+        if self.leader_lease is not None:
+            # A standby taking over continues from the cursor saved last.
+            force = True
+        self.trades_batches_since_checkpoint += 1
+        now = self.clock()
+        if (not force) and (self.trades_batches_since_checkpoint < settings.TRADES_CURSOR_CHECKPOINT_BATCHES) and\
+                ((now - self.last_checkpoint_time) < settings.TRADES_CURSOR_CHECKPOINT_SECONDS):
+            return
+        self.save_trades_cursor(cursor)
+        self.trades_batches_since_checkpoint = 0
+        self.last_checkpoint_time = now
+
+    def wait_while_market_closed(self):
+        sleep(MarketWatcher.MARKET_CLOSED_WAIT_SECONDS)
+
+    def wait_for_next_capture(self):
+        if settings.CAPTURE_MODE != 'event':
+            # Sleep in the main loop.
+            sleep(settings.LOOP_INTERVAL)
+            return
+        # Wake up as soon as the websocket delivers an update,
+        # or after LOOP_INTERVAL at the latest so that idle feeds are still detected.
+        if self.ws_dispatcher.wait(settings.LOOP_INTERVAL):
+            # Updates landing within the minimum publish interval are coalesced into one capture.
+            remaining_seconds = settings.MIN_PUBLISH_INTERVAL - (self.clock() - self.last_capture_time)
+            if 0 < remaining_seconds:
+                sleep(remaining_seconds)
+        self.ws_dispatcher.clear()
+
+    def capture_once(self):
+        """
+        Captures trades and the order book once, saves them and publishes the update.
+        Returns False if the watcher should stop.
+        """
+        capture_start_time = perf_counter()
+        self.last_capture_time = self.clock()
+        # Idle counts stand for LOOP_INTERVALs without updates, however often we capture.
+        is_idle_check = settings.LOOP_INTERVAL <= self.last_capture_time - self.last_idle_check_time
+        if is_idle_check:
+            self.last_idle_check_time = self.last_capture_time
+
+        # Nothing is formatted for records which are not logged.
+        loop_log_level = self.loop_log_level
+        is_loop_logged = logger.isEnabledFor(loop_log_level)
+        loop_id = None
+        if is_loop_logged:
+            loop_id = "{}_{:d}".format(datetime.now().astimezone(constants.TIMEZONE).strftime("%Y%m%d%H%M%S"),
+                                       self.loop_count)
+            logger.log(loop_log_level, "LOOP_HEAD[%s](%s)", loop_id, constants.VERSION)
+        self.loop_count += 1
+        if self.ws_reconnector is not None and self.bitmex_client.ws_client is not self.ws_client_in_use:
+            # Reconnected by another watcher of the websocket.
+            self.resync_with_ws()
+        self.sanity_check()
+        if self.bitmex_client.ws_market_state() == "Closed":
+            logger.info("The market is closed. Waiting for a while.")
+            self.wait_while_market_closed()
+        if self.leader_lease is not None and not self.hold_leader_lease():
+            return self.capture_as_standby(is_idle_check)
+        if self.trades_backfiller is not None:
+            self.save_queued_backfilled_trades()
+
+        # Fetch recent trade data from the market.
+        with self.metrics.time('ws_fetch_trades'):
+            trades = self.fetch_trades()
+        if self.is_trades_gap_check_due:
+            self.detect_trades_gap(trades)
+        if is_loop_logged:
+            if 0 < len(trades):
+                logger.log(loop_log_level, "%d trades are fetched [%s - %s].",
+                           len(trades),
+                           trades[0].timestamp.strftime(constants.DATE_FORMAT),
+                           trades[-1].timestamp.strftime(constants.DATE_FORMAT))
+            else:
+                logger.log(loop_log_level, "NO trades are fetched from the market.")
+
+        with self.metrics.time('trade_filter'):
+            new_trades = MarketWatcher.filter_new_trades(self.trades_cursor, trades)
+        if 0 < len(new_trades):
+            self.trades_idle_count = 0
+            self.num_recoveries = 0
+            self.metrics.count('trades', len(new_trades))
+            if is_loop_logged:
+                logger.log(loop_log_level, "%d new trades. [%s - %s]",
+                           len(new_trades),
+                           new_trades[0].timestamp.strftime(constants.DATE_FORMAT),
+                           new_trades[-1].timestamp.strftime(constants.DATE_FORMAT))
+            self.trades_cursor = TradesCursor(new_trades[-1].timestamp, new_trades[-1].trd_match_id)
+            if self.is_binary_payload() or (self.stream_publisher is not None):
+                self.publish_trades_payload(self.to_trades_payload(new_trades))
+            if self.trades_rollups is not None:
+                # Saved before the cursor. Trades fed again after a restart are skipped by the rollups.
+                self.save_trades_rollups(self.trades_rollups.add(new_trades))
+            if self.trade_windows is not None:
+                self.trade_windows.add(new_trades)
+            self.save_trades(new_trades, self.trades_cursor)
+            self.metrics.observe_lag('trade_to_saved', (self.now() - new_trades[-1].timestamp).total_seconds())
+        else:
+            if is_idle_check:
+                self.trades_idle_count += 1
+            logger.log(loop_log_level, "NO new trades.")
+
+        # Fetch order books.
+        prev_snapshot = self.order_book_snapshot
+        order_book_snapshot = self.fetch_order_book_snapshot()
+        logger.debug("OrderBookSnapshot: %s", order_book_snapshot)
+        if not MarketWatcher.is_healthy(order_book_snapshot):
+            logger.error("OrderBookSnapshot corrupted: %s", order_book_snapshot)
+            return False
+        self.order_book_snapshot = order_book_snapshot
+
+        with self.metrics.time('book_diff'):
+            order_book_changes = order_book_snapshot.changes_from(prev_snapshot)
+        if order_book_changes.is_empty():
+            logger.log(loop_log_level, "Order book has NOT changed.")
+            if is_idle_check:
+                self.orders_idle_count += 1
+        else:
+            self.orders_idle_count = 0
+            self.num_recoveries = 0
+            self.metrics.count('order_book_snapshots')
+            logger.log(loop_log_level, "Order book has changed: %s", order_book_changes)
+            document = self.to_order_book_snapshot_document(order_book_snapshot, order_book_changes)
+            order_book_snapshot_id = str(document.setdefault('_id', ObjectId()))
+            payload = None
+            if settings.REDIS_PUBLISH_MODE == 'payload':
+                payload = self.to_order_book_snapshot_payload(order_book_snapshot, order_book_snapshot_id)
+            trade_stats = None
+            if self.trade_windows is not None:
+                trade_stats = self.trade_windows.to_payload(order_book_snapshot.timestamp)
+            if self.snapshot_ring is not None:
+                # Readers on the same host do not wait for MongoDB or Redis.
+                try:
+                    self.snapshot_ring.write(order_book_snapshot.to_bytes(
+                        self.get_tick_size(), settings.ORDER_BOOK_RING_DEPTH, order_book_snapshot_id))
+                except ValueError as e:
+                    logger.warning("The snapshot is not written to the ring: %s", e)
+            stream_entry = None
+            if self.stream_publisher is not None:
+                # Added to the stream with the id, once the snapshot is written.
+                stream_entry = self.stream_publisher.order_book_snapshot_entry(
+                    order_book_snapshot_id, order_book_snapshot, payload, trade_stats)
+            else:
+                if trade_stats is not None:
+                    # Ahead of the snapshot, so that the stats are there when subscribers are notified.
+                    self.publish_trade_stats(trade_stats)
+                if payload is not None:
+                    # Subscribers of the payload do not wait for MongoDB.
+                    self.publish_order_book_snapshot_payload(payload)
+            # Save the order book snapshot to MongoDB, and publish it.
+            self.save_and_publish_order_book_snapshot(document, stream_entry)
+        if is_idle_check:
+            self.publish_heartbeat(not order_book_changes.is_empty())
+            self.metrics.sample()
+            if settings.REDIS_METRICS_KEY_NAME:
+                self.publish_metrics(self.metrics.to_json())
+
+        if self.is_stale() and not self.recover():
+            return False
+
+        elapsed_seconds = perf_counter() - capture_start_time
+        self.metrics.observe('capture', elapsed_seconds)
+        self.metrics.count('captures')
+        if settings.LOG_MODE == 'production' and \
+                settings.LOG_SUMMARY_INTERVAL <= self.last_capture_time - self.last_log_summary_time:
+            self.log_summary()
+        logger.log(loop_log_level,
+                   "LOOP[%s] (SUMMARY) ElapsedSeconds: %.2f; OrderBookIdleCount: %d; TradesIdleCount: %d;",
+                   loop_id, elapsed_seconds, self.orders_idle_count, self.trades_idle_count)
+        return True
+
+    def is_stale(self):
+        """
+        Returns True once the order book or the trades have been idle for too long.
+        """
+        return settings.MAX_ORDERS_IDLE_COUNT < self.orders_idle_count or\
+            settings.MAX_TRADES_IDLE_COUNT < self.trades_idle_count
+
+    def recover(self):
+        """
+        Reconnects the websocket if the stale feed has gone quiet on it, or catches up with its tables otherwise.
+        Returns False if the watcher should stop: reconnecting is disabled,
+        or has not brought fresh data MAX_RECONNECTS times in a row.
+        """
+        is_ws_idle = False
+        if settings.MAX_ORDERS_IDLE_COUNT < self.orders_idle_count:
+            is_ws_idle = self.is_ws_idle(settings.MARKET_ORDER_BOOK_DATA_NAME, settings.MAX_ORDERS_IDLE_COUNT)
+            logger.error("Order book NOT updated. IdleCount=%d; WS Idle: %s", self.orders_idle_count, is_ws_idle)
+        if settings.MAX_TRADES_IDLE_COUNT < self.trades_idle_count:
+            is_trades_ws_idle = self.is_ws_idle('trade', settings.MAX_TRADES_IDLE_COUNT)
+            logger.error("Trades NOT updated. IdleCount=%d; WS Idle: %s", self.trades_idle_count, is_trades_ws_idle)
+            is_ws_idle = is_ws_idle or is_trades_ws_idle
+        if self.ws_reconnector is None or settings.MAX_RECONNECTS <= self.num_recoveries:
+            logger.error("Aborting. Reconnects: %d", self.num_recoveries)
+            return False
+        self.num_recoveries += 1
+        if is_ws_idle:
+            if not self.ws_reconnector.reconnect(self.bitmex_client.ws_client):
+                # Tried again on the next capture.
+                return True
+            self.metrics.count('ws_reconnects')
+        self.resync_with_ws()
+        return True
+
+    def resync_with_ws(self):
+        """
+        Catches up with the tables of the websocket, e.g. a new one whose partials arrived
+        before it was attached to the dispatcher. The trades of its recent trades table after the cursor
+        are saved by the next capture, which fills the gap left by the stale one.
+        """
+        self.ws_client_in_use = self.bitmex_client.ws_client
+        if self.order_book is not None:
+            self.order_book.reset(self.bitmex_client.ws_raw_order_books_of_market())
+        if self.trade_stream is not None:
+            self.trade_stream.append(list(self.bitmex_client.ws_raw_recent_trades_of_market()))
+            self.is_trades_gap_check_due = True
+        self.orders_idle_count = 0
+        self.trades_idle_count = 0
+
+    def detect_trades_gap(self, trades):
+        """
+        Trades fetched with the recent trades table starting after the cursor mean that trades in between
+        may have been missed: the table has rolled over between captures, the websocket has been reconnected,
+        or the watcher has been stopped. They are backfilled, if enabled.
+        """
+        if self.trade_stream is not None:
+            # Trades drained from the stream after this are only new ones.
+            self.is_trades_gap_check_due = False
+        if self.trades_cursor is None or len(trades) == 0 or not self.trades_cursor.is_behind_of(trades[0]):
+            return
+        if self.trades_backfiller is None:
+            logger.warning("Trades after %s and before %s may be missing.",
+                           self.trades_cursor, trades[0].timestamp.strftime(constants.DATE_FORMAT))
+            return
+        self.trades_backfiller.request(self.trades_cursor, TradesCursor(trades[0].timestamp, trades[0].trd_match_id))
+
+    def save_backfilled_trades(self, trades):
+        """
+        Called on the thread of the backfiller. The trades are saved by the next capture.
+        """
+        self.backfilled_trades.put(trades)
+
+    def save_queued_backfilled_trades(self):
+        """
+        They are older than the cursor, so the windows (which skip trades behind their cursors) do not include them,
+        and they are not published. The rollups are re-aggregated.
+        """
+        while True:
+            try:
+                trades = self.backfilled_trades.get_nowait()
+            except queue.Empty:
+                return
+            documents = [t.to_dict() for t in trades]
+            if self.mongo_writer is None:
+                num_inserted = sum(MarketWatcher.insert_trades(c, d) for c, d in self.split_trades(documents))
+                self.metrics.count('backfilled_trades', num_inserted)
+            else:
+                for collection, partition_documents in self.split_trades(documents):
+                    for each in partition_documents:
+                        self.mongo_writer.write(collection, InsertOne(each),
+                                                on_written=lambda: self.metrics.count('backfilled_trades'))
+            if self.trades_rollups is not None:
+                self.save_backfilled_trades_rollups(trades)
+            logger.info("%d backfilled trades are saved: %s - %s", len(trades),
+                        trades[0].timestamp.strftime(constants.DATE_FORMAT),
+                        trades[-1].timestamp.strftime(constants.DATE_FORMAT))
+
+    def save_backfilled_trades_rollups(self, trades):
+        """
+        The buckets in progress are given the backfilled trades in memory,
+        since the trades captured after them may not be written yet.
+        The earlier buckets are re-aggregated from the trades collection once the backfilled trades are written.
+        """
+        self.save_trades_rollups(self.trades_rollups.add_earlier(trades))
+        ranges = []
+        for interval in self.trades_rollups.intervals:
+            start = floor_timestamp(trades[0].timestamp, interval)
+            end = floor_timestamp(trades[-1].timestamp, interval) + timedelta(seconds=interval)
+            bucket = self.trades_rollups.buckets.get(interval)
+            if bucket is not None:
+                end = min(end, bucket.timestamp)
+            if start < end:
+                ranges.append((interval, start, end))
+        if self.mongo_writer is None:
+            self.reaggregate_trades_rollups(ranges)
+        else:
+            self.mongo_writer.run(lambda: self.reaggregate_trades_rollups(ranges))
+
+    def reaggregate_trades_rollups(self, ranges):
+        """
+        Replaces the rollup buckets in [(interval, start, end), ...] with those of the saved trades.
+        """
+        for interval, start, end in ranges:
+            query = {"timestamp": {"$gte": start, "$lt": end}}
+            if self.partitioned_trades is None:
+                documents = self.trades_collection.find(query).sort(TRADES_SORT)
+            else:
+                documents = self.partitioned_trades.find(query, start, end, TRADES_SORT)
+            buckets = []
+            for trade in map(trade_from_dict, documents):
+                bucket_start = floor_timestamp(trade.timestamp, interval)
+                if len(buckets) == 0 or buckets[-1].timestamp != bucket_start:
+                    buckets.append(RollupBucket(bucket_start))
+                buckets[-1].add(trade)
+            if 0 < len(buckets):
+                self.trades_rollup_collections[interval].bulk_write(
+                    [ReplaceOne({"timestamp": b.timestamp}, b.to_dict(), upsert=True) for b in buckets], ordered=False)
+            logger.info("%d rollup buckets of %d seconds are re-aggregated: %s - %s", len(buckets), interval,
+                        start.strftime(constants.DATE_FORMAT), end.strftime(constants.DATE_FORMAT))
+
+    def hold_leader_lease(self):
+        """
+        Returns True while this watcher is the leader, taking over when it has just become one.
+        """
+        was_leader = self.leader_lease.is_leader
+        if not self.leader_lease.hold():
+            return False
+        if not was_leader:
+            self.take_over()
+        return True
+
+    def take_over(self):
+        """
+        Continues from what the last leader saved. Trades after its last cursor which are still
+        in the recent trades table are saved again, and the ones it has saved already are ignored as duplicates.
+        """
+        logger.warning("Taking over as the leader of %s: %s", self.symbol, self.leader_lease.instance_id)
+        self.load_state()
+        if self.trade_stream is not None:
+            # The standby has drained the stream without saving.
+            self.trade_stream.append(list(self.bitmex_client.ws_raw_recent_trades_of_market()))
+            self.is_trades_gap_check_due = True
+        # The first snapshot is saved whole and published, even if the book has not changed.
+        self.order_book_snapshot = None
+        if self.order_book_snapshot_encoder is not None:
+            self.order_book_snapshot_encoder = OrderBookSnapshotEncoder(
+                settings.KEYFRAME_INTERVAL_SNAPSHOTS, settings.KEYFRAME_INTERVAL_SECONDS)
+
+    def capture_as_standby(self, is_idle_check):
+        """
+        Follows the trades and the order book as the leader does, so that idle feeds are detected
+        and the standby is ready to take over. Nothing is saved or published.
+        """
+        new_trades = MarketWatcher.filter_new_trades(self.trades_cursor, self.fetch_trades())
+        if 0 < len(new_trades):
+            self.trades_idle_count = 0
+            self.num_recoveries = 0
+            self.trades_cursor = TradesCursor(new_trades[-1].timestamp, new_trades[-1].trd_match_id)
+        elif is_idle_check:
+            self.trades_idle_count += 1
+
+        order_book_snapshot = self.fetch_order_book_snapshot()
+        if not MarketWatcher.is_healthy(order_book_snapshot):
+            logger.error("OrderBookSnapshot corrupted: %s", order_book_snapshot)
+            return False
+        if order_book_snapshot.changes_from(self.order_book_snapshot).is_empty():
+            if is_idle_check:
+                self.orders_idle_count += 1
+        else:
+            self.orders_idle_count = 0
+            self.num_recoveries = 0
+        self.order_book_snapshot = order_book_snapshot
+        if is_idle_check:
+            self.metrics.sample()
+        if logger.isEnabledFor(self.loop_log_level):
+            # The holder is read from Redis.
+            logger.log(self.loop_log_level, "STANDBY[%s] OrderBookIdleCount: %d; TradesIdleCount: %d; Leader: %s",
+                       self.symbol, self.orders_idle_count, self.trades_idle_count, self.leader_lease.holder())
+        return not self.is_stale() or self.recover()
+
+    def log_summary(self):
+        """
+        Logs what the captures have done since the last summary, in one record.
+        """
+        state = self.metrics.summary_state()
+        summary = self.metrics.summary_since(self.last_log_summary, state)
+        seconds = self.last_capture_time - self.last_log_summary_time
+        self.last_log_summary = state
+        self.last_log_summary_time = self.last_capture_time
+        logger.info("SUMMARY[%s] %.0fs: %d captures, %d new trades, %d order book snapshots, %d publishes; "
+                    "Capture p50 %.2fms, p99 %.2fms; OrderBookIdleCount: %d; TradesIdleCount: %d;",
+                    self.symbol, seconds, summary['captures'], summary['trades'], summary['order_book_snapshots'],
+                    summary['redis_publishes'], summary['captureP50'] * 1000, summary['captureP99'] * 1000,
+                    self.orders_idle_count, self.trades_idle_count)
+
+    @staticmethod
+    def count_inserted_ignoring_duplicates(e):
+        # Trades already saved before the last checkpoint of the cursor.
+        if any(each.get('code') != DUPLICATE_KEY_ERROR for each in e.details.get('writeErrors', [])):
+            raise e
+        return e.details.get('nInserted', 0)
+
+    @staticmethod
+    def insert_trades(collection, documents):
+        try:
+            return len(collection.insert_many(documents, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            return MarketWatcher.count_inserted_ignoring_duplicates(e)
+
+    def split_trades(self, documents):
+        """
+        Returns [(collection, [documents to insert in it]), ...].
+        """
+        if self.partitioned_trades is None:
+            return [(self.trades_collection, documents)]
+        return self.partitioned_trades.split(documents)
+
+    def save_trades(self, new_trades, trades_cursor):
+        documents = [t.to_dict() for t in new_trades]
+        if self.mongo_writer is None:
+            with self.metrics.time('mongo_trade_insert'):
+                num_inserted = sum(MarketWatcher.insert_trades(c, d) for c, d in self.split_trades(documents))
+            logger.log(self.loop_log_level, "%d trades inserted. The last: %s", num_inserted, trades_cursor)
+        else:
+            on_written = None
+            if not self.is_trades_write_failed and 0 < len(documents):
+                batch = [len(documents), None]
+                with self.trades_cursor_lock:
+                    self.pending_trades_batches.append(batch)
+                on_written = (lambda: self.on_trade_written(batch))
+            for collection, partition_documents in self.split_trades(documents):
+                for each in partition_documents:
+                    self.mongo_writer.write(collection, InsertOne(each), on_written=on_written,
+                                            on_failed=self.on_trade_failed)
+            logger.log(self.loop_log_level, "%d trades queued. The last: %s", len(documents), trades_cursor)
+        # The cursor follows the trades it covers.
+        self.checkpoint_trades_cursor(trades_cursor)
+
+    def publish_order_book_snapshot_id(self, order_book_snapshot_id, stream_entry=None):
+        with self.metrics.time('redis_publish'):
+            if self.stream_publisher is not None:
+                self.stream_publisher.add_order_book_snapshot(self.redis, stream_entry)
+            else:
+                self.redis.publish(self.order_book_snapshot_id_channel_name, order_book_snapshot_id)
+        self.metrics.count('redis_publishes')
+        if order_book_snapshot_id != '*':
+            self.observe_order_book_lag()
+        logger.log(self.loop_log_level, "Published to redis: %s", order_book_snapshot_id)
+
+    def observe_order_book_lag(self):
+        last_update = self.bitmex_client.get_last_ws_update(settings.MARKET_ORDER_BOOK_DATA_NAME)
+        if last_update is not None:
+            # Naive times are local ones.
+            self.metrics.observe_lag('ws_to_publish', (self.now() - last_update.astimezone()).total_seconds())
+
+    def publish_order_book_snapshot_payload(self, payload):
+        # The latest payload is also kept in a key for subscribers which have just started. One round trip.
+        with self.metrics.time('redis_publish'):
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.set(self.order_book_snapshot_channel_name, payload)
+            pipeline.publish(self.order_book_snapshot_channel_name, payload)
+            pipeline.execute()
+        self.metrics.count('redis_publishes')
+        logger.log(self.loop_log_level, "Published the payload to redis [%s]: %d bytes",
+                   self.order_book_snapshot_channel_name, len(payload))
+
+    def publish_trade_stats(self, trade_stats):
+        # The latest stats are also kept in a key. One round trip.
+        with self.metrics.time('redis_publish'):
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.set(self.trade_stats_channel_name, trade_stats)
+            pipeline.publish(self.trade_stats_channel_name, trade_stats)
+            pipeline.execute()
+        self.metrics.count('redis_publishes')
+
+    def publish_trades_payload(self, payload):
+        with self.metrics.time('redis_publish'):
+            if self.stream_publisher is not None:
+                self.stream_publisher.add_trades(self.redis, payload)
+            else:
+                self.redis.publish(self.trades_channel_name, payload)
+        self.metrics.count('redis_publishes')
+        logger.log(self.loop_log_level, "Published the trades to redis: %d bytes", len(payload))
+
+    def publish_heartbeat(self, is_order_book_changed):
+        """
+        Called every LOOP_INTERVAL.
+        """
+        if self.stream_publisher is not None:
+            self.stream_publisher.set_heartbeat(self.redis)
+        elif not is_order_book_changed:
+            # Subscribers of the channel are told that the order book has not changed.
+            self.publish_order_book_snapshot_id('*')
+
+    def save_and_publish_order_book_snapshot(self, document, stream_entry=None):
+        """
+        stream_entry is the entry of the snapshot added to the stream once it is written, with the stream publisher.
+        """
+        collection = self.order_book_snapshot_collection_for(document['timestamp'])
+        if self.mongo_writer is None:
+            with self.metrics.time('snapshot_insert'):
+                insert_result = collection.insert_one(document)
+            order_book_snapshot_id = str(insert_result.inserted_id)
+            logger.log(self.loop_log_level, "A new order book snapshot is inserted: %s", order_book_snapshot_id)
+            # We publish the updated order book snapshot.
+            self.publish_order_book_snapshot_id(order_book_snapshot_id, stream_entry)
+            return
+        # The id is assigned here, so that it can be published as soon as the snapshot is written.
+        order_book_snapshot_id = str(document.setdefault('_id', ObjectId()))
+        self.mongo_writer.write(collection, InsertOne(document),
+                                on_written=lambda: self.publish_order_book_snapshot_id(order_book_snapshot_id,
+                                                                                       stream_entry))
+        logger.log(self.loop_log_level, "A new order book snapshot is queued: %s", order_book_snapshot_id)
+
+    def publish_metrics(self, metrics_json):
+        self.redis.set(self.metrics_key_name, metrics_json)
+
+    def load_state(self):
+        """
+        Loads what the capture loop continues from.
+        """
+        self.trades_cursor = self.load_trades_cursor()
+        self.load_trades_rollups()
+        self.load_trade_windows()
 
     def run_loop(self):
         try:
-            order_book_digest = ""
-            orders_idle_count = 0
-            trades_idle_count = 0
-            loop_count = 0
-            trades_cursor = self.load_trades_cursor()
-            while True:
-                loop_start_time = datetime.now().astimezone(constants.TIMEZONE)
-                loop_id = loop_start_time.strftime("%Y%m%d%H%M%S") + "_" + str(loop_count)
-                logger.info("LOOP_HEAD[%s](%s)" % (loop_id, constants.VERSION))
-                self.sanity_check()
-                if self.bitmex_client.ws_market_state() == "Closed":
-                    logger.info("The market is closed. Waiting for a while.")
-                    sleep(1.0)
-
-                # Fetch recent trade data from the market.
-                trades = self.bitmex_client.ws_sorted_recent_trade_objects_of_market()
-                if 0 < len(trades):
-                    logger.info("%d trades are fetched [%s - %s].",
-                                len(trades),
-                                trades[0].timestamp.strftime(constants.DATE_FORMAT),
-                                trades[-1].timestamp.strftime(constants.DATE_FORMAT))
-                else:
-                    logger.info("NO trades are fetched from the market.")
-
-                new_trades = MarketWatcher.filter_new_trades(trades_cursor, trades)
-                if 0 < len(new_trades):
-                    trades_idle_count = 0
-                    logger.info("%d new trades. [%s - %s]",
-                                len(new_trades),
-                                new_trades[0].timestamp.strftime(constants.DATE_FORMAT),
-                                new_trades[-1].timestamp.strftime(constants.DATE_FORMAT))
-                    insert_result = self.trades_collection.insert_many([t.to_dict() for t in new_trades])
-                    trades_cursor = TradesCursor(new_trades[-1].timestamp, new_trades[-1].trd_match_id)
-                    logger.info("%d trades inserted. The last: %s",
-                                len(insert_result.inserted_ids), str(trades_cursor))
-                    self.save_trades_cursor(trades_cursor)
-                else:
-                    trades_idle_count += 1
-                    logger.info("NO new trades.")
-
-                # Fetch order books.
-                timestamp = datetime.now().astimezone(constants.TIMEZONE)
-                bids, asks = self.bitmex_client.ws_sorted_bids_and_asks_of_market()
-                order_book_snapshot = self.create_order_book_snapshot(timestamp, bids, asks)
-                if logger.isEnabledFor(logging.DEBUG):
-                    logger.debug("OrderBookSnapshot: %s" % str(order_book_snapshot))
-                if not MarketWatcher.is_healthy(order_book_snapshot):
-                    logger.error("OrderBookSnapshot corrupted: %s" % str(order_book_snapshot))
-                    break
-
-                prev_digest = order_book_digest
-                order_book_digest = order_book_snapshot.digest_string()
-
-                if prev_digest == order_book_digest:
-                    orders_idle_count += 1
-                    logger.info("Order book digest has NOT changed.")
-                    self.redis.publish(settings.REDIS_ORDER_BOOK_SNAPSHOT_ID_CHANNEL_NAME, '*')
-                else:
-                    orders_idle_count = 0
-                    # Save the order book snapshot to MongoDB.
-                    insert_result = self.order_book_snapshot_collection.insert_one(order_book_snapshot.to_dict())
-                    order_book_snapshot_id = str(insert_result.inserted_id)
-                    logger.info("A new order book snapshot is inserted: %s" % order_book_snapshot_id)
-                    # We publish the updated order book snapshot.
-                    self.redis.publish(settings.REDIS_ORDER_BOOK_SNAPSHOT_ID_CHANNEL_NAME, order_book_snapshot_id)
-                    logger.info("Published to redis [%s]: %s",
-                                settings.REDIS_ORDER_BOOK_SNAPSHOT_ID_CHANNEL_NAME, order_book_snapshot_id)
-
-                if settings.MAX_ORDERS_IDLE_COUNT < orders_idle_count:
-                    logger.error("Order book NOT updated. Aborting. IdleCount=%d" % orders_idle_count)
-                    break
-                if settings.MAX_TRADES_IDLE_COUNT < trades_idle_count:
-                    logger.error("Trades NOT updated. Aborting. IdleCount=%d; WS Idle: %s",
-                                 trades_idle_count, self.is_ws_idle('trade', settings.MAX_TRADES_IDLE_COUNT))
-                    break
-
-                loop_end_time = datetime.now().astimezone(constants.TIMEZONE)
-                elapsed_seconds = (loop_end_time - loop_start_time).total_seconds()
-                logger.info("LOOP[%s] (SUMMARY) ElapsedSeconds: %.2f; OrderBookIdleCount: %d; TradesIdleCount: %d;",
-                            loop_id, elapsed_seconds, orders_idle_count, trades_idle_count)
-
-                # Sleep in the main loop.
-                sleep(settings.LOOP_INTERVAL)
+            self.load_state()
+            while self.capture_once():
+                self.wait_for_next_capture()
         except Exception as e:
             import traceback
             traceback.print_exc(file=sys.stdout)
@@ -249,11 +1200,114 @@ class MarketWatcher:
             self.exit()
 
 
+class MultiMarketWatcher:
+    """
+    Watches many symbols in one process, running a MarketWatcher per symbol in its own thread.
+    One websocket subscribes to all the symbols, and the MongoDB and Redis connection pools are shared.
+    """
+
+    def __init__(self, symbols):
+        self.symbols = list(symbols)
+        if settings.TRADES_SOURCE != 'stream':
+            logger.warning("The symbols share one recent trades table of the websocket. Busy symbols push "
+                           "the trades of quiet ones out between captures. Use TRADES_SOURCE = \"stream\".")
+
+        logger.info("Connecting to BitMEX exchange: %s %s %s",
+                    settings.BASE_URL, ','.join(self.symbols), settings.MARKET_ORDER_BOOK_DATA_NAME)
+        self.ws_client = MultiplexedWebSocketClient(
+            settings.BASE_URL, self.symbols, ["instrument", settings.MARKET_ORDER_BOOK_DATA_NAME, "trade"])
+        logger.info("Connecting to %s" % settings.MONGO_DB_URI)
+        self.mongo_client = pymongo.MongoClient(settings.MONGO_DB_URI)
+        self.redis = redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+
+        # Each message is parsed once, and passed to the watcher of its symbol.
+        # Always attached, because the idle checks need the time of the last message of each symbol.
+        self.symbol_router = SymbolRouter(self.symbols)
+        self.symbol_router.attach(self.ws_client)
+
+        self.watchers = [
+            MarketWatcher(symbol, SymbolBitMEXClient(self.ws_client, symbol, self.symbol_router),
+                          self.mongo_client, self.redis, self.symbol_router.dispatchers[symbol])
+            for symbol in self.symbols
+        ]
+
+        # The websocket of all the symbols is reconnected by whichever watcher finds it stale first, if enabled.
+        self.ws_reconnector = None
+        if settings.STALE_FEED_POLICY == 'reconnect':
+            self.ws_reconnector = WsReconnector(self.ws_client, self._use_ws_client)
+            for watcher in self.watchers:
+                watcher.ws_reconnector = self.ws_reconnector
+
+        self.metrics_server = None
+        if settings.METRICS_PORT is not None:
+            self.metrics_server = MetricsServer(settings.METRICS_PORT, [w.metrics for w in self.watchers]).start()
+
+        self.is_running = True
+        atexit.register(self.exit)
+        signal.signal(signal.SIGTERM, self.exit)
+
+    def _use_ws_client(self, ws_client):
+        self.symbol_router.attach(ws_client)
+        for watcher in self.watchers:
+            watcher.bitmex_client.ws_client = ws_client
+        self.ws_client = ws_client
+
+    def run_loop(self):
+        threads = [threading.Thread(target=w.run_loop, name="watcher-" + w.symbol) for w in self.watchers]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            # As a single watcher does, the process stops as soon as any symbol stops,
+            # and all the symbols restart together.
+            while all(t.is_alive() for t in threads):
+                sleep(1.0)
+            logger.error("Watcher threads stopped: %s", [t.name for t in threads if not t.is_alive()])
+        finally:
+            self.exit()
+
+    def exit(self, p1=None, p2=None, p3=None):
+        if not self.is_running:
+            return
+
+        logger.info('SHUTTING DOWN BitMEX Watcher. Version %s' % constants.VERSION)
+
+        for watcher in self.watchers:
+            try:
+                watcher.exit()
+            except Exception as e:
+                logger.info("Unable to stop watcher of %s: %s" % (watcher.symbol, e))
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        try:
+            self.mongo_client.close()
+        except Exception as e:
+            logger.info("Unable to close MongoDB client: %s" % e)
+        try:
+            self.ws_client.exit()
+        except Exception as e:
+            logger.info("Unable to close Bitmex client: %s" % e)
+
+        # Now the clients are all down.
+        self.is_running = False
+
+        sleep(1)
+        sys.exit()
+
+
 def start():
     logger.info('STARTING BitMEX Watcher. Version %s' % constants.VERSION)
     # Try/except just keeps ctrl-c from printing an ugly stacktrace
     try:
-        watcher = MarketWatcher()
+        if settings.RUNTIME == 'asyncio':
+            # Imported here, because motor and redis.asyncio are only required by the asyncio runtime.
+            from bitmex_watcher import async_watcher
+            async_watcher.start()
+            return
+        if settings.SYMBOLS:
+            watcher = MultiMarketWatcher(settings.SYMBOLS)
+        else:
+            watcher = MarketWatcher()
         watcher.run_loop()
     except (KeyboardInterrupt, SystemExit):
         sys.exit()
@@ -0,0 +1,102 @@
+import json
+import threading
+from datetime import datetime, timezone
+
+from bitmex_watcher.trade_stream import BITMEX_TIMESTAMP_FORMAT, parse_timestamp
+
+
+###
+# Hooks into the websocket of a pybitmex client and lets the watcher react to table updates
+# (instrument, orderBookL2, trade, ...) as soon as they land, instead of polling at a fixed interval.
+##
+class WsMessageDispatcher:
+
+    def __init__(self):
+        self._updated = threading.Event()
+        self._listeners = []
+        self._wakers = []
+
+    def attach(self, ws_client):
+        """
+        Wraps the message handler of the websocket app owned by a pybitmex BitMEXWebSocketClient.
+        pybitmex applies each message to its own tables first, so the data is up to date when we are notified.
+        """
+        ws_app = ws_client.ws
+        original_on_message = ws_app.on_message
+
+        def on_message(*args):
+            # The raw message is always the last argument, whichever websocket-client version calls us.
+            original_on_message(*args)
+            self.dispatch(args[-1])
+
+        ws_app.on_message = on_message
+
+    def add_listener(self, listener):
+        """
+        Registers a callable that receives every parsed websocket message (a dict with 'table', 'action', 'data').
+        Listeners are called on the websocket thread and must return quickly.
+        """
+        self._listeners.append(listener)
+
+    def add_waker(self, waker):
+        """
+        Registers a callable with no arguments that is called on every websocket message, without parsing it.
+        Used to wake up waiters on other threads or event loops.
+        """
+        self._wakers.append(waker)
+
+    def dispatch(self, raw_message):
+        # Messages are only parsed a second time when somebody is interested in their contents.
+        if 0 < len(self._listeners):
+            message = json.loads(raw_message) if isinstance(raw_message, (str, bytes)) else raw_message
+            for listener in self._listeners:
+                listener(message)
+        self._updated.set()
+        for waker in self._wakers:
+            waker()
+
+    def wait(self, timeout):
+        """
+        Blocks until a websocket message arrives or the timeout expires.
+        Returns True if the wait was ended by a message.
+        """
+        return self._updated.wait(timeout)
+
+    def clear(self):
+        self._updated.clear()
+
+
+def to_bitmex_timestamp(timestamp):
+    return timestamp.astimezone(timezone.utc).strftime(BITMEX_TIMESTAMP_FORMAT)
+
+
+###
+# Records websocket messages as JSON lines of {"receivedAt": ..., "message": ...}, to be replayed later
+# (see replay.py). A listener of WsMessageDispatcher.
+##
+class WsMessageRecorder:
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def on_message(self, message):
+        line = json.dumps({'receivedAt': to_bitmex_timestamp(datetime.now(timezone.utc)), 'message': message},
+                          separators=(',', ':'))
+        with self._lock:
+            self.file.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+
+def read_recorded_messages(path):
+    """
+    Yields (received time, message) of a file written by WsMessageRecorder.
+    """
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield parse_timestamp(record['receivedAt']), record['message']
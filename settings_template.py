@@ -10,9 +10,74 @@ REDIS_HOST = "redis"
 REDIS_PORT = 6379
 REDIS_DB = 0
 
+# "id" (only the ObjectId of each snapshot) or "payload" (also the summary and the top levels as JSON).
+REDIS_PUBLISH_MODE = "id"
+# "json" or "binary" (compact; new trades are also published).
+REDIS_PAYLOAD_FORMAT = "json"
+# "pubsub" (fire-and-forget) or "stream" (Redis Streams; consumers resume from their last entry).
+REDIS_PUBLISHER = "pubsub"
+
+# Instruments to watch in one process. If empty, SYMBOL ("XBTUSD") is watched.
+# Needs RUNTIME = "thread", and TRADES_SOURCE = "stream" since the symbols share one recent trades table.
+SYMBOLS = []
+
+# "polling" (every LOOP_INTERVAL seconds) or "event" (on every websocket update, throttled by MIN_PUBLISH_INTERVAL).
+CAPTURE_MODE = "polling"
+MIN_PUBLISH_INTERVAL = 0.1
+
+# "thread" (blocking) or "asyncio" (motor and redis.asyncio; writes and publishes overlap with captures).
+RUNTIME = "thread"
+
+# "snapshot" (re-sorts the websocket table on every capture) or "incremental" (maintained from L2 deltas).
+ORDER_BOOK_SOURCE = "snapshot"
+# "snapshot" (re-sorts the recent trades table on every capture) or "stream" (only the appended trades).
+TRADES_SOURCE = "snapshot"
+
+# Trade rollups as (interval seconds, retention seconds), e.g. [(1, 86400), (60, 2592000)]. Empty to disable.
+TRADES_ROLLUPS = []
+
+# Sliding windows of trade statistics in seconds, published with each snapshot, e.g. [60, 300, 1800].
+# Empty to disable.
+TRADE_WINDOWS = []
+
+# "none" (capped collections), "day" or "hour" (a collection per day or hour, kept PARTITION_RETENTION_DAYS).
+STORAGE_PARTITIONING = "none"
+PARTITION_RETENTION_DAYS = 90
+
+# "full" (whole snapshots) or "delta" (keyframes and level diffs in between).
+ORDER_BOOK_STORAGE_MODE = "full"
+# "document" or "binary" (the compact wire format, with ORDER_BOOK_STORAGE_MODE = "full").
+ORDER_BOOK_STORAGE_FORMAT = "document"
+
+# "sync" (writes in the capture loop) or "async" (batched writes on a background thread).
+MONGO_WRITE_MODE = "sync"
+
+# A memory-mapped file of the latest order book snapshots for bots on the same host. Empty to disable.
+ORDER_BOOK_RING_PATH = ""
+
+# A file to record websocket messages to, which replay.start() replays from REPLAY_PATH. Empty to disable.
+WS_RECORD_PATH = ""
+
+# Prometheus metrics of the capture stages at http://<host>:METRICS_PORT/metrics. None to disable.
+METRICS_PORT = None
+
+# Two or more watchers with the same settings on different hosts: the one holding the lease in Redis
+# saves and publishes, and a standby takes over within LEADER_LEASE_TTL_SECONDS if it stops.
+LEADER_ELECTION = False
+LEADER_LEASE_TTL_SECONDS = 5.0
+
+# "exit" (stop on stale data, to be restarted) or "reconnect" (replace the websocket in the process).
+STALE_FEED_POLICY = "exit"
+
+# Trades missed by the websocket are fetched from the REST API in the background.
+TRADES_BACKFILL = False
+
 # If this flag is set True, sample_subscriber.py (it does nothing meaningful.) is executed in another thread.
 ENABLE_SAMPLE_SUBSCRIBER = False
 
+# "verbose" (every capture in INFO) or "production" (periodic summaries, written on a background thread).
+LOG_MODE = "verbose"
+
 # Logging to files is not recommended when you run this on Docker.
 # By leaving the name empty the program avoids to create log files.
 LOG_FILE_NAME = ''
@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+
+os.environ.setdefault('MARKET_ORDER_BOOK_DATA_NAME', 'orderBookL2_25')
+
+_START = datetime(2019, 4, 13, 23, 59, 58, tzinfo=timezone.utc)
+
+
+def _matches(document, query):
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(_matches(document, each) for each in condition):
+                return False
+        elif isinstance(condition, dict):
+            for operator, value in condition.items():
+                if operator == "$lt" and not document[key] < value:
+                    return False
+                if operator == "$gt" and not document[key] > value:
+                    return False
+                if operator == "$lte" and not document[key] <= value:
+                    return False
+                if operator == "$gte" and not document[key] >= value:
+                    return False
+        elif document[key] != condition:
+            return False
+    return True
+
+
+class _FakeCursor(list):
+
+    def sort(self, keys):
+        return _FakeCursor(sorted(self, key=lambda d: tuple(d[k] for k, _ in keys)))
+
+
+class _FakeCollection:
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def find(self, query):
+        return _FakeCursor(d for d in self.documents if _matches(d, query))
+
+
+class TestMarketDataArchiver(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_trades(self):
+        from bitmex_watcher.archive import MarketDataArchiver, ArchiveReader
+
+        trades = [{"timestamp": _START + timedelta(seconds=i), "trdMatchID": "%03d" % i, "side": "Buy",
+                   "price": 5000.0 + i, "size": i + 1} for i in range(5)]
+        db = {"trades": _FakeCollection(trades[:3]), "order_book_snapshots": _FakeCollection([])}
+        archiver = MarketDataArchiver(self.root, db, "XBTUSD", "trades", "order_book_snapshots", max_rows_per_file=2)
+        # Split by date and size.
+        self.assertEqual(3, archiver.archive_trades(_START + timedelta(hours=1)))
+
+        # Only the new trades are archived by the next run.
+        db["trades"].documents = trades
+        archiver = MarketDataArchiver(self.root, db, "XBTUSD", "trades", "order_book_snapshots")
+        self.assertEqual(2, archiver.archive_trades(_START + timedelta(hours=1)))
+        self.assertEqual(0, archiver.archive_trades(_START + timedelta(hours=1)))
+
+        loaded = ArchiveReader(self.root).load_trades("XBTUSD", _START, _START + timedelta(seconds=4))
+        self.assertEqual(["000", "001", "002", "003"], list(loaded['trdMatchID']))
+        self.assertEqual([5000.0, 5001.0, 5002.0, 5003.0], list(loaded['price']))
+        self.assertEqual(0, len(ArchiveReader(self.root).load_trades("ETHUSD", _START, _START + timedelta(days=1))
+                                ['price']))
+
+    def test_late_trades(self):
+        from bitmex_watcher.archive import MarketDataArchiver, ArchiveReader
+
+        trades = [{"timestamp": _START + timedelta(seconds=i), "trdMatchID": "%03d" % i, "side": "Buy",
+                   "price": 5000.0 + i, "size": i + 1} for i in range(6)]
+        db = {"trades": _FakeCollection([trades[i] for i in (0, 3, 4)]), "order_book_snapshots": _FakeCollection([])}
+        archiver = MarketDataArchiver(self.root, db, "XBTUSD", "trades", "order_book_snapshots", recheck_seconds=3)
+        self.assertEqual(3, archiver.archive_trades(_START + timedelta(hours=1)))
+
+        # Trades 1 and 2 are backfilled after the checkpoint has passed them. Trade 0 is archived already.
+        db["trades"].documents = trades
+        self.assertEqual(3, archiver.archive_trades(_START + timedelta(hours=1)))
+        self.assertEqual(0, archiver.archive_trades(_START + timedelta(hours=1)))
+        loaded = ArchiveReader(self.root).load_trades("XBTUSD", _START, _START + timedelta(hours=1))
+        self.assertEqual(["%03d" % i for i in range(6)], list(loaded['trdMatchID']))
+
+    def test_order_book_snapshots(self):
+        from bson.objectid import ObjectId
+        from bitmex_watcher.models import OrderBookSnapshot
+        from bitmex_watcher.snapshot_store import OrderBookSnapshotEncoder
+        from bitmex_watcher.archive import MarketDataArchiver, ArchiveReader
+
+        books = [
+            ([{"price": 100.0, "size": 100}, {"price": 99.5, "size": 200}], [{"price": 100.5, "size": 10}]),
+            ([{"price": 100.0, "size": 120}], [{"price": 100.5, "size": 10}, {"price": 101.0, "size": 50}]),
+            ([{"price": 100.0, "size": 1}], [{"price": 100.5, "size": 15}]),
+        ]
+        encoder = OrderBookSnapshotEncoder(keyframe_interval_snapshots=100, keyframe_interval_seconds=60)
+        documents = []
+        prev_snapshot = None
+        for i, (bids, asks) in enumerate(books):
+            snapshot = OrderBookSnapshot(_START + timedelta(seconds=i), bids, asks, 25)
+            documents.append(encoder.encode(snapshot, snapshot.changes_from(prev_snapshot)))
+            prev_snapshot = snapshot
+        db = {"trades": _FakeCollection([]), "order_book_snapshots": _FakeCollection(documents)}
+        archiver = MarketDataArchiver(self.root, db, "XBTUSD", "trades", "order_book_snapshots")
+        self.assertEqual(3, archiver.archive_order_book_snapshots(_START + timedelta(hours=1)))
+
+        summary, batch = ArchiveReader(self.root).load_order_book_snapshots(
+            "XBTUSD", _START, _START + timedelta(hours=1))
+        self.assertEqual([str(d['_id']) for d in documents], list(summary['id']))
+        self.assertEqual([2, 1, 1], list(batch.num_bids))
+        self.assertEqual([100.5, 101.0], list(batch.ask_prices[1]))
+        self.assertEqual([15, 0], list(batch.ask_sizes[2]))
+        self.assertEqual([d['midPrice'] for d in documents], list(summary['midPrice']))
+        self.assertIsInstance(documents[0]['_id'], ObjectId)
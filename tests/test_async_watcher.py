@@ -0,0 +1,193 @@
+import os
+import asyncio
+import threading
+import unittest
+from unittest import mock
+from time import monotonic
+from datetime import datetime, timedelta
+
+os.environ.setdefault('MARKET_ORDER_BOOK_DATA_NAME', 'orderBookL2_25')
+
+
+class _FakeBitMEXClient:
+
+    def __init__(self, trades):
+        self.trades = trades
+
+    def is_market_in_normal_state(self):
+        return True
+
+    def ws_market_state(self):
+        return "Open"
+
+    def ws_sorted_recent_trade_objects_of_market(self):
+        return self.trades
+
+    def ws_sorted_bids_and_asks_of_market(self):
+        return [{"price": 5000.0, "size": 30}], [{"price": 5000.5, "size": 10}]
+
+    def get_last_ws_update(self, table_name):
+        return datetime.now()
+
+
+class _InsertManyResult:
+
+    def __init__(self, inserted_ids):
+        self.inserted_ids = inserted_ids
+
+
+class _FakeAsyncCollection:
+
+    def __init__(self):
+        self.documents = []
+        self.indices = []
+
+    async def create_index(self, keys, **kwargs):
+        self.indices.append(keys)
+
+    async def find_one(self):
+        return self.documents[0] if self.documents else None
+
+    async def insert_one(self, document):
+        self.documents.append(document)
+
+    async def insert_many(self, documents, ordered=True):
+        self.documents.extend(documents)
+        return _InsertManyResult(list(range(len(documents))))
+
+    async def replace_one(self, query, document, upsert=False):
+        self.documents = [document]
+
+
+class _FakeAsyncDatabase(dict):
+
+    def __missing__(self, name):
+        self[name] = _FakeAsyncCollection()
+        return self[name]
+
+    async def list_collection_names(self):
+        return list(self.keys())
+
+    async def create_collection(self, name, **kwargs):
+        return self[name]
+
+
+class _FakeAsyncMongoClient(dict):
+
+    def __missing__(self, name):
+        self[name] = _FakeAsyncDatabase()
+        return self[name]
+
+
+class _FakeAsyncRedis:
+
+    def __init__(self):
+        self.messages = []
+
+    async def publish(self, channel, message):
+        self.messages.append((channel, message))
+
+
+class TestAsyncMarketWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_run_loop(self):
+        from pybitmex import Trade
+        from bitmex_watcher.utils import constants
+        from bitmex_watcher.settings import settings
+        from bitmex_watcher.ws_events import WsMessageDispatcher
+        from bitmex_watcher.async_watcher import AsyncMarketWatcher
+
+        start = datetime(2019, 4, 13, 12, 0, 0, tzinfo=constants.TIMEZONE)
+        trades = [Trade("%03d" % i, start + timedelta(seconds=i), "Buy", 5000.5, 1) for i in range(3)]
+        mongo_client = _FakeAsyncMongoClient()
+        redis_client = _FakeAsyncRedis()
+        with mock.patch.dict(settings, {'LOOP_INTERVAL': 0.01}):
+            watcher = AsyncMarketWatcher(None, _FakeBitMEXClient(trades), mongo_client, redis_client,
+                                         WsMessageDispatcher(), self.loop)
+            # The order book never changes, so the watcher stops after MAX_ORDERS_IDLE_COUNT.
+            self.loop.run_until_complete(watcher.run_loop())
+
+        db = mongo_client[settings.BITMEX_DB]
+        self.assertEqual(["000", "001", "002"], [d['trdMatchID'] for d in db[settings.TRADES_COLLECTION].documents])
+        self.assertEqual("002", db[settings.TRADES_CURSOR_COLLECTION].documents[0]['trdMatchID'])
+        snapshots = db[settings.ORDER_BOOK_SNAPSHOTS_COLLECTION].documents
+        self.assertEqual(1, len(snapshots))
+        messages = [m for _, m in redis_client.messages]
+        self.assertEqual(str(snapshots[0]['_id']), messages[0])
+        self.assertEqual(settings.MAX_ORDERS_IDLE_COUNT + 1, messages.count('*'))
+
+    def test_write_errors(self):
+        from pymongo.errors import AutoReconnect, OperationFailure
+        from pybitmex import Trade
+        from bitmex_watcher.utils import constants
+        from bitmex_watcher.settings import settings
+        from bitmex_watcher.mongo_writer import MongoWriter
+        from bitmex_watcher.ws_events import WsMessageDispatcher
+        from bitmex_watcher.async_watcher import AsyncMarketWatcher
+
+        start = datetime(2019, 4, 13, 12, 0, 0, tzinfo=constants.TIMEZONE)
+        trades = [Trade("%03d" % i, start + timedelta(seconds=i), "Buy", 5000.5, 1) for i in range(3)]
+        for error, expected_trade_ids in [(AutoReconnect("primary stepped down"), ["000", "001", "002"]),
+                                          (OperationFailure("failed"), [])]:
+            mongo_client = _FakeAsyncMongoClient()
+            db = mongo_client[settings.BITMEX_DB]
+            trades_collection = db[settings.TRADES_COLLECTION]
+            insert_many = trades_collection.insert_many
+            errors = [error]
+
+            async def fail_once(documents, ordered=True):
+                if errors:
+                    raise errors.pop()
+                return await insert_many(documents, ordered)
+
+            trades_collection.insert_many = fail_once
+            with mock.patch.dict(settings, {'LOOP_INTERVAL': 0.01}), \
+                    mock.patch.object(MongoWriter, 'MAX_RETRY_INTERVAL_SECONDS', 0.0):
+                watcher = AsyncMarketWatcher(None, _FakeBitMEXClient(trades), mongo_client, _FakeAsyncRedis(),
+                                             WsMessageDispatcher(), self.loop)
+                # The watcher keeps capturing until the order book is stale.
+                self.loop.run_until_complete(watcher.run_loop())
+
+            self.assertEqual(expected_trade_ids, [d['trdMatchID'] for d in trades_collection.documents])
+            # The cursor is not saved after trades which are not.
+            cursors = db[settings.TRADES_CURSOR_COLLECTION].documents
+            self.assertEqual(expected_trade_ids[-1:], [d['trdMatchID'] for d in cursors])
+            self.assertEqual(1, len(db[settings.ORDER_BOOK_SNAPSHOTS_COLLECTION].documents))
+
+    def test_unsupported_settings(self):
+        from bitmex_watcher.settings import settings
+        from bitmex_watcher.ws_events import WsMessageDispatcher
+        from bitmex_watcher.async_watcher import AsyncMarketWatcher
+
+        for unsupported in [{'LEADER_ELECTION': True}, {'SYMBOLS': ['XBTUSD', 'ETHUSD']}]:
+            with mock.patch.dict(settings, unsupported):
+                with self.assertRaises(ValueError):
+                    AsyncMarketWatcher(None, _FakeBitMEXClient([]), _FakeAsyncMongoClient(), _FakeAsyncRedis(),
+                                       WsMessageDispatcher(), self.loop)
+
+        # Reconnecting would block the event loop. The watcher exits on a stale feed instead.
+        watcher = AsyncMarketWatcher(None, _FakeBitMEXClient([]), _FakeAsyncMongoClient(), _FakeAsyncRedis(),
+                                     WsMessageDispatcher(), self.loop)
+        self.assertIsNone(watcher._create_ws_reconnector())
+
+    def test_wake_up_from_websocket_thread(self):
+        from bitmex_watcher.settings import settings
+        from bitmex_watcher.ws_events import WsMessageDispatcher
+        from bitmex_watcher.async_watcher import AsyncMarketWatcher
+
+        dispatcher = WsMessageDispatcher()
+        with mock.patch.dict(settings, {'CAPTURE_MODE': 'event', 'LOOP_INTERVAL': 10.0}):
+            watcher = AsyncMarketWatcher(None, _FakeBitMEXClient([]), _FakeAsyncMongoClient(), _FakeAsyncRedis(),
+                                         dispatcher, self.loop)
+            threading.Timer(0.05, dispatcher.dispatch, args=['{}']).start()
+            start = monotonic()
+            self.loop.run_until_complete(watcher.wait_for_next_capture())
+        self.assertLess(monotonic() - start, 5.0)
@@ -0,0 +1,158 @@
+import os
+import json
+import threading
+import unittest
+from time import sleep, monotonic
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, parse_qs
+from socketserver import ThreadingMixIn
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+os.environ.setdefault('MARKET_ORDER_BOOK_DATA_NAME', 'orderBookL2_25')
+
+_START = datetime(2019, 4, 13, 12, 0, 0, tzinfo=timezone.utc)
+
+
+def _trade_row(i):
+    return {'timestamp': (_START + timedelta(seconds=i)).strftime("%Y-%m-%dT%H:%M:%S.%fZ"), 'symbol': 'XBTUSD',
+            'side': 'Buy', 'size': 1, 'price': 5000.5, 'trdMatchID': '%03d' % i}
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+###
+# GET /api/v1/trade of BitMEX over the given trades, rate limited once if asked.
+##
+class _StubBitMEX:
+
+    def __init__(self, rows, num_rate_limited=0):
+        stub = self
+        self.rows = rows
+        self.num_rate_limited = num_rate_limited
+        self.request_times = []
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != '/api/v1/trade':
+                    self.send_error(404)
+                    return
+                stub.request_times.append(monotonic())
+                if 0 < stub.num_rate_limited:
+                    stub.num_rate_limited -= 1
+                    self.send_response(429)
+                    self.send_header('Retry-After', '0')
+                    self.end_headers()
+                    return
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                rows = [r for r in stub.rows if r['symbol'] == query['symbol'] and
+                        query['startTime'] <= r['timestamp'] <= query['endTime']]
+                start = int(query['start'])
+                body = json.dumps(rows[start:start + int(query['count'])]).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = 'http://127.0.0.1:{:d}/api/v1/'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestBackfill(unittest.TestCase):
+
+    def test_paging(self):
+        from bitmex_watcher.backfill import TradesBackfiller, create_rest_client
+        from bitmex_watcher.models import TradesCursor
+
+        stub = _StubBitMEX([_trade_row(i) for i in range(10)], num_rate_limited=1)
+        saved = []
+        try:
+            backfiller = TradesBackfiller(create_rest_client(stub.base_url, 'XBTUSD'), 'XBTUSD', saved.append,
+                                          page_size=3, request_interval=0.1)
+            # Trades 2 to 6, before the websocket starts again with trade 7.
+            num_trades = backfiller.backfill(TradesCursor(_START + timedelta(seconds=1), '001'),
+                                             TradesCursor(_START + timedelta(seconds=7), '007'))
+        finally:
+            stub.stop()
+        self.assertEqual(5, num_trades)
+        self.assertEqual([['002', '003'], ['004', '005', '006']],
+                         [[t.trd_match_id for t in page] for page in saved])
+        # The first request is rate limited. Pages of the trades 1-3, 4-6 and 7.
+        self.assertEqual(4, backfiller.num_requests)
+        intervals = [b - a for a, b in zip(stub.request_times, stub.request_times[1:])]
+        # Measured by the server, give or take the scheduling of its threads.
+        self.assertTrue(all(0.08 <= each for each in intervals), intervals)
+
+    def test_gap(self):
+        for write_mode in ['sync', 'async']:
+            with self.subTest(write_mode=write_mode):
+                self.backfill_gap(write_mode)
+
+    def backfill_gap(self, write_mode):
+        from bitmex_watcher.memory_stores import InMemoryMongoClient, InMemoryRedis
+        from bitmex_watcher.replay import ReplayBitMEXClient, ReplayMarketWatcher
+        from bitmex_watcher.settings import settings
+
+        stub = _StubBitMEX([_trade_row(i) for i in range(7)])
+        bitmex_client = ReplayBitMEXClient('XBTUSD')
+        ws_client = bitmex_client.ws_client
+        ws_client.feed(_START, {'table': 'instrument', 'action': 'partial', 'keys': ['symbol'],
+                                'data': [{'symbol': 'XBTUSD', 'state': 'Open', 'tickSize': 0.5}]})
+        ws_client.feed(_START, {'table': 'trade', 'action': 'partial', 'keys': [], 'data': [_trade_row(0)]})
+        ws_client.feed(_START, {'table': 'orderBookL2_25', 'action': 'partial', 'keys': ['symbol', 'id', 'side'],
+                                'data': [{'symbol': 'XBTUSD', 'id': 10000, 'side': 'Buy', 'size': 100, 'price': 5000.0},
+                                         {'symbol': 'XBTUSD', 'id': 10001, 'side': 'Sell', 'size': 10,
+                                          'price': 5000.5}]})
+        try:
+            with mock.patch.dict(settings, {'TRADES_BACKFILL': True, 'BASE_URL': stub.base_url,
+                                            'TRADES_BACKFILL_REQUEST_INTERVAL': 0.01,
+                                            'TRADES_ROLLUPS': [(1, 86400), (60, 86400)],
+                                            'MONGO_WRITE_MODE': write_mode}):
+                watcher = ReplayMarketWatcher('XBTUSD', bitmex_client, InMemoryMongoClient(), InMemoryRedis())
+                watcher.load_state()
+                self.assertTrue(watcher.capture_once())
+                # The recent trades table rolls over: trades 1 to 4 are gone before the next capture.
+                ws_client.feed(_START + timedelta(seconds=6), {'table': 'trade', 'action': 'partial', 'keys': [],
+                                                               'data': [_trade_row(5), _trade_row(6)]})
+                self.assertTrue(watcher.capture_once())
+                # The next capture finds no gap.
+                self.assertTrue(watcher.capture_once())
+
+                # The backfilled trades are saved by the captures.
+                deadline = monotonic() + 5.0
+                while watcher.metrics.counters['backfilled_trades'] < 4 and monotonic() < deadline:
+                    sleep(0.01)
+                    self.assertTrue(watcher.capture_once())
+                watcher.exit()
+        finally:
+            stub.stop()
+
+        saved_trades = list(watcher.trades_collection.find().sort('timestamp'))
+        self.assertEqual(['%03d' % i for i in range(7)], [t['trdMatchID'] for t in saved_trades])
+        # Trade 5 is saved by the capture.
+        self.assertEqual(4, watcher.metrics.counters['backfilled_trades'])
+        self.assertEqual(1, watcher.trades_backfiller.num_requests)
+        # The rollups include the backfilled trades, those of the completed buckets and of the ones in progress.
+        seconds = list(watcher.trades_rollup_collections[1].find().sort('timestamp'))
+        self.assertEqual([1] * 7, [b['count'] for b in seconds])
+        minute = list(watcher.trades_rollup_collections[60].find())
+        self.assertEqual([7], [b['count'] for b in minute])
+        self.assertEqual('006', minute[0]['lastTrdMatchID'])
+
+
+if __name__ == "__main__":
+    unittest.main()
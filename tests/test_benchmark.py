@@ -0,0 +1,45 @@
+import os
+import json
+import unittest
+
+
+os.environ.setdefault('MARKET_ORDER_BOOK_DATA_NAME', 'orderBookL2_25')
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_synthetic_data(self):
+        from datetime import datetime, timezone
+        from bitmex_watcher.benchmark import synthetic_book, synthetic_trades
+
+        bids, asks = synthetic_book(100)
+        self.assertEqual(100, len(bids))
+        self.assertLess(bids[0]["price"], asks[0]["price"])
+        self.assertEqual(sorted(bids, key=lambda b: -b["price"]), bids)
+        trades = synthetic_trades(50, datetime(2019, 4, 13, tzinfo=timezone.utc))
+        self.assertEqual(sorted(trades, key=lambda t: (t.timestamp, t.trd_match_id)), trades)
+
+    def test_run_all(self):
+        from bitmex_watcher.benchmark import run_all, compare
+
+        report = run_all(book_levels=[25], trade_bursts=[(20, 5)], min_seconds=0.0, min_iterations=3)
+        # Machine-readable, to be compared across commits.
+        report = json.loads(json.dumps(report))
+        names = [r['name'] for r in report['results']]
+        self.assertEqual(['OrderBookSnapshot.__init__', 'OrderBookSnapshot.digest_string', 'OrderBookSnapshot.to_dict',
+                          'MarketWatcher.filter_new_trades', 'TradesCursor.is_behind_of',
+                          'MarketWatcher.capture_once'], names)
+        for result in report['results']:
+            self.assertEqual(3, result['iterations'])
+            latency = result['latencyMicros']
+            self.assertLessEqual(latency['p50'], latency['p99'])
+            self.assertLessEqual(latency['p99'], latency['max'])
+            self.assertLessEqual(0, result['peakBytesPerOp'])
+
+        comparisons = compare(report, report)
+        self.assertEqual(len(names), len(comparisons))
+        self.assertTrue(all(latency_ratio == 1.0 for _, _, latency_ratio, _ in comparisons))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import unittest
+from time import sleep
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+
+
+os.environ.setdefault('MARKET_ORDER_BOOK_DATA_NAME', 'orderBookL2_25')
+
+_START = datetime(2019, 4, 13, 12, 0, 0, tzinfo=timezone.utc)
+
+
+def _trade_message(i):
+    timestamp = (_START + timedelta(seconds=i)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    return {'table': 'trade', 'action': 'insert', 'data': [
+        {'timestamp': timestamp, 'symbol': 'XBTUSD', 'side': 'Buy', 'size': 1, 'price': 5000.5,
+         'trdMatchID': '%03d' % i}]}
+
+
+class TestLeaderLease(unittest.TestCase):
+
+    def test_single_leader(self):
+        from bitmex_watcher.leader_lease import LeaderLease
+        from bitmex_watcher.memory_stores import InMemoryRedis
+
+        redis = InMemoryRedis()
+        leader = LeaderLease(redis, 'leader', 'a', 5.0)
+        standby = LeaderLease(redis, 'leader', 'b', 5.0)
+        self.assertTrue(leader.hold())
+        self.assertFalse(standby.hold())
+        self.assertEqual('a', standby.holder())
+
+        # Only the holder releases the lease.
+        standby.release()
+        self.assertEqual('a', standby.holder())
+        leader.release()
+        self.assertFalse(leader.is_leader)
+        self.assertTrue(standby.hold())
+        self.assertFalse(leader.hold())
+
+    def test_expiry(self):
+        from bitmex_watcher.leader_lease import LeaderLease
+        from bitmex_watcher.memory_stores import InMemoryRedis
+
+        redis = InMemoryRedis()
+        leader = LeaderLease(redis, 'leader', 'a', 0.3)
+        standby = LeaderLease(redis, 'leader', 'b', 0.3)
+        self.assertTrue(leader.hold())
+        # Renewed every third of the TTL.
+        for _ in range(3):
+            sleep(0.12)
+            self.assertTrue(leader.hold())
+            self.assertFalse(standby.hold())
+
+        # The leader stops renewing, e.g. it has crashed. It steps down before the key expires.
+        sleep(0.32)
+        self.assertTrue(standby.hold())
+        self.assertFalse(leader.hold())
+        self.assertEqual('b', leader.holder())
+
+
+class TestFailover(unittest.TestCase):
+
+    def test_take_over(self):
+        from bitmex_watcher.memory_stores import InMemoryMongoClient, InMemoryRedis
+        from bitmex_watcher.replay import ReplayBitMEXClient, ReplayMarketWatcher, Replayer, messages_from_documents
+        from bitmex_watcher.settings import settings
+
+        snapshot = {'timestamp': _START, 'bids': [{'price': 5000.0, 'size': 100}],
+                    'asks': [{'price': 5000.5, 'size': 10}]}
+        mongo_client = InMemoryMongoClient()
+        redis = InMemoryRedis()
+        with mock.patch.dict(settings, {'LEADER_ELECTION': True}):
+            replayers = []
+            watchers = []
+            for _ in range(2):
+                bitmex_client = ReplayBitMEXClient('XBTUSD')
+                replayer = Replayer(bitmex_client, messages_from_documents('XBTUSD', 0.5, [], [snapshot]))
+                replayer.prime()
+                replayers.append(replayer)
+                watchers.append(ReplayMarketWatcher('XBTUSD', bitmex_client, mongo_client, redis))
+            leader, standby = watchers
+            for watcher in watchers:
+                watcher.load_state()
+
+            def feed_trade(i):
+                for replayer in replayers:
+                    replayer.feed(_START + timedelta(seconds=i), _trade_message(i))
+
+            feed_trade(1)
+            self.assertTrue(leader.capture_once())
+            self.assertTrue(standby.capture_once())
+            self.assertTrue(leader.leader_lease.is_leader)
+            self.assertFalse(standby.leader_lease.is_leader)
+            self.assertEqual(1, leader.metrics.gauge_values()['is_leader'])
+            self.assertEqual(0, standby.metrics.gauge_values()['is_leader'])
+
+            feed_trade(2)
+            self.assertTrue(leader.capture_once())
+            self.assertTrue(standby.capture_once())
+            # The leader stops after trade 3 arrives, before capturing it.
+            feed_trade(3)
+            leader.exit()
+            self.assertTrue(standby.capture_once())
+            self.assertTrue(standby.leader_lease.is_leader)
+            feed_trade(4)
+            self.assertTrue(standby.capture_once())
+            standby.exit()
+
+        # Every trade is saved once, and only the leader of the time published.
+        saved_trades = list(leader.trades_collection.find().sort('timestamp'))
+        self.assertEqual(['001', '002', '003', '004'], [t['trdMatchID'] for t in saved_trades])
+        self.assertEqual('004', leader.load_trades_cursor().trd_match_id)
+        # The new leader saves the unchanged book again, as the first snapshot of its own.
+        self.assertEqual(2, len(list(leader.order_book_snapshot_collection.find())))
+        self.assertEqual(2, len([c for c, m in redis.messages if m != '*']))
+
+
+if __name__ == "__main__":
+    unittest.main()
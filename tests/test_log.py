@@ -0,0 +1,79 @@
+import os
+import logging
+import threading
+import unittest
+from unittest import mock
+
+
+os.environ.setdefault('MARKET_ORDER_BOOK_DATA_NAME', 'orderBookL2_25')
+
+
+class _RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        super(_RecordingHandler, self).__init__()
+        self.messages = []
+        self.threads = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+        self.threads.append(threading.current_thread())
+
+
+class _Lazy:
+
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return "lazy"
+
+
+class TestLog(unittest.TestCase):
+
+    def test_queue_handler(self):
+        from bitmex_watcher.utils.log import use_queue_handler
+
+        logger = logging.getLogger('test_queue_handler')
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        handler = _RecordingHandler()
+        logger.addHandler(handler)
+        listener = use_queue_handler(logger)
+        # Installed once.
+        self.assertIsNone(use_queue_handler(logger))
+
+        lazy = _Lazy()
+        logger.info("Formatted by the listener: %s", lazy)
+        logger.debug("Not formatted at all: %s", lazy)
+        listener.stop()
+
+        self.assertEqual(["Formatted by the listener: lazy"], handler.messages)
+        self.assertEqual(1, lazy.formatted)
+        self.assertIsNot(threading.current_thread(), handler.threads[0])
+
+    def test_production_mode(self):
+        from datetime import datetime, timedelta, timezone
+        from bitmex_watcher.settings import settings
+        from bitmex_watcher.replay import messages_from_documents, replay
+
+        start = datetime(2019, 4, 13, 12, 0, 0, tzinfo=timezone.utc)
+        trades = [{'timestamp': start + timedelta(seconds=i), 'trdMatchID': '%03d' % i, 'side': 'Buy',
+                   'price': 5000.5, 'size': 1} for i in range(10)]
+        snapshots = [{'timestamp': start + timedelta(seconds=i), 'bids': [{'price': 5000.0, 'size': 100 + i}],
+                      'asks': [{'price': 5000.5, 'size': 10}]} for i in range(10)]
+        with mock.patch.dict(settings, {'LOG_MODE': 'production', 'LOG_SUMMARY_INTERVAL': 3, 'LOOP_INTERVAL': 1.0}):
+            with self.assertLogs('root', level=logging.INFO) as logs:
+                replay(messages_from_documents('XBTUSD', 0.5, trades, snapshots), capture_interval=1.0)
+
+        # Only the summaries (and the start and the end) are logged in INFO, not every capture.
+        summaries = [line for line in logs.output if 'SUMMARY[XBTUSD]' in line]
+        self.assertEqual(3, len(summaries))
+        # Captures at 0, 1, 2 and 3 seconds see what has arrived before them.
+        self.assertIn("4 captures, 3 new trades, 3 order book snapshots", summaries[0])
+        self.assertFalse(any('LOOP_HEAD' in line for line in logs.output))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import json
+import unittest
+from urllib.request import urlopen
+from urllib.error import HTTPError
+
+
+os.environ.setdefault('MARKET_ORDER_BOOK_DATA_NAME', 'orderBookL2_25')
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        from bitmex_watcher.metrics import Histogram
+
+        histogram = Histogram((0.001, 0.01, 0.1))
+        self.assertIsNone(histogram.quantile(0.5))
+        for value in [0.0005] * 5 + [0.005] * 4 + [1.0]:
+            histogram.observe(value)
+        self.assertEqual([5, 4, 0, 1], histogram.counts)
+        self.assertEqual(0.001, histogram.quantile(0.5))
+        self.assertEqual(0.01, histogram.quantile(0.9))
+        self.assertEqual(float('inf'), histogram.quantile(0.99))
+
+    def test_watcher_metrics(self):
+        from bitmex_watcher.metrics import WatcherMetrics, MetricsServer
+
+        metrics = WatcherMetrics('XBTUSD')
+        with metrics.time('snapshot_build'):
+            pass
+        metrics.observe_lag('trade_to_saved', 0.2)
+        metrics.count('trades', 3)
+        metrics.add_gauge('orders_idle_count', lambda: 2)
+        metrics.sample()
+        metrics.count('trades', 3)
+        metrics.sample()
+
+        document = json.loads(metrics.to_json())
+        self.assertEqual(1, document['stages']['snapshot_build']['count'])
+        self.assertEqual(0, document['stages']['snapshot_insert']['count'])
+        self.assertEqual(0.25, document['lags']['trade_to_saved']['p50'])
+        self.assertEqual(6, document['counters']['trades'])
+        self.assertLess(0.0, document['rates']['trades'])
+        self.assertEqual(2, document['gauges']['orders_idle_count'])
+
+        server = MetricsServer(0, [metrics], host='127.0.0.1').start()
+        try:
+            text = urlopen("http://127.0.0.1:{:d}/metrics".format(server.port)).read().decode('utf-8')
+            with self.assertRaises(HTTPError):
+                urlopen("http://127.0.0.1:{:d}/".format(server.port))
+        finally:
+            server.stop()
+        lines = text.splitlines()
+        self.assertIn('bitmex_watcher_trades_total{symbol="XBTUSD"} 6', lines)
+        self.assertIn('bitmex_watcher_stage_seconds_count{symbol="XBTUSD",stage="snapshot_build"} 1', lines)
+        self.assertIn('bitmex_watcher_lag_seconds_bucket{symbol="XBTUSD",lag="trade_to_saved",le="0.25"} 1', lines)
+        self.assertIn('bitmex_watcher_orders_idle_count{symbol="XBTUSD"} 2.0', lines)
+
+    def test_capture_stages(self):
+        from datetime import datetime, timedelta, timezone
+        from bitmex_watcher.replay import messages_from_documents, replay
+
+        start = datetime(2019, 4, 13, 12, 0, 0, tzinfo=timezone.utc)
+        trades = [{'timestamp': start + timedelta(seconds=i), 'trdMatchID': '%03d' % i, 'side': 'Buy',
+                   'price': 5000.5, 'size': 1} for i in range(3)]
+        snapshots = [{'timestamp': start + timedelta(seconds=i), 'bids': [{'price': 5000.0, 'size': 100 + i}],
+                      'asks': [{'price': 5000.5, 'size': 10}]} for i in range(3)]
+        stats, watcher = replay(messages_from_documents('XBTUSD', 0.5, trades, snapshots), capture_interval=1.0)
+
+        document = watcher.metrics.to_dict()
+        self.assertEqual(stats['captures'], document['counters']['captures'])
+        self.assertEqual(3, document['counters']['trades'])
+        self.assertEqual(3, document['counters']['order_book_snapshots'])
+        for stage in ['capture', 'ws_fetch_trades', 'trade_filter', 'mongo_trade_insert', 'ws_fetch_order_book',
+                      'snapshot_build', 'book_diff', 'snapshot_insert', 'redis_publish']:
+            self.assertLess(0, document['stages'][stage]['count'], stage)
+        # On the recorded clock, trades wait for the next capture a second later at most.
+        self.assertEqual(3, document['lags']['trade_to_saved']['count'])
+        self.assertEqual(1.0, document['lags']['trade_to_saved']['p99'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -81,6 +81,111 @@ class TestOrderBookSnapshot(unittest.TestCase):
         self.assertEqual(depth.bids_ratio, d["bidsRatio"])
         self.assertEqual(depth.total_volume, d["totalVolume"])
 
+    def test_changes_from(self):
+
+        from bitmex_watcher.utils import constants
+        from bitmex_watcher.models import OrderBookSnapshot
+
+        now = datetime.now().astimezone(constants.TIMEZONE)
+        bids = [{"price": 100.0, "size": 100}, {"price": 99.5, "size": 200}]
+        asks = [{"price": 100.5, "size": 10}, {"price": 101.0, "size": 50}]
+        depth = OrderBookSnapshot(now, bids, asks, 0.0075)
+
+        changes = depth.changes_from(None)
+        self.assertEqual(4, len(changes))
+
+        same_depth = OrderBookSnapshot(now, [dict(b) for b in bids], [dict(a) for a in asks], 0.0075)
+        self.assertTrue(same_depth.is_same_book_as(depth))
+        self.assertTrue(same_depth.changes_from(depth).is_empty())
+
+        bids2 = [{"price": 100.0, "size": 120}, {"price": 99.5, "size": 200}]
+        asks2 = [{"price": 101.0, "size": 50}, {"price": 101.5, "size": 5}]
+        depth2 = OrderBookSnapshot(now, bids2, asks2, 0.0075)
+        self.assertFalse(depth2.is_same_book_as(depth))
+        changes = depth2.changes_from(depth)
+        # 99.5 and 101.5 are out of the price range of the new mid price.
+        self.assertEqual([{"price": 100.0, "size": 120}, {"price": 99.5, "size": 0}], changes.bids)
+        self.assertEqual([{"price": 100.5, "size": 0}], changes.asks)
+
+        depth3 = OrderBookSnapshot(now, bids2, asks2, 25)
+        changes = depth3.changes_from(OrderBookSnapshot(now, bids, asks, 25))
+        self.assertEqual([{"price": 100.0, "size": 120}], changes.bids)
+        self.assertEqual([{"price": 101.5, "size": 5}, {"price": 100.5, "size": 0}], changes.asks)
+        self.assertEqual({'bids': changes.bids, 'asks': changes.asks}, changes.to_dict())
+        self.assertTrue(0 < len(str(changes)))
+
+    def test_payload(self):
+
+        from bitmex_watcher.utils import constants
+        from bitmex_watcher.models import OrderBookSnapshot, parse_order_book_payload
+
+        now = datetime.now().astimezone(constants.TIMEZONE)
+        bids = [{"price": 100.0, "size": 100}, {"price": 99.5, "size": 200}]
+        asks = [{"price": 100.5, "size": 10}, {"price": 101.0, "size": 50}]
+        depth = OrderBookSnapshot(now, bids, asks, 0.0075)
+
+        payload = parse_order_book_payload(depth.to_payload(1, "5cb1d3b0e1382300014e6a4b"))
+        self.assertEqual("5cb1d3b0e1382300014e6a4b", payload["id"])
+        self.assertEqual(now, payload["timestamp"])
+        self.assertEqual(depth.mid_price, payload["midPrice"])
+        self.assertEqual(depth.total_volume, payload["totalVolume"])
+        self.assertEqual(bids[:1], payload["bids"])
+        self.assertEqual(asks[:1], payload["asks"])
+
+    def test_bytes(self):
+
+        from bitmex_watcher.utils import constants
+        from bitmex_watcher.models import OrderBookSnapshot, parse_order_book_bytes, parse_order_book_message
+
+        now = datetime.now().astimezone(constants.TIMEZONE)
+        bids = [{"price": 170.05, "size": 100}, {"price": 170.0, "size": 4000000000}, {"price": 169.95, "size": 1}]
+        asks = [{"price": 170.1, "size": 10}, {"price": 170.15, "size": 50}]
+        depth = OrderBookSnapshot(now, bids, asks, 0.0075)
+
+        decoded = OrderBookSnapshot.from_bytes(depth.to_bytes(0.05))
+        self.assertEqual(depth.to_dict(), decoded.to_dict())
+
+        data = depth.to_bytes(0.05, 2, "5cb1d3b0e1382300014e6a4b")
+        self.assertLess(len(data), len(str(depth.to_dict())))
+        payload = parse_order_book_bytes(data)
+        self.assertEqual("5cb1d3b0e1382300014e6a4b", payload["id"])
+        self.assertEqual(bids[:2], payload["bids"])
+        self.assertEqual(169.95, payload["lowestBid"])
+        self.assertEqual(depth.bids_volume, payload["bidsVolume"])
+        self.assertEqual(payload, parse_order_book_message(data))
+        self.assertEqual(bids[:2], parse_order_book_message(depth.to_payload(2, None))["bids"])
+
+        with self.assertRaises(ValueError):
+            OrderBookSnapshot.from_bytes(b'BW\x02' + data[3:])
+
+        # A price of more ticks than fit in the wire format.
+        with self.assertRaises(ValueError):
+            OrderBookSnapshot(now, [{"price": 5000.0, "size": 1}], [{"price": 5000.5, "size": 1}], 25).to_bytes(1e-6)
+
+    def test_trades_bytes(self):
+
+        from pybitmex import Trade
+        from bitmex_watcher.utils import constants
+        from bitmex_watcher.models import trades_to_bytes, trades_from_bytes, trades_to_payload, parse_trades_payload
+        from bitmex_watcher.models import parse_trades_message
+
+        now = datetime.now().astimezone(constants.TIMEZONE)
+        trades = [Trade("00f5a8e1-7c1c-4a55-b0b1-a0d14b6c7e1d", now, "Buy", 5000.5, 10),
+                  Trade("b7d3f0e5-6c71-2d4b-31a9-7e2cf7e8a5f4", now, "Sell", 5000.0, 2500000)]
+        decoded = trades_from_bytes(trades_to_bytes(trades, 0.5))
+        self.assertEqual([t.to_dict() for t in trades], [t.to_dict() for t in decoded])
+        self.assertEqual([], trades_from_bytes(trades_to_bytes([], 0.5)))
+        decoded = parse_trades_payload(trades_to_payload(trades))
+        self.assertEqual([t.to_dict() for t in trades], [t.to_dict() for t in decoded])
+
+        # Published in JSON instead, since the ids would not be decoded as they are.
+        for trd_match_id in ["005", "00F5A8E1-7C1C-4A55-B0B1-A0D14B6C7E1D", None]:
+            with self.assertRaises(ValueError):
+                trades_to_bytes([Trade(trd_match_id, now, "Buy", 5000.5, 10)], 0.5)
+        decoded = parse_trades_message(trades_to_payload([Trade("005", now, "Buy", 5000.5, 10)]))
+        self.assertEqual(["005"], [t.trd_match_id for t in decoded])
+        self.assertEqual(2, len(parse_trades_message(trades_to_bytes(trades, 0.5))))
+
 
 class TestTrade(unittest.TestCase):
 
@@ -0,0 +1,266 @@
+import os
+import threading
+import unittest
+from unittest import mock
+from time import sleep, monotonic
+from datetime import datetime, timedelta, timezone
+
+os.environ.setdefault('MARKET_ORDER_BOOK_DATA_NAME', 'orderBookL2_25')
+
+_START = datetime(2019, 4, 13, 12, 0, 0, tzinfo=timezone.utc)
+
+
+def _create_collection(full_name, num_failures=0, blocker=None, error=None):
+    from bitmex_watcher.memory_stores import InMemoryCollection
+
+    ###
+    # Fails the first num_failures bulk writes with the error, after the blocker is set.
+    ##
+    class _FlakyCollection(InMemoryCollection):
+
+        def __init__(self):
+            super().__init__(*full_name.split('.'))
+            self.num_failures = num_failures
+            self.num_bulk_writes = 0
+
+        def bulk_write(self, requests, ordered=True):
+            from pymongo.errors import AutoReconnect
+
+            if blocker is not None:
+                blocker.wait()
+            self.num_bulk_writes += 1
+            if 0 < self.num_failures:
+                self.num_failures -= 1
+                raise error or AutoReconnect("primary stepped down")
+            super().bulk_write(requests, ordered)
+
+    return _FlakyCollection()
+
+
+class TestMongoWriter(unittest.TestCase):
+
+    def test_batches_and_callbacks(self):
+        from pymongo import InsertOne
+        from bitmex_watcher.mongo_writer import MongoWriter
+
+        trades = _create_collection("bitmex_data.trades", num_failures=1)
+        cursor = _create_collection("bitmex_data.trades_cursor")
+        written = []
+        writer = MongoWriter(max_queue_size=100, flush_size=10, flush_interval=0.05)
+        for i in range(5):
+            writer.write(trades, InsertOne({'i': i}))
+        writer.write(cursor, InsertOne({'i': 4}), on_written=lambda: written.append(len(trades.find())))
+        writer.start()
+        writer.stop()
+
+        self.assertEqual(list(range(5)), [d['i'] for d in trades.find()])
+        self.assertEqual([5], written)
+        stats = writer.stats()
+        self.assertEqual(6, stats['written'])
+        self.assertEqual(1, stats['retried'])
+        self.assertEqual(0, stats['queueDepth'])
+
+    def test_overflow(self):
+        from pymongo import InsertOne
+        from bitmex_watcher.mongo_writer import MongoWriter
+
+        with self.assertRaises(ValueError):
+            MongoWriter(max_queue_size=2, flush_size=10, flush_interval=0.01, overflow_policy='unknown')
+
+        for policy, expected in [(MongoWriter.OVERFLOW_DROP_NEWEST, [0, 1]),
+                                 (MongoWriter.OVERFLOW_DROP_OLDEST, [2, 3])]:
+            blocker = threading.Event()
+            collection = _create_collection("bitmex_data.trades", blocker=blocker)
+            writer = MongoWriter(max_queue_size=2, flush_size=10, flush_interval=0.01, overflow_policy=policy)
+            results = [writer.write(collection, InsertOne({'i': i})) for i in range(4)]
+            blocker.set()
+            writer.start()
+            writer.stop()
+
+            self.assertEqual(policy == MongoWriter.OVERFLOW_DROP_OLDEST, all(results))
+            self.assertEqual(2, writer.stats()['dropped'])
+            self.assertEqual(expected, [d['i'] for d in collection.find()])
+
+        # Tasks are never dropped. The oldest write after them is, and its on_failed is called.
+        blocker = threading.Event()
+        collection = _create_collection("bitmex_data.trades", blocker=blocker)
+        writer = MongoWriter(max_queue_size=2, flush_size=10, flush_interval=0.01,
+                             overflow_policy=MongoWriter.OVERFLOW_DROP_OLDEST)
+        tasks = []
+        failed = []
+        writer.run(lambda: tasks.append(len(collection.find())))
+        for i in range(3):
+            writer.write(collection, InsertOne({'i': i}), on_failed=lambda i=i: failed.append(i))
+        blocker.set()
+        writer.start()
+        writer.stop()
+        self.assertEqual([0], tasks)
+        self.assertEqual([0, 1], failed)
+        self.assertEqual([2], [d['i'] for d in collection.find()])
+
+    def test_tasks(self):
+        from pymongo import InsertOne
+        from bitmex_watcher.mongo_writer import MongoWriter
+
+        collection = _create_collection("bitmex_data.trades_20190413")
+        writer = MongoWriter(max_queue_size=100, flush_size=10, flush_interval=0.01)
+        # Run before the writes queued after it, even in the same batch.
+        writer.run(lambda: collection.create_index([("trdMatchID", 1)], unique=True))
+        for _ in range(2):
+            writer.write(collection, InsertOne({'trdMatchID': 'a'}))
+        writer.start()
+        writer.stop()
+
+        self.assertEqual(['a'], [d['trdMatchID'] for d in collection.find()])
+        self.assertEqual(1, writer.stats()['duplicated'])
+
+    def test_failure(self):
+        from pymongo import InsertOne
+        from pymongo.errors import AutoReconnect, DocumentTooLarge
+        from bitmex_watcher.mongo_writer import MongoWriter
+
+        # Not retried, and the callbacks are not called.
+        collection = _create_collection("bitmex_data.trades", num_failures=1, error=DocumentTooLarge("too large"))
+        written = []
+        writer = MongoWriter(max_queue_size=100, flush_size=10, flush_interval=0.01)
+        for i in range(3):
+            writer.write(collection, InsertOne({'i': i}), on_written=lambda: written.append(True))
+        writer.start()
+        writer.stop()
+        self.assertEqual([], collection.find())
+        self.assertEqual([], written)
+        self.assertEqual(1, collection.num_bulk_writes)
+        self.assertEqual({'failed': 3, 'retried': 0}, {k: writer.stats()[k] for k in ('failed', 'retried')})
+
+        # Errors of the connection are retried up to MAX_RETRIES times.
+        collection = _create_collection("bitmex_data.trades", num_failures=100, error=AutoReconnect("down"))
+        writer = MongoWriter(max_queue_size=100, flush_size=10, flush_interval=0.01)
+        writer.write(collection, InsertOne({'i': 0}))
+        with mock.patch.object(MongoWriter, 'MAX_RETRIES', 2), mock.patch('bitmex_watcher.mongo_writer.sleep'):
+            writer.start()
+            deadline = monotonic() + 5.0
+            while writer.stats()['failed'] == 0 and monotonic() < deadline:
+                sleep(0.01)
+            writer.stop()
+        self.assertEqual(3, collection.num_bulk_writes)
+        self.assertEqual({'failed': 1, 'retried': 2}, {k: writer.stats()[k] for k in ('failed', 'retried')})
+
+
+class TestTradesCursor(unittest.TestCase):
+
+    def create_watcher(self):
+        from bitmex_watcher.memory_stores import InMemoryMongoClient, InMemoryRedis
+        from bitmex_watcher.replay import ReplayBitMEXClient, ReplayMarketWatcher, Replayer, messages_from_documents
+
+        snapshot = {'timestamp': _START, 'bids': [{'price': 5000.0, 'size': 100}],
+                    'asks': [{'price': 5000.5, 'size': 10}]}
+        bitmex_client = ReplayBitMEXClient('XBTUSD')
+        Replayer(bitmex_client, messages_from_documents('XBTUSD', 0.5, [], [snapshot])).prime()
+        watcher = ReplayMarketWatcher('XBTUSD', bitmex_client, InMemoryMongoClient(), InMemoryRedis())
+        watcher.load_state()
+        return watcher
+
+    @staticmethod
+    def feed_trade(watcher, i):
+        timestamp = _START + timedelta(seconds=i)
+        watcher.bitmex_client.ws_client.feed(timestamp, {'table': 'trade', 'action': 'insert', 'data': [
+            {'timestamp': timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), 'symbol': 'XBTUSD', 'side': 'Buy',
+             'size': 1, 'price': 5000.5, 'trdMatchID': '%03d' % i}]})
+
+    @staticmethod
+    def wait_for_writes(watcher):
+        # Until every operation queued is written or failed.
+        deadline = monotonic() + 5.0
+        while monotonic() < deadline:
+            stats = watcher.mongo_writer.stats()
+            if stats['enqueued'] <= sum(stats[k] for k in ('written', 'duplicated', 'failed')):
+                return
+            sleep(0.01)
+
+    def test_failed_trades(self):
+        from pymongo.errors import OperationFailure
+        from bitmex_watcher.settings import settings
+
+        def feed_trade(i):
+            TestTradesCursor.feed_trade(watcher, i)
+
+        with mock.patch.dict(settings, {'MONGO_WRITE_MODE': 'async', 'TRADES_CURSOR_CHECKPOINT_BATCHES': 1}):
+            watcher = self.create_watcher()
+            feed_trade(1)
+            self.assertTrue(watcher.capture_once())
+            deadline = monotonic() + 5.0
+            while watcher.trades_cursor_collection.find_one() is None and monotonic() < deadline:
+                sleep(0.01)
+            self.assertEqual('001', watcher.load_trades_cursor().trd_match_id)
+
+            # The next trades are not written. The cursor stays before them.
+            with mock.patch.object(watcher.trades_collection, 'bulk_write', side_effect=OperationFailure("failed")):
+                for i in (2, 3):
+                    feed_trade(i)
+                    self.assertTrue(watcher.capture_once())
+                watcher.exit()
+
+        self.assertEqual('003', watcher.trades_cursor.trd_match_id)
+        self.assertEqual('001', watcher.load_trades_cursor().trd_match_id)
+        self.assertEqual(['001'], [t['trdMatchID'] for t in watcher.trades_collection.find()])
+        self.assertEqual(2, watcher.mongo_writer.stats()['failed'])
+
+    def test_later_trades_written(self):
+        from pymongo.errors import OperationFailure
+        from bitmex_watcher.settings import settings
+
+        with mock.patch.dict(settings, {'MONGO_WRITE_MODE': 'async', 'TRADES_CURSOR_CHECKPOINT_BATCHES': 1}):
+            watcher = self.create_watcher()
+            bulk_write = watcher.trades_collection.bulk_write
+
+            def fail_002(requests, ordered=True):
+                if any(r._doc['trdMatchID'] == '002' for r in requests):
+                    raise OperationFailure("failed")
+                return bulk_write(requests, ordered)
+
+            with mock.patch.object(watcher.trades_collection, 'bulk_write', side_effect=fail_002):
+                # Trade 2 fails, and the trades after it are written.
+                for i in range(1, 5):
+                    self.feed_trade(watcher, i)
+                    self.assertTrue(watcher.capture_once())
+                    self.wait_for_writes(watcher)
+                watcher.exit()
+
+        self.assertEqual(['001', '003', '004'], [t['trdMatchID'] for t in watcher.trades_collection.find()])
+        # The cursor stays before the lost trade.
+        self.assertEqual('001', watcher.load_trades_cursor().trd_match_id)
+        self.assertEqual(0, len(watcher.pending_trades_batches))
+
+    def test_exit(self):
+        from bitmex_watcher.settings import settings
+
+        with mock.patch.dict(settings, {'MONGO_WRITE_MODE': 'async', 'TRADES_CURSOR_CHECKPOINT_BATCHES': 100}):
+            # Every trade is written before the cursor is saved on exit.
+            watcher = self.create_watcher()
+            for i in range(1, 5):
+                self.feed_trade(watcher, i)
+                self.assertTrue(watcher.capture_once())
+            self.wait_for_writes(watcher)
+            watcher.exit()
+            self.assertEqual('004', watcher.load_trades_cursor().trd_match_id)
+
+            # The trades are still queued when the cursor is saved on exit.
+            watcher = self.create_watcher()
+            blocker = threading.Event()
+            bulk_write = watcher.trades_collection.bulk_write
+
+            def blocked_bulk_write(requests, ordered=True):
+                blocker.wait()
+                return bulk_write(requests, ordered)
+
+            with mock.patch.object(watcher.trades_collection, 'bulk_write', side_effect=blocked_bulk_write):
+                for i in range(1, 5):
+                    self.feed_trade(watcher, i)
+                    self.assertTrue(watcher.capture_once())
+                threading.Timer(0.1, blocker.set).start()
+                watcher.exit()
+            self.assertEqual('004', watcher.load_trades_cursor().trd_match_id)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+
+
+class _FakeWsClient:
+
+    def __init__(self):
+        self.endpoint = "https://www.bitmex.com/api/v1/"
+        self.data = {
+            'instrument': [{'symbol': 'XBTUSD', 'state': 'Open'}, {'symbol': 'ETHUSD', 'state': 'Closed'}],
+            'orderBookL2_25': [
+                {'symbol': 'XBTUSD', 'id': 1, 'side': 'Sell', 'size': 10, 'price': 5000.5},
+                {'symbol': 'ETHUSD', 'id': 2, 'side': 'Sell', 'size': 20, 'price': 170.05},
+                {'symbol': 'XBTUSD', 'id': 3, 'side': 'Buy', 'size': 30, 'price': 5000.0},
+            ],
+            'trade': [
+                {'symbol': 'ETHUSD', 'trdMatchID': 'b', 'timestamp': '2019-04-13T12:00:00.000Z',
+                 'side': 'Buy', 'price': 170.05, 'size': 1},
+                {'symbol': 'XBTUSD', 'trdMatchID': 'a', 'timestamp': '2019-04-13T12:00:00.000Z',
+                 'side': 'Buy', 'price': 5000.5, 'size': 1},
+            ]
+        }
+
+    def get_order_book_table_name(self):
+        return 'orderBookL2_25'
+
+    def market_depth(self):
+        return self.data['orderBookL2_25']
+
+    def recent_trades(self):
+        return self.data['trade']
+
+
+class TestMultiplex(unittest.TestCase):
+
+    def test_symbol_client(self):
+        from bitmex_watcher.multiplex import SymbolBitMEXClient
+
+        ws_client = _FakeWsClient()
+        xbt = SymbolBitMEXClient(ws_client, 'XBTUSD')
+        eth = SymbolBitMEXClient(ws_client, 'ETHUSD')
+
+        self.assertEqual('Open', xbt.ws_market_state())
+        self.assertEqual('Closed', eth.ws_market_state())
+        self.assertEqual(([{"price": 5000.0, "size": 30}], [{"price": 5000.5, "size": 10}]),
+                         xbt.ws_sorted_bids_and_asks_of_market())
+        self.assertEqual(([], [{"price": 170.05, "size": 20}]), eth.ws_sorted_bids_and_asks_of_market())
+        self.assertEqual(['a'], [t.trd_match_id for t in xbt.ws_sorted_recent_trade_objects_of_market()])
+
+    def test_subscription_url(self):
+        from bitmex_watcher.multiplex import MultiplexedWebSocketClient
+
+        # Not connected.
+        ws_client = MultiplexedWebSocketClient.__new__(MultiplexedWebSocketClient)
+        ws_client.endpoint = "https://www.bitmex.com/api/v1/"
+        ws_client.symbols = ['XBTUSD', 'ETHUSD']
+        ws_client.subscription_list = ['instrument', 'trade']
+        self.assertEqual(
+            "wss://www.bitmex.com/realtime?subscribe=instrument:XBTUSD,trade:XBTUSD,instrument:ETHUSD,trade:ETHUSD",
+            ws_client._BitMEXWebSocketClient__get_url())
+
+    def test_symbol_router(self):
+        from bitmex_watcher.multiplex import SymbolRouter
+
+        router = SymbolRouter(['XBTUSD', 'ETHUSD'])
+        received = {'XBTUSD': [], 'ETHUSD': []}
+        for symbol, dispatcher in router.dispatchers.items():
+            dispatcher.add_listener(received[symbol].append)
+
+        router.on_message({'table': 'trade', 'action': 'insert', 'data': [
+            {'symbol': 'XBTUSD', 'trdMatchID': 'a'}, {'symbol': 'ETHUSD', 'trdMatchID': 'b'},
+            {'symbol': 'XBTUSD', 'trdMatchID': 'c'}, {'symbol': 'LTCM19', 'trdMatchID': 'd'}
+        ]})
+        router.on_message({'table': 'orderBookL2', 'action': 'partial', 'filter': {'symbol': 'ETHUSD'}, 'data': []})
+
+        self.assertEqual(['a', 'c'], [r['trdMatchID'] for r in received['XBTUSD'][0]['data']])
+        self.assertEqual(['b'], [r['trdMatchID'] for r in received['ETHUSD'][0]['data']])
+        self.assertEqual('partial', received['ETHUSD'][1]['action'])
+        self.assertTrue(router.dispatchers['XBTUSD'].wait(0))
+
+    def test_last_update(self):
+        from bitmex_watcher.multiplex import SymbolBitMEXClient, SymbolRouter
+
+        router = SymbolRouter(['XBTUSD', 'ETHUSD'])
+        ws_client = _FakeWsClient()
+        xbt = SymbolBitMEXClient(ws_client, 'XBTUSD', router)
+        eth = SymbolBitMEXClient(ws_client, 'ETHUSD', router)
+        router.on_message({'table': 'trade', 'action': 'insert', 'data': [{'symbol': 'XBTUSD', 'trdMatchID': 'a'}]})
+
+        # The trades of XBTUSD do not keep ETHUSD from being idle.
+        self.assertIsNotNone(xbt.get_last_ws_update('trade'))
+        self.assertIsNone(xbt.get_last_ws_update('orderBookL2_25'))
+        self.assertIsNone(eth.get_last_ws_update('trade'))
+        router.on_message({'table': 'trade', 'action': 'partial', 'filter': {'symbol': 'ETHUSD'}, 'data': []})
+        self.assertLessEqual(xbt.get_last_ws_update('trade'), eth.get_last_ws_update('trade'))
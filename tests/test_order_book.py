@@ -0,0 +1,61 @@
+import unittest
+from datetime import datetime
+
+
+def _row(_id, side, price, size, symbol="XBTUSD"):
+    return {"symbol": symbol, "id": _id, "side": side, "price": price, "size": size}
+
+
+class TestIncrementalOrderBook(unittest.TestCase):
+
+    def test_apply_deltas(self):
+        from bitmex_watcher.order_book import IncrementalOrderBook
+
+        book = IncrementalOrderBook("orderBookL2")
+        book.on_message({"table": "orderBookL2", "action": "partial", "data": [
+            _row(1, "Sell", 101.0, 50), _row(2, "Sell", 100.5, 10),
+            _row(3, "Buy", 100.0, 100), _row(4, "Buy", 99.5, 200)
+        ]})
+        self.assertEqual((300, 60), book.volumes())
+
+        bids, asks = book.sorted_bids_and_asks()
+        self.assertEqual([{"price": 100.0, "size": 100}, {"price": 99.5, "size": 200}], bids)
+        self.assertEqual([{"price": 100.5, "size": 10}, {"price": 101.0, "size": 50}], asks)
+
+        version = book.version
+        book.on_message({"table": "orderBookL2", "action": "update", "data": [
+            {"symbol": "XBTUSD", "id": 3, "side": "Buy", "size": 30}
+        ]})
+        book.on_message({"table": "orderBookL2", "action": "delete", "data": [
+            {"symbol": "XBTUSD", "id": 2, "side": "Sell"}
+        ]})
+        book.on_message({"table": "orderBookL2", "action": "insert", "data": [_row(5, "Buy", 100.25, 5)]})
+        book.on_message({"table": "trade", "action": "insert", "data": [_row(6, "Buy", 100.5, 5)]})
+        self.assertEqual(version + 3, book.version)
+        self.assertEqual((235, 50), book.volumes())
+
+        bids, asks = book.sorted_bids_and_asks()
+        self.assertEqual([100.25, 100.0, 99.5], [b["price"] for b in bids])
+        self.assertEqual([{"price": 101.0, "size": 50}], asks)
+
+    def test_same_snapshot_as_full_book(self):
+        from bitmex_watcher.utils import constants
+        from bitmex_watcher.models import OrderBookSnapshot
+        from bitmex_watcher.order_book import IncrementalOrderBook
+
+        bids = [{"price": 99.0, "size": 200}, {"price": 98.5, "size": 10},
+                {"price": 98.0, "size": 250}, {"price": 97.0, "size": 100}]
+        asks = [{"price": 100.5, "size": 150}, {"price": 101.0, "size": 100},
+                {"price": 102.0, "size": 200}, {"price": 102.5, "size": 150}]
+        rows = [_row(i, "Buy", b["price"], b["size"]) for i, b in enumerate(bids)] +\
+               [_row(10 + i, "Sell", a["price"], a["size"]) for i, a in enumerate(asks)]
+        book = IncrementalOrderBook("orderBookL2", "XBTUSD")
+        book.reset(rows + [_row(99, "Buy", 99.5, 1, symbol="ETHUSD")])
+
+        now = datetime.now().astimezone(constants.TIMEZONE)
+        window_bids, window_asks = book.sorted_bids_and_asks(0.025)
+        self.assertEqual(3, len(window_bids))
+        self.assertEqual(3, len(window_asks))
+        expected = OrderBookSnapshot(now, bids, asks, 0.025).to_dict()
+        actual = OrderBookSnapshot(now, window_bids, window_asks, 0.025).to_dict()
+        self.assertEqual(expected, actual)
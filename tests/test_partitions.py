@@ -0,0 +1,102 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+
+
+_START = datetime(2019, 4, 13, 22, 30, 0, tzinfo=timezone.utc)
+
+
+class _FakeCursor(list):
+
+    def sort(self, key):
+        return self
+
+
+class _FakeCollection:
+
+    def __init__(self, name):
+        self.name = name
+        self.documents = []
+
+    def find(self, query):
+        condition = query["timestamp"]
+        return _FakeCursor(d for d in self.documents if condition["$gte"] <= d["timestamp"])
+
+
+class _FakeDatabase(dict):
+
+    def __missing__(self, name):
+        self[name] = _FakeCollection(name)
+        return self[name]
+
+    def list_collection_names(self):
+        return list(self.keys())
+
+    def drop_collection(self, name):
+        self.pop(name)
+
+
+class TestPartitionNames(unittest.TestCase):
+
+    def test_partition_name(self):
+        from bitmex_watcher.partitions import partition_name, DAY, HOUR
+
+        self.assertEqual("trades_20190413", partition_name("trades", _START, DAY))
+        self.assertEqual("trades_2019041322", partition_name("trades", _START, HOUR))
+        # In UTC.
+        tokyo = timezone(timedelta(hours=9))
+        self.assertEqual("trades_20190413", partition_name("trades", datetime(2019, 4, 14, 8, 0, tzinfo=tokyo), DAY))
+        # Naive datetimes from MongoDB are in UTC.
+        self.assertEqual("trades_2019041322", partition_name("trades", _START.replace(tzinfo=None), HOUR))
+
+    def test_expired_partition_names(self):
+        from bitmex_watcher.partitions import expired_partition_names, DAY
+
+        names = ["trades_20190410", "trades_20190411", "trades_20190412", "trades_20190413",
+                 "trades_cursor", "trades_rollup_1m", "order_book_snapshots_20190401"]
+        self.assertEqual(["trades_20190410", "trades_20190411"],
+                         expired_partition_names(names, "trades", DAY, _START, 24 * 60 * 60))
+
+
+class TestTimePartitionedCollection(unittest.TestCase):
+
+    def test_split_and_find(self):
+        from bitmex_watcher.partitions import TimePartitionedCollection, HOUR
+
+        db = _FakeDatabase()
+        initialized = []
+        partitioned = TimePartitionedCollection(db, "trades", HOUR, lambda c: initialized.append(c.name))
+        documents = [{"timestamp": _START + timedelta(minutes=20 * i), "i": i} for i in range(6)]
+        batches = partitioned.split(documents)
+        self.assertEqual(["trades_2019041322", "trades_2019041323", "trades_2019041400"],
+                         [c.name for c, _ in batches])
+        self.assertEqual([[0, 1], [2, 3, 4], [5]], [[d["i"] for d in b] for _, b in batches])
+        partitioned.split(documents)
+        self.assertEqual([c.name for c, _ in batches], initialized)
+        for collection, batch in batches:
+            collection.documents.extend(batch)
+
+        since = _START + timedelta(minutes=50)
+        found = partitioned.find({"timestamp": {"$gte": since}}, since, _START + timedelta(hours=2))
+        self.assertEqual([3, 4, 5], [d["i"] for d in found])
+        self.assertEqual(["trades_2019041323", "trades_2019041322"],
+                         [c.name for c in partitioned.partitions_before(since, 2)])
+
+    def test_partitions_for_id(self):
+        from bson.objectid import ObjectId
+        from bitmex_watcher.partitions import TimePartitionedCollection, HOUR
+
+        partitioned = TimePartitionedCollection(_FakeDatabase(), "snapshots", HOUR)
+        object_id = ObjectId.from_datetime(datetime(2019, 4, 13, 23, 0, 0, tzinfo=timezone.utc))
+        self.assertEqual(["snapshots_2019041323", "snapshots_2019041322"],
+                         [c.name for c in partitioned.partitions_for_id(object_id)])
+
+    def test_drop_expired(self):
+        from bitmex_watcher.partitions import TimePartitionedCollection, DAY
+
+        db = _FakeDatabase()
+        partitioned = TimePartitionedCollection(db, "trades", DAY)
+        for days in range(4):
+            partitioned.partition_for(_START - timedelta(days=days))
+        self.assertEqual(["trades_20190410", "trades_20190411"], partitioned.drop_expired(_START, 24 * 60 * 60))
+        self.assertEqual(["trades_20190412", "trades_20190413"], sorted(db.keys()))
+        self.assertEqual(["trades_20190412", "trades_20190413"], sorted(partitioned.partitions.keys()))
@@ -0,0 +1,97 @@
+import os
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+
+
+os.environ.setdefault('MARKET_ORDER_BOOK_DATA_NAME', 'orderBookL2_25')
+
+_START = datetime(2019, 4, 13, 12, 0, 0, tzinfo=timezone.utc)
+
+
+def _trade_row(i):
+    return {'timestamp': (_START + timedelta(seconds=i)).strftime("%Y-%m-%dT%H:%M:%S.%fZ"), 'symbol': 'XBTUSD',
+            'side': 'Buy', 'size': 1, 'price': 5000.5, 'trdMatchID': '%03d' % i}
+
+
+def _book_rows(bid_size):
+    return [{'symbol': 'XBTUSD', 'id': 10000, 'side': 'Buy', 'size': bid_size, 'price': 5000.0},
+            {'symbol': 'XBTUSD', 'id': 10001, 'side': 'Sell', 'size': 10, 'price': 5000.5}]
+
+
+def _feed_partials(ws_client, recorded_time, trade_rows, bid_size):
+    ws_client.feed(recorded_time, {'table': 'instrument', 'action': 'partial', 'keys': ['symbol'],
+                                   'data': [{'symbol': 'XBTUSD', 'state': 'Open', 'tickSize': 0.5}]})
+    ws_client.feed(recorded_time, {'table': 'trade', 'action': 'partial', 'keys': [], 'data': trade_rows})
+    ws_client.feed(recorded_time, {'table': 'orderBookL2_25', 'action': 'partial',
+                                   'keys': ['symbol', 'id', 'side'], 'data': _book_rows(bid_size)})
+
+
+class TestReconnect(unittest.TestCase):
+
+    def create_watcher(self, connect=None):
+        from bitmex_watcher.memory_stores import InMemoryMongoClient, InMemoryRedis
+        from bitmex_watcher.reconnect import WsReconnector
+        from bitmex_watcher.replay import ReplayBitMEXClient, ReplayMarketWatcher
+
+        bitmex_client = ReplayBitMEXClient('XBTUSD')
+        _feed_partials(bitmex_client.ws_client, _START, [_trade_row(0)], 100)
+        watcher = ReplayMarketWatcher('XBTUSD', bitmex_client, InMemoryMongoClient(), InMemoryRedis())
+        if connect is not None:
+            watcher.ws_reconnector = WsReconnector(bitmex_client.ws_client, watcher._use_ws_client, connect)
+        watcher.load_state()
+        return watcher
+
+    @staticmethod
+    def capture_at(watcher, seconds):
+        watcher.bitmex_client.ws_client.recorded_time = _START + timedelta(seconds=seconds)
+        return watcher.capture_once()
+
+    def test_reconnect(self):
+        from bitmex_watcher.replay import ReplayWebSocketClient
+        from bitmex_watcher.settings import settings
+
+        def connect(stale_ws_client):
+            # Trades 1 and 2 arrived while the stale websocket was quiet.
+            ws_client = ReplayWebSocketClient(stale_ws_client.symbol)
+            _feed_partials(ws_client, _START + timedelta(seconds=3), [_trade_row(i) for i in range(3)], 120)
+            return ws_client
+
+        with mock.patch.dict(settings, {'LOOP_INTERVAL': 1.0, 'MAX_ORDERS_IDLE_COUNT': 2}):
+            watcher = self.create_watcher(connect)
+            stale_ws_client = watcher.bitmex_client.ws_client
+            for seconds in range(4):
+                self.assertTrue(self.capture_at(watcher, seconds))
+            self.assertTrue(stale_ws_client.exited)
+            self.assertIsNot(stale_ws_client, watcher.bitmex_client.ws_client)
+            self.assertEqual(0, watcher.orders_idle_count)
+            self.assertTrue(self.capture_at(watcher, 4))
+            watcher.exit()
+
+        # The clients and the state are kept, and the trades the stale websocket missed are saved.
+        self.assertTrue(watcher.bitmex_client.is_running)
+        self.assertEqual(1, watcher.metrics.counters['ws_reconnects'])
+        saved_trades = list(watcher.trades_collection.find().sort('timestamp'))
+        self.assertEqual(['000', '001', '002'], [t['trdMatchID'] for t in saved_trades])
+        saved_snapshots = list(watcher.order_book_snapshot_collection.find().sort('timestamp'))
+        self.assertEqual([100, 120], [s['bids'][0]['size'] for s in saved_snapshots])
+
+    def test_give_up(self):
+        from bitmex_watcher.settings import settings
+
+        def connect(stale_ws_client):
+            raise ConnectionError("unreachable")
+
+        with mock.patch.dict(settings, {'LOOP_INTERVAL': 1.0, 'MAX_ORDERS_IDLE_COUNT': 2, 'MAX_RECONNECTS': 2}):
+            watcher = self.create_watcher(connect)
+            # Stale from the fourth capture. Reconnects are tried on it and the next one.
+            self.assertEqual([True] * 5 + [False], [self.capture_at(watcher, seconds) for seconds in range(6)])
+            self.assertEqual(0, watcher.metrics.counters['ws_reconnects'])
+
+            # Without a reconnector, the watcher stops as soon as the data is stale.
+            watcher = self.create_watcher()
+            self.assertEqual([True] * 3 + [False], [self.capture_at(watcher, seconds) for seconds in range(4)])
+
+
+if __name__ == "__main__":
+    unittest.main()
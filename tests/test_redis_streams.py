@@ -0,0 +1,118 @@
+import unittest
+from datetime import datetime
+
+
+def _to_key(entry_id):
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    ms, _, seq = entry_id.partition('-')
+    return int(ms), int(seq or 0)
+
+
+class _FakeStreamRedis:
+
+    def __init__(self):
+        self.entries = []
+        self.groups = {}
+        self.keys = {}
+
+    def xadd(self, name, fields, maxlen=None, approximate=True):
+        entry_id = "{:d}-0".format(len(self.entries) + 1).encode()
+        self.entries.append((entry_id, {k.encode(): v for k, v in fields.items()}))
+        return entry_id
+
+    def set(self, name, value, px=None):
+        self.keys[name] = (value, px)
+
+    def xrevrange(self, name, count=None):
+        return list(reversed(self.entries))[:count]
+
+    def _after(self, last_id, count):
+        return [e for e in self.entries if _to_key(last_id) < _to_key(e[0])][:count]
+
+    def xread(self, streams, count=None, block=None):
+        name, last_id = list(streams.items())[0]
+        entries = self._after(last_id, count)
+        return [[name, entries]] if entries else []
+
+    def xgroup_create(self, name, group_name, id='0', mkstream=False):
+        import redis
+        if group_name in self.groups:
+            raise redis.exceptions.ResponseError("BUSYGROUP Consumer Group name already exists")
+        self.groups[group_name] = {'last': id, 'pending': {}}
+
+    def xreadgroup(self, group_name, consumer_name, streams, count=None, block=None):
+        name, last_id = list(streams.items())[0]
+        group = self.groups[group_name]
+        pending = group['pending'].setdefault(consumer_name, [])
+        if last_id == '>':
+            entries = self._after(group['last'], count)
+            if entries:
+                group['last'] = entries[-1][0]
+            pending.extend(e[0] for e in entries)
+        else:
+            entries = [e for e in self._after(last_id, None) if e[0] in pending][:count]
+        return [[name, entries]] if entries else []
+
+    def xack(self, name, group_name, *entry_ids):
+        for pending in self.groups[group_name]['pending'].values():
+            for each in entry_ids:
+                if each in pending:
+                    pending.remove(each)
+        return len(entry_ids)
+
+
+class TestRedisStreams(unittest.TestCase):
+
+    def test_publisher(self):
+        from bitmex_watcher.utils import constants
+        from bitmex_watcher.models import OrderBookSnapshot
+        from bitmex_watcher.redis_streams import StreamPublisher
+
+        redis_client = _FakeStreamRedis()
+        publisher = StreamPublisher("snapshots", "trades", "heartbeat", 100, 4.5)
+        snapshot = OrderBookSnapshot(datetime.now().astimezone(constants.TIMEZONE),
+                                     [{"price": 100.0, "size": 100}], [{"price": 100.5, "size": 10}], 25)
+        fields = publisher.order_book_snapshot_entry("5cb1d3b0e1382300014e6a4b", snapshot)
+        publisher.add_order_book_snapshot(redis_client, fields)
+        publisher.set_heartbeat(redis_client)
+
+        fields = redis_client.entries[0][1]
+        self.assertEqual("5cb1d3b0e1382300014e6a4b", fields[b'id'])
+        self.assertIn('"midPrice":100.25', fields[b'summary'])
+        self.assertNotIn(b'payload', fields)
+        self.assertEqual(4500, redis_client.keys["heartbeat"][1])
+
+    def test_resume_from_last_id(self):
+        from bitmex_watcher.redis_streams import StreamConsumer
+
+        redis_client = _FakeStreamRedis()
+        redis_client.xadd("s", {'id': 'old'})
+        consumer = StreamConsumer(redis_client, "s")
+        self.assertEqual([], consumer.read())
+        redis_client.xadd("s", {'id': 'a'})
+        redis_client.xadd("s", {'id': 'b'})
+        self.assertEqual(['a'], [f[b'id'] for _, f in consumer.read(count=1)])
+
+        # Reconnected while 'c' was added.
+        redis_client.xadd("s", {'id': 'c'})
+        resumed = StreamConsumer(redis_client, "s", last_id=consumer.last_id)
+        self.assertEqual(['b', 'c'], [f[b'id'] for _, f in resumed.read()])
+
+    def test_consumer_group(self):
+        from bitmex_watcher.redis_streams import StreamConsumer
+
+        redis_client = _FakeStreamRedis()
+        consumer = StreamConsumer(redis_client, "s", group_name="bots", consumer_name="bot1")
+        redis_client.xadd("s", {'id': 'a'})
+        redis_client.xadd("s", {'id': 'b'})
+        entries = consumer.read()
+        self.assertEqual(['a', 'b'], [f[b'id'] for _, f in entries])
+        consumer.ack([entries[0][0]])
+
+        # Restarted before acknowledging 'b'.
+        redis_client.xadd("s", {'id': 'c'})
+        restarted = StreamConsumer(redis_client, "s", group_name="bots", consumer_name="bot1")
+        self.assertEqual(['b'], [f[b'id'] for _, f in restarted.read()])
+        self.assertEqual(['c'], [f[b'id'] for _, f in restarted.read()])
+        self.assertEqual([], restarted.read())
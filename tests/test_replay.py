@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+
+os.environ.setdefault('MARKET_ORDER_BOOK_DATA_NAME', 'orderBookL2_25')
+
+_START = datetime(2019, 4, 13, 12, 0, 0, tzinfo=timezone.utc)
+
+
+class TestReplay(unittest.TestCase):
+
+    def test_recorder(self):
+        from bitmex_watcher.ws_events import WsMessageRecorder, read_recorded_messages
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'messages.jsonl')
+            recorder = WsMessageRecorder(path)
+            recorder.on_message({'table': 'trade', 'action': 'insert', 'data': [{'trdMatchID': 'a'}]})
+            recorder.on_message({'table': 'trade', 'action': 'insert', 'data': [{'trdMatchID': 'b'}]})
+            recorder.close()
+
+            recorded = list(read_recorded_messages(path))
+            self.assertEqual(['a', 'b'], [m['data'][0]['trdMatchID'] for _, m in recorded])
+            self.assertLessEqual(recorded[0][0], recorded[1][0])
+            self.assertEqual(timezone.utc, recorded[0][0].tzinfo)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_replay_documents(self):
+        from bitmex_watcher.replay import messages_from_documents, replay
+
+        trades = [{'timestamp': _START + timedelta(seconds=i), 'trdMatchID': '%03d' % i, 'side': 'Buy',
+                   'price': 5000.5, 'size': i + 1} for i in range(6)]
+        snapshots = [
+            {'timestamp': _START, 'bids': [{'price': 5000.0, 'size': 100}], 'asks': [{'price': 5000.5, 'size': 10}]},
+            {'timestamp': _START + timedelta(seconds=2.5),
+             'bids': [{'price': 5000.0, 'size': 120}], 'asks': [{'price': 5000.5, 'size': 10}]},
+            # Unchanged.
+            {'timestamp': _START + timedelta(seconds=4),
+             'bids': [{'price': 5000.0, 'size': 120}], 'asks': [{'price': 5000.5, 'size': 10}]},
+        ]
+        messages = list(messages_from_documents('XBTUSD', 0.5, trades, snapshots))
+        self.assertEqual(['instrument', 'trade', 'orderBookL2_25', 'trade'], [m['table'] for _, m in messages[:4]])
+        self.assertEqual([10000, 10001], sorted(row['id'] for row in messages[2][1]['data']))
+
+        stats, watcher = replay(messages, capture_interval=1.0)
+        self.assertEqual(len(messages), stats['messages'])
+        self.assertEqual(7, stats['captures'])
+        # The last capture is after the last message.
+        self.assertEqual(6.0, stats['recordedSeconds'])
+
+        saved_trades = list(watcher.trades_collection.find().sort('timestamp'))
+        self.assertEqual(['%03d' % i for i in range(6)], [t['trdMatchID'] for t in saved_trades])
+        # Snapshots are taken on the recorded clock.
+        saved_snapshots = list(watcher.order_book_snapshot_collection.find().sort('timestamp'))
+        self.assertEqual([_START, _START + timedelta(seconds=3)], [s['timestamp'] for s in saved_snapshots])
+        self.assertEqual([100, 120], [s['bids'][0]['size'] for s in saved_snapshots])
+        self.assertFalse(watcher.is_running)
+
+
+if __name__ == "__main__":
+    unittest.main()
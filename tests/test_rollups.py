@@ -0,0 +1,125 @@
+import math
+import random
+import unittest
+from datetime import datetime, timedelta, timezone
+
+
+_START = datetime(2019, 4, 13, 12, 0, 0, tzinfo=timezone.utc)
+
+
+def _random_trades(num_trades, seed=0):
+    from pybitmex import Trade
+
+    rnd = random.Random(seed)
+    trades = []
+    timestamp = _START
+    for i in range(num_trades):
+        timestamp += timedelta(milliseconds=rnd.randint(0, 3000))
+        trades.append(Trade("%06d" % i, timestamp, rnd.choice(["Buy", "Sell"]),
+                            5000.0 + 0.5 * rnd.randint(-40, 40), rnd.randint(1, 10000)))
+    return trades
+
+
+def _expected_stats(trades):
+    prices = [t.price for t in trades]
+    mean = sum(prices) / len(prices)
+    return {
+        'open': prices[0], 'high': max(prices), 'low': min(prices), 'close': prices[-1],
+        'volume': sum(t.size for t in trades), 'momentum': sum(t.momentum for t in trades), 'count': len(trades),
+        'mean': mean, 'sd': math.sqrt(sum((p - mean) ** 2 for p in prices) / len(prices))
+    }
+
+
+class _FakeCursor(list):
+
+    def sort(self, key, direction):
+        return _FakeCursor(sorted(self, key=lambda d: d[key], reverse=direction < 0))
+
+
+class _FakeCollection:
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def find(self, query):
+        condition = query["timestamp"]
+        return _FakeCursor(d for d in self.documents if condition["$gte"] <= d["timestamp"] < condition["$lt"])
+
+
+class TestRollups(unittest.TestCase):
+
+    def _assert_stats(self, expected, stats):
+        for key, value in expected.items():
+            self.assertAlmostEqual(value, stats[key], places=6, msg=key)
+
+    def test_bucket_merge(self):
+        from bitmex_watcher.rollups import RollupBucket
+
+        trades = _random_trades(500)
+        whole = RollupBucket(_START)
+        parts = [RollupBucket(_START) for _ in range(4)]
+        for i, trade in enumerate(trades):
+            whole.add(trade)
+            parts[i * len(parts) // len(trades)].add(trade)
+        merged = RollupBucket(_START)
+        for each in [RollupBucket(_START)] + parts:
+            merged.merge(each)
+
+        self._assert_stats(_expected_stats(trades), whole.to_stats_dict())
+        self._assert_stats(_expected_stats(trades), merged.to_stats_dict())
+        self.assertEqual(whole.to_dict()['lastTrdMatchID'], RollupBucket.from_dict(merged.to_dict()).last_trd_match_id)
+
+    def test_add_earlier(self):
+        from bitmex_watcher.rollups import TradeRollups
+
+        trades = [t for t in _random_trades(200) if t.timestamp < _START + timedelta(seconds=60)]
+        rollups = TradeRollups([60])
+        # A gap in the middle is backfilled after the rest.
+        gap = trades[10:20]
+        rollups.add(trades[:10] + trades[20:])
+        changed = rollups.add_earlier(gap)
+        self.assertEqual([rollups.buckets[60]], changed[60])
+        self._assert_stats(_expected_stats(trades), rollups.buckets[60].to_stats_dict())
+        self.assertEqual(trades[-1].trd_match_id, rollups.buckets[60].last_trd_match_id)
+
+        # A gap at the start opens the bucket.
+        rollups = TradeRollups([60])
+        rollups.add(trades[10:])
+        rollups.add_earlier(trades[:10])
+        self._assert_stats(_expected_stats(trades), rollups.buckets[60].to_stats_dict())
+
+    def test_cover_range(self):
+        from bitmex_watcher.rollups import cover_range
+
+        def at(minutes, seconds=0):
+            return _START + timedelta(minutes=minutes, seconds=seconds)
+
+        self.assertEqual(
+            [(1, at(3, 30), at(4)), (60, at(4), at(5)), (300, at(5), at(15)), (60, at(15), at(16)),
+             (1, at(16), at(16, 11))],
+            cover_range(at(3, 30), at(16, 11), [1, 60, 300]))
+        self.assertEqual([(1, at(1, 30), at(1, 40))], cover_range(at(1, 30), at(1, 40), [1, 60, 300]))
+
+    def test_rollups_and_reader(self):
+        from bitmex_watcher.rollups import TradeRollups, TradesRollupReader, floor_timestamp
+
+        trades = _random_trades(2000)
+        rollups = TradeRollups([300, 1, 60])
+        documents = {1: {}, 60: {}, 300: {}}
+        for i in range(0, len(trades), 37):
+            # Trades fed again after a restart are skipped.
+            for interval, buckets in rollups.add(trades[max(0, i - 5):i + 37]).items():
+                for bucket in buckets:
+                    documents[interval][bucket.timestamp] = bucket.to_dict()
+
+        restarted = TradeRollups([1, 60, 300])
+        restarted.seed({interval: documents[interval][max(documents[interval])] for interval in documents})
+        self.assertEqual(trades[-1].trd_match_id, restarted.cursor.trd_match_id)
+        self.assertEqual({1: [], 60: [], 300: []}, restarted.add(trades[-3:]))
+
+        reader = TradesRollupReader({k: _FakeCollection(list(v.values())) for k, v in documents.items()})
+        end = trades[-1].timestamp
+        for start in (_START, _START + timedelta(minutes=7, seconds=13), end - timedelta(minutes=30)):
+            # To the precision of the finest interval.
+            expected = _expected_stats([t for t in trades if floor_timestamp(start, 1) <= t.timestamp])
+            self._assert_stats(expected, reader.stats(start, end))
@@ -0,0 +1,90 @@
+import random
+import unittest
+from datetime import datetime
+
+
+_CASES = [
+    ([{"price": 100.0, "size": 100}, {"price": 99.5, "size": 200}],
+     [{"price": 100.5, "size": 10}, {"price": 101.0, "size": 50}],
+     0.0075),
+    ([{"price": 99.0, "size": 200}, {"price": 98.5, "size": 10},
+      {"price": 98.0, "size": 250}, {"price": 97.0, "size": 100}],
+     [{"price": 100.5, "size": 150}, {"price": 101.0, "size": 100},
+      {"price": 102.0, "size": 200}, {"price": 102.5, "size": 150}],
+     0.025),
+    ([{"price": 99.5, "size": 50}, {"price": 99.0, "size": 200}, {"price": 98.5, "size": 10},
+      {"price": 98.0, "size": 250}, {"price": 97.0, "size": 100}],
+     [{"price": 100.5, "size": 150}, {"price": 101.0, "size": 100},
+      {"price": 102.0, "size": 200}, {"price": 102.5, "size": 150}],
+     0.025)
+]
+
+
+def _random_levels(rnd, best_price, direction):
+    num_levels = rnd.randint(1, 60)
+    prices = [0] + sorted(rnd.sample(range(1, 200), num_levels - 1))
+    return [{"price": best_price + direction * p * 0.5, "size": rnd.randint(1, 500000)} for p in prices]
+
+
+class TestOrderBookArrays(unittest.TestCase):
+
+    def _assert_same_as_snapshot(self, metrics, snapshot):
+        for name, value in metrics.items():
+            self.assertEqual(getattr(snapshot, name), value, name)
+
+    def test_same_results_as_order_book_snapshot(self):
+        from bitmex_watcher.utils import constants
+        from bitmex_watcher.models import OrderBookSnapshot
+        from bitmex_watcher.snapshot_arrays import OrderBookArrays
+
+        now = datetime.now().astimezone(constants.TIMEZONE)
+        expected_values = [(100.5417, 0.2917, 0.8333, 360), (99.8736, 0.1236, 0.5055, 910),
+                           (100.0068, 0.0068, 0.4595, 1110)]
+        for (bids, asks, ratio), expected in zip(_CASES, expected_values):
+            metrics = OrderBookArrays.from_levels(now, bids, asks).compute_metrics(ratio)
+            self.assertEqual(expected, (metrics['price_from_depth'], metrics['depth_bias'],
+                                        metrics['bids_ratio'], metrics['total_volume']))
+            self._assert_same_as_snapshot(metrics, OrderBookSnapshot(now, bids, asks, ratio))
+
+    def test_batch(self):
+        from bitmex_watcher.utils import constants
+        from bitmex_watcher.models import OrderBookSnapshot
+        from bitmex_watcher.snapshot_arrays import OrderBookArrays, OrderBookArraysBatch
+
+        now = datetime.now().astimezone(constants.TIMEZONE)
+        rnd = random.Random(777)
+        books = []
+        for _ in range(200):
+            best_bid = 3000.0 + rnd.randint(0, 4000) * 0.5
+            books.append((_random_levels(rnd, best_bid, -1), _random_levels(rnd, best_bid + 0.5, 1)))
+
+        ratio = 0.005
+        batch = OrderBookArraysBatch.from_arrays([OrderBookArrays.from_levels(now, b, a) for b, a in books])
+        metrics = batch.compute_metrics(ratio)
+        self.assertEqual(len(books), len(batch))
+        for i, (bids, asks) in enumerate(books):
+            self._assert_same_as_snapshot({k: v[i].item() for k, v in metrics.items()},
+                                          OrderBookSnapshot(now, bids, asks, ratio))
+
+    def test_levels_round_trip(self):
+        from bitmex_watcher.snapshot_arrays import OrderBookArrays
+
+        bids, asks, _ = _CASES[1]
+        arrays = OrderBookArrays.from_document({"timestamp": None, "bids": bids, "asks": asks})
+        self.assertEqual((bids, asks), arrays.to_levels())
+
+    def test_from_bytes(self):
+        from bitmex_watcher.utils import constants
+        from bitmex_watcher.models import OrderBookSnapshot
+        from bitmex_watcher.snapshot_arrays import OrderBookArrays
+
+        bids, asks, ratio = _CASES[1]
+        snapshot = OrderBookSnapshot(datetime.now().astimezone(constants.TIMEZONE), bids, asks, 25)
+        data = snapshot.to_bytes(0.5)
+        arrays = OrderBookArrays.from_bytes(data)
+        self.assertEqual((snapshot.bids, snapshot.asks), arrays.to_levels())
+        self.assertEqual(snapshot.timestamp, arrays.timestamp)
+        # Sizes are not copied.
+        self.assertFalse(arrays.bid_sizes.flags.owndata)
+        self._assert_same_as_snapshot(arrays.compute_metrics(ratio),
+                                      OrderBookSnapshot(snapshot.timestamp, bids, asks, ratio))
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timezone
+
+
+class TestSnapshotRing(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'ring')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write_and_read(self):
+        from bitmex_watcher.snapshot_ring import SnapshotRingWriter, SnapshotRingReader
+
+        writer = SnapshotRingWriter(self.path, num_slots=3, slot_bytes=16)
+        reader = SnapshotRingReader(self.path)
+        self.assertEqual(0, reader.last_number())
+        self.assertEqual([], reader.read_latest(3))
+
+        for i in range(5):
+            self.assertEqual(i + 1, writer.write(bytes([i]) * (i + 1)))
+        self.assertEqual(5, reader.last_number())
+        self.assertEqual([(5, b'\x04' * 5), (4, b'\x03' * 4), (3, b'\x02' * 3)], reader.read_latest(10))
+        # Overwritten.
+        self.assertIsNone(reader.read(2))
+        self.assertIsNone(reader.read(6))
+
+        with self.assertRaises(ValueError):
+            writer.write(bytes(17))
+        reader.close()
+        writer.close()
+
+    def test_restart(self):
+        from bitmex_watcher.snapshot_ring import SnapshotRingWriter, SnapshotRingReader
+
+        writer = SnapshotRingWriter(self.path, num_slots=3, slot_bytes=16)
+        writer.write(b'old')
+        reader = SnapshotRingReader(self.path)
+        self.assertEqual([(1, b'old')], reader.read_latest())
+
+        # The restarted writer replaces the file. The mapping of the reader stays valid until it finds the new one.
+        writer.close()
+        writer = SnapshotRingWriter(self.path, num_slots=4, slot_bytes=16)
+        self.assertEqual(b'old', reader.read(1))
+        self.assertEqual(0, reader.last_number())
+        self.assertEqual(2, reader.generation)
+        self.assertEqual(4, reader.num_slots)
+        writer.write(b'new')
+        self.assertEqual([(1, b'new')], reader.read_latest())
+        self.assertEqual([self.path], [os.path.join(self.directory, f) for f in os.listdir(self.directory)])
+        reader.close()
+        writer.close()
+
+    def test_order_book_snapshot(self):
+        from bitmex_watcher.models import OrderBookSnapshot, parse_order_book_bytes
+        from bitmex_watcher.snapshot_ring import SnapshotRingWriter, SnapshotRingReader
+
+        bids = [{"price": 100.0, "size": 100}, {"price": 99.5, "size": 200}]
+        asks = [{"price": 100.5, "size": 10}]
+        snapshot = OrderBookSnapshot(datetime(2019, 4, 13, tzinfo=timezone.utc), bids, asks, 25)
+        writer = SnapshotRingWriter(self.path, num_slots=4, slot_bytes=4096)
+        writer.write(snapshot.to_bytes(0.5, None, '5cb1a8a0e4b0a1b2c3d4e5f6'))
+
+        number, data = SnapshotRingReader(self.path).read_latest()[0]
+        loaded = parse_order_book_bytes(data)
+        self.assertEqual(1, number)
+        self.assertEqual('5cb1a8a0e4b0a1b2c3d4e5f6', loaded['id'])
+        self.assertEqual(bids, loaded['bids'])
+        writer.close()
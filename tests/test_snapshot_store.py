@@ -0,0 +1,88 @@
+import unittest
+from datetime import datetime, timedelta
+
+
+class TestOrderBookSnapshotEncoder(unittest.TestCase):
+
+    def test_keyframes_and_deltas(self):
+        from bitmex_watcher.utils import constants
+        from bitmex_watcher.models import OrderBookSnapshot
+        from bitmex_watcher.snapshot_store import OrderBookSnapshotEncoder, rebuild_levels, KEYFRAME, DELTA
+
+        start = datetime.strptime("2019-04-13 00:00:00", '%Y-%m-%d %H:%M:%S').astimezone(constants.TIMEZONE)
+        books = [
+            ([{"price": 100.0, "size": 100}, {"price": 99.5, "size": 200}],
+             [{"price": 100.5, "size": 10}, {"price": 101.0, "size": 50}]),
+            ([{"price": 100.0, "size": 120}, {"price": 99.5, "size": 200}],
+             [{"price": 100.5, "size": 10}, {"price": 101.0, "size": 50}]),
+            ([{"price": 100.0, "size": 120}, {"price": 99.0, "size": 30}],
+             [{"price": 100.5, "size": 15}, {"price": 101.0, "size": 50}, {"price": 101.5, "size": 1}]),
+            ([{"price": 100.0, "size": 1}],
+             [{"price": 100.5, "size": 15}]),
+        ]
+        encoder = OrderBookSnapshotEncoder(keyframe_interval_snapshots=3, keyframe_interval_seconds=60)
+        documents = []
+        prev_snapshot = None
+        for i, (bids, asks) in enumerate(books):
+            snapshot = OrderBookSnapshot(start + timedelta(seconds=i), bids, asks, 25)
+            documents.append(encoder.encode(snapshot, snapshot.changes_from(prev_snapshot)))
+            prev_snapshot = snapshot
+
+        self.assertEqual([KEYFRAME, DELTA, DELTA, KEYFRAME], [d['type'] for d in documents])
+        self.assertEqual([0, 1, 2, 0], [d['seq'] for d in documents])
+        self.assertEqual(documents[0]['_id'], documents[2]['keyframeId'])
+        self.assertEqual(documents[3]['_id'], documents[3]['keyframeId'])
+        self.assertEqual(1, len(documents[1]['bidsChanges']) + len(documents[1]['asksChanges']))
+        self.assertEqual(100.0, documents[1]['highestBid'])
+
+        for i in range(3):
+            self.assertEqual(books[i], rebuild_levels(documents[0], documents[1:i + 1]))
+
+        encoder = OrderBookSnapshotEncoder(keyframe_interval_snapshots=100, keyframe_interval_seconds=1)
+        bids, asks = books[0]
+        types = []
+        for i in range(3):
+            snapshot = OrderBookSnapshot(start + timedelta(seconds=0.6 * i), bids, asks, 25)
+            types.append(encoder.encode(snapshot, snapshot.changes_from(snapshot))['type'])
+        self.assertEqual([KEYFRAME, DELTA, KEYFRAME], types)
+
+    def test_to_dict_has_levels_once(self):
+        from bitmex_watcher.utils import constants
+        from bitmex_watcher.models import OrderBookSnapshot
+
+        bids = [{"price": 100.0, "size": 100}]
+        asks = [{"price": 100.5, "size": 10}]
+        snapshot = OrderBookSnapshot(datetime.now().astimezone(constants.TIMEZONE), bids, asks, 25)
+        self.assertNotIn('bids', snapshot.to_summary_dict())
+        self.assertEqual(bids, snapshot.to_dict()['bids'])
+
+    def test_binary_document(self):
+        from bson.objectid import ObjectId
+        from bitmex_watcher.utils import constants
+        from bitmex_watcher.models import OrderBookSnapshot
+        from bitmex_watcher.snapshot_store import OrderBookSnapshotReader, to_binary_document
+
+        bids = [{"price": 100.0, "size": 100}, {"price": 99.5, "size": 200}]
+        asks = [{"price": 100.5, "size": 10}]
+        snapshot = OrderBookSnapshot(datetime.now().astimezone(constants.TIMEZONE), bids, asks, 25)
+        document = to_binary_document(snapshot, 0.5)
+        document['_id'] = ObjectId()
+
+        loaded = OrderBookSnapshotReader(None).rebuild(document)
+        self.assertEqual(document['_id'], loaded.pop('_id'))
+        self.assertEqual(snapshot.to_dict(), loaded)
+
+    def test_keyframe_at_new_partition(self):
+        from bitmex_watcher.utils import constants
+        from bitmex_watcher.models import OrderBookSnapshot
+        from bitmex_watcher.snapshot_store import OrderBookSnapshotEncoder, KEYFRAME, DELTA
+
+        start = datetime.strptime("2019-04-13 00:00:00", '%Y-%m-%d %H:%M:%S').astimezone(constants.TIMEZONE)
+        bids = [{"price": 100.0, "size": 100}]
+        asks = [{"price": 100.5, "size": 10}]
+        encoder = OrderBookSnapshotEncoder(keyframe_interval_snapshots=100, keyframe_interval_seconds=60)
+        types = []
+        for i, partition in enumerate(["s_2019041300", "s_2019041300", "s_2019041301", "s_2019041301"]):
+            snapshot = OrderBookSnapshot(start + timedelta(seconds=i), bids, asks, 25)
+            types.append(encoder.encode(snapshot, snapshot.changes_from(snapshot), partition)['type'])
+        self.assertEqual([KEYFRAME, DELTA, KEYFRAME, DELTA], types)
@@ -0,0 +1,50 @@
+import os
+import unittest
+from datetime import datetime, timedelta
+
+os.environ.setdefault('MARKET_ORDER_BOOK_DATA_NAME', 'orderBookL2_25')
+
+
+def _row(trd_match_id, timestamp, symbol="XBTUSD"):
+    return {"symbol": symbol, "trdMatchID": trd_match_id, "timestamp": timestamp,
+            "side": "Buy", "price": 5000.5, "size": 10}
+
+
+class TestTradeStream(unittest.TestCase):
+
+    def test_drain(self):
+        from bitmex_watcher.utils import constants
+        from bitmex_watcher.trade_stream import TradeStream
+
+        stream = TradeStream("XBTUSD")
+        stream.append([_row("b", "2019-04-13T12:00:01.000Z"), _row("a", "2019-04-13T12:00:01.000Z")])
+        stream.on_message({"table": "trade", "action": "insert", "data": [
+            _row("c", "2019-04-13T12:00:00.500Z"), _row("a", "2019-04-13T12:00:01.000Z"),
+            _row("x", "2019-04-13T12:00:00.000Z", symbol="ETHUSD")
+        ]})
+        stream.on_message({"table": "orderBookL2", "action": "insert", "data": [{"id": 1}]})
+
+        trades = stream.drain()
+        self.assertEqual(["c", "a", "b"], [t.trd_match_id for t in trades])
+        self.assertEqual(datetime(2019, 4, 13, 12, 0, 0, 500000, tzinfo=constants.TIMEZONE), trades[0].timestamp)
+        self.assertEqual([], stream.drain())
+
+
+class TestFilterNewTrades(unittest.TestCase):
+
+    def test_binary_search(self):
+        from pybitmex import Trade
+        from bitmex_watcher.utils import constants
+        from bitmex_watcher.models import TradesCursor
+        from bitmex_watcher.watcher_server import MarketWatcher
+
+        start = datetime(2019, 4, 13, 12, 0, 0, tzinfo=constants.TIMEZONE)
+        trades = [Trade("%03d" % i, start + timedelta(seconds=i // 3), "Buy", 5000.0, 1) for i in range(30)]
+
+        self.assertEqual(trades, MarketWatcher.filter_new_trades(None, trades))
+        self.assertEqual([], MarketWatcher.filter_new_trades(TradesCursor(start, "000"), []))
+        for i in range(30):
+            cursor = TradesCursor(trades[i].timestamp, trades[i].trd_match_id)
+            self.assertEqual(trades[i + 1:], MarketWatcher.filter_new_trades(cursor, trades))
+        self.assertEqual(trades, MarketWatcher.filter_new_trades(TradesCursor(start, "!"), trades))
+        self.assertEqual(trades[3:], MarketWatcher.filter_new_trades(TradesCursor(start, "zzz"), trades))
@@ -0,0 +1,65 @@
+import math
+import random
+import unittest
+from datetime import datetime, timedelta, timezone
+
+
+_START = datetime(2019, 4, 13, 12, 0, 0, tzinfo=timezone.utc)
+
+
+class TestTradeWindows(unittest.TestCase):
+
+    def test_against_full_scan(self):
+        from pybitmex import Trade
+        from bitmex_watcher.trade_windows import TradeWindows, parse_trade_stats_payload
+
+        rnd = random.Random(0)
+        windows = TradeWindows([300, 60])
+        trades = []
+        now = _START
+        for i in range(3000):
+            # Bursts and pauses longer than the shorter window.
+            now += timedelta(milliseconds=rnd.choice([0, 50, 500, 5000, 90000]))
+            trade = Trade("%06d" % i, now, rnd.choice(["Buy", "Sell"]),
+                          5000.0 + 0.5 * rnd.randint(-40, 40), rnd.randint(1, 10000))
+            trades.append(trade)
+            windows.add([trade])
+            if i % 7 != 0:
+                continue
+            stats = parse_trade_stats_payload(windows.to_payload(now + timedelta(seconds=1)).encode())
+            for name, seconds in (('1m', 60), ('5m', 300)):
+                in_window = [t for t in trades if now + timedelta(seconds=1 - seconds) < t.timestamp]
+                window = stats[name]
+                self.assertEqual(len(in_window), window['count'])
+                if not in_window:
+                    self.assertIsNone(window['mean'])
+                    continue
+                prices = [t.price for t in in_window]
+                mean = sum(prices) / len(prices)
+                self.assertEqual(sum(t.size for t in in_window), window['volume'])
+                self.assertEqual(sum(t.momentum for t in in_window), window['momentum'])
+                self.assertEqual(min(prices), window['min'])
+                self.assertEqual(max(prices), window['max'])
+                self.assertAlmostEqual(mean, window['mean'], places=6)
+                self.assertAlmostEqual(math.sqrt(sum((p - mean) ** 2 for p in prices) / len(prices)),
+                                       window['sd'], places=6)
+                self.assertAlmostEqual(sum(t.price * t.size for t in in_window) / window['volume'],
+                                       window['vwap'], places=6)
+
+    def test_replayed_trades(self):
+        from pybitmex import Trade
+        from bitmex_watcher.models import trade_from_dict
+        from bitmex_watcher.trade_windows import TradeWindows
+
+        trades = [Trade("a", _START, "Buy", 100.0, 10), Trade("b", _START, "Sell", 101.0, 3),
+                  Trade("c", _START + timedelta(seconds=1), "Buy", 99.5, 5)]
+        windows = TradeWindows([60])
+        # Loaded from MongoDB on start, then fetched again from the websocket.
+        windows.add([trade_from_dict(dict(t.to_dict(), timestamp=t.timestamp.replace(tzinfo=None)))
+                     for t in trades[:2]])
+        windows.add(trades)
+        stats = windows.to_dict(_START + timedelta(seconds=30))['1m']
+        self.assertEqual(3, stats['count'])
+        self.assertEqual(12, stats['momentum'])
+
+        self.assertEqual(0, windows.to_dict(_START + timedelta(seconds=61))['1m']['count'])
@@ -0,0 +1,36 @@
+import unittest
+
+
+class _FakeWsApp:
+
+    def __init__(self):
+        self.received = []
+        self.on_message = self.received.append
+
+
+class _FakeWsClient:
+
+    def __init__(self):
+        self.ws = _FakeWsApp()
+
+
+class TestWsMessageDispatcher(unittest.TestCase):
+
+    def test_notify_after_original_handler(self):
+        from bitmex_watcher.ws_events import WsMessageDispatcher
+
+        ws_client = _FakeWsClient()
+        dispatcher = WsMessageDispatcher()
+        dispatcher.attach(ws_client)
+        self.assertFalse(dispatcher.wait(0.01))
+
+        messages = []
+        dispatcher.add_listener(messages.append)
+        ws_client.ws.on_message('{"table": "trade", "action": "insert", "data": []}')
+
+        self.assertEqual(1, len(ws_client.ws.received))
+        self.assertEqual("trade", messages[0]["table"])
+        self.assertTrue(dispatcher.wait(0.01))
+
+        dispatcher.clear()
+        self.assertFalse(dispatcher.wait(0.01))